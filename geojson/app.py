@@ -2,6 +2,9 @@ import os
 import subprocess
 import boto3
 
+from export import export_file
+from upload import export_to_s3
+
 
 def lambda_handler(event, context):
     dataset_id = event.get("dataset_id")
@@ -32,12 +35,45 @@ def lambda_handler(event, context):
 
     target = f"/tmp/data/mapbox/mts/{dataset_id}.geojsonld"
     s3_key = f"climate-data-geojson/v{dataset_version}/{dataset_id}.geojsonld"
-
-    # Run gmake with the specified target
-    try:
-        subprocess.run(["gmake", target], check=True, env=env)
-    except subprocess.CalledProcessError as e:
-        return {"status": "error", "message": str(e)}
+    # EXPORT_NATIVE exports the cells straight from Postgres with
+    # export.py instead of gmake and ogr2ogr. It's off by default until
+    # a run against PostGIS shows the two give the same output (see
+    # `python export.py ID --benchmark`). Lambda has no /dev/shm for a
+    # process pool, so the native encoding runs in this process unless
+    # EXPORT_WORKERS says otherwise.
+    native = event.get("native", os.getenv("EXPORT_NATIVE") == "1")
+    workers = int(os.getenv("EXPORT_WORKERS", "0"))
+    # S3_ENDPOINT_URL points it at a local S3 stand-in for testing.
+    s3_client = boto3.client("s3", region_name="us-west-2", endpoint_url=os.getenv("S3_ENDPOINT_URL") or None)
+
+    # With the native exporter, EXPORT_STREAM uploads the export as it's
+    # generated rather than writing it to /tmp first; EXPORT_GZIP gzips
+    # it on the way.
+    if native and event.get("stream", os.getenv("EXPORT_STREAM") == "1"):
+        compress = event.get("gzip", os.getenv("EXPORT_GZIP") == "1")
+        if compress:
+            s3_key += ".gz"
+        print(f"Streaming dataset {dataset_id} to bucket {bucket_name} with key {s3_key}...")
+        try:
+            features, written, uploaded = export_to_s3(dataset_id, s3_client, bucket_name, s3_key, compress, workers)
+        except Exception as e:
+            print(f"Upload failed: {e}")
+            return {"status": "error", "message": f"Failed to stream the export to S3: {str(e)}"}
+        print(f"Uploaded {features} features ({written} bytes, {uploaded} bytes uploaded).")
+        return {"status": "success", "s3_path": f"s3://{bucket_name}/{s3_key}"}
+
+    if native:
+        try:
+            features, _ = export_file(dataset_id, target, workers=workers)
+            print(f"Exported {features} features")
+        except Exception as e:
+            return {"status": "error", "message": str(e)}
+    else:
+        # Run gmake with the specified target
+        try:
+            subprocess.run(["gmake", target], check=True, env=env)
+        except subprocess.CalledProcessError as e:
+            return {"status": "error", "message": str(e)}
 
     if not os.path.exists(target):
         return {"status": "error", "message": f"File not found: {target}"}
@@ -45,8 +81,6 @@ def lambda_handler(event, context):
     file_size = os.path.getsize(target)
     print(f"File size: {file_size} bytes")
 
-    s3_client = boto3.client("s3", region_name="us-west-2")
-
     config = boto3.s3.transfer.TransferConfig(
         multipart_threshold=100 * 1024 * 1024,  # 100 MB
         multipart_chunksize=10 * 1024 * 1024,  # 10 MB
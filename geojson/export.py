@@ -0,0 +1,339 @@
+import argparse
+import json
+import os
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import psycopg2
+
+"""
+Exports a dataset's cells as newline-delimited GeoJSON (GeoJSONSeq),
+the way `gmake /tmp/data/mapbox/mts/{id}.geojsonld` does with ogr2ogr,
+without GDAL.
+
+The rows come off a server-side cursor `FETCH_SIZE` at a time and are
+encoded into lines of GeoJSON as they come. With --workers, the
+dataset is split into `RANGES` ranges of coordinate hashes; each
+worker process reads and encodes ranges over a connection of its own
+(so no rows are shipped between processes), and the ranges are
+written out in order. Cells come in coordinate hash order either way,
+so the output doesn't depend on the number of workers. Coordinates are
+rounded to `COORDINATE_PRECISION` decimals like ogr2ogr's GeoJSONSeq
+(RFC 7946) output; outer rings go counterclockwise; and a cell that
+crosses the antimeridian is split into a MultiPolygon, like
+`-wrapdateline`. The values are written as Postgres prints them.
+
+    python export.py 40104 --output 40104.geojsonld
+    python export.py 40104 --benchmark
+
+"""
+
+# Same as CHANGE_MAPS_IDS in the Makefile: these are exported from the
+# view with absolute values for change maps.
+CHANGE_MAPS_IDS = {40601, 40614, 40607, 40616, 40612, 40613, 40703, 40704}
+
+EXPORT_COLUMNS = [
+    "data_baseline_low",
+    "data_baseline_mid",
+    "data_baseline_high",
+    "data_1c_low",
+    "data_1c_mid",
+    "data_1c_high",
+    "data_1_5c_low",
+    "data_1_5c_mid",
+    "data_1_5c_high",
+    "data_2c_low",
+    "data_2c_mid",
+    "data_2c_high",
+    "data_2_5c_low",
+    "data_2_5c_mid",
+    "data_2_5c_high",
+    "data_3c_low",
+    "data_3c_mid",
+    "data_3c_high",
+]
+
+FETCH_SIZE = 50000
+COORDINATE_PRECISION = 7
+# How many ranges of coordinate hashes the workers split a dataset into.
+RANGES = 16
+COPY_BUFFER_SIZE = 1 << 20
+
+
+def export_view(dataset_id):
+    if int(dataset_id) in CHANGE_MAPS_IDS:
+        return "pf_private.aggregate_pf_statistic_cells_change_to_absolute"
+    return "pf_private.aggregate_pf_dataset_statistic_cells"
+
+
+def export_query(dataset_id):
+    """The query ogr2ogr runs (see SELECT_QUERY in the Makefile)."""
+    return "select cell, {} from {} where dataset_id = {}".format(
+        ", ".join(EXPORT_COLUMNS), export_view(dataset_id), int(dataset_id)
+    )
+
+
+def cell_query(dataset_id):
+    """The same rows with the cell as its bounds and the values as text."""
+    return (
+        "select ST_XMin(cell::geometry), ST_YMin(cell::geometry), "
+        "ST_XMax(cell::geometry), ST_YMax(cell::geometry), {} from {} where dataset_id = {}".format(
+            ", ".join("{}::text".format(column) for column in EXPORT_COLUMNS),
+            export_view(dataset_id),
+            int(dataset_id),
+        )
+    )
+
+
+def connect():
+    return psycopg2.connect(
+        host=os.getenv("PG_HOST"),
+        port=os.getenv("PG_PORT"),
+        user=os.getenv("PG_USER"),
+        password=os.getenv("PG_PASSWORD"),
+        dbname=os.getenv("PG_DBNAME"),
+    )
+
+
+def _number(value, precision, cache):
+    text = cache.get(value)
+    if text is None:
+        text = "{:.{}f}".format(value, precision).rstrip("0").rstrip(".")
+        if text == "-0":
+            text = "0"
+        cache[value] = text
+    return text
+
+
+def _ring(xmin, ymin, xmax, ymax, precision, cache):
+    x0 = _number(xmin, precision, cache)
+    y0 = _number(ymin, precision, cache)
+    x1 = _number(xmax, precision, cache)
+    y1 = _number(ymax, precision, cache)
+    # Counterclockwise, as RFC 7946 wants outer rings.
+    return "[[{0},{1}],[{2},{1}],[{2},{3}],[{0},{3}],[{0},{1}]]".format(x0, y0, x1, y1)
+
+
+def _geometry(xmin, ymin, xmax, ymax, precision, cache):
+    if xmax > 180:
+        east = _ring(xmin, ymin, 180, ymax, precision, cache)
+        west = _ring(-180, ymin, xmax - 360, ymax, precision, cache)
+    elif xmin < -180:
+        east = _ring(xmin + 360, ymin, 180, ymax, precision, cache)
+        west = _ring(-180, ymin, xmax, ymax, precision, cache)
+    else:
+        return '{"type":"Polygon","coordinates":[' + _ring(xmin, ymin, xmax, ymax, precision, cache) + "]}"
+    return '{"type":"MultiPolygon","coordinates":[[' + east + "],[" + west + "]]}"
+
+
+_KEYS = ['"{}":'.format(column) for column in EXPORT_COLUMNS]
+
+
+def encode_rows(rows, precision=COORDINATE_PRECISION):
+    """GeoJSONSeq lines, as bytes, for rows of `cell_query`."""
+    cache = {}
+    lines = []
+    for row in rows:
+        properties = ",".join(
+            key + ("null" if value is None or value == "NaN" else value) for key, value in zip(_KEYS, row[4:])
+        )
+        lines.append(
+            '{"type":"Feature","properties":{'
+            + properties
+            + '},"geometry":'
+            + _geometry(row[0], row[1], row[2], row[3], precision, cache)
+            + "}\n"
+        )
+    return "".join(lines).encode()
+
+
+def hash_ranges(count):
+    """Split coordinate hashes (hex md5s) into `count` ranges of about
+    the same size, as (from, to) bounds; None is open-ended.
+
+    This is `key_ranges` in netcdfs/import/bulk.py. The two are built
+    into different images and this one doesn't ship the importer, so
+    it's a copy rather than an import; change them together."""
+    bounds = [None] + ["{:04x}".format(i * 16 ** 4 // count) for i in range(1, count)] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _range_query(dataset_id, bounds):
+    query = cell_query(dataset_id)
+    low, high = bounds
+    if low is not None:
+        query += " and coordinate_hash >= '{}'".format(low)
+    if high is not None:
+        query += " and coordinate_hash < '{}'".format(high)
+    return query + " order by coordinate_hash"
+
+
+def _stream(connection, query, out, fetch_size, precision):
+    # A named cursor is a server-side one; rows come over in batches
+    # instead of all at once.
+    features = written = 0
+    with connection.cursor(name="pf_geojson_export") as cursor:
+        cursor.itersize = fetch_size
+        cursor.execute(query)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            features += len(rows)
+            written += out.write(encode_rows(rows, precision))
+    connection.commit()
+    return features, written
+
+
+def export_range(dataset_id, bounds, path, fetch_size=FETCH_SIZE, precision=COORDINATE_PRECISION):
+    """Export one range of coordinate hashes of a dataset to `path`,
+    over a connection of its own. Runs in a worker process."""
+    connection = connect()
+    try:
+        with open(path, "wb") as out:
+            return _stream(connection, _range_query(dataset_id, bounds), out, fetch_size, precision)
+    finally:
+        connection.close()
+
+
+def export_geojsonl(
+    connection, dataset_id, out, workers=0, ranges=RANGES, fetch_size=FETCH_SIZE, precision=COORDINATE_PRECISION
+):
+    """Write the cells of a dataset to the binary file `out` as
+    GeoJSONSeq. With `workers` the dataset is split into `ranges`
+    ranges of coordinate hashes, each read and encoded by a worker
+    process into a file of its own, and the files are copied into
+    `out` in range order. Without, it's read in one go on
+    `connection`. Either way the cells come in coordinate hash order.
+    Returns (features, bytes written)."""
+    if workers <= 0:
+        return _stream(connection, _range_query(dataset_id, (None, None)), out, fetch_size, precision)
+
+    features = written = 0
+    with tempfile.TemporaryDirectory() as directory, ProcessPoolExecutor(workers) as executor:
+        parts = []
+        for i, bounds in enumerate(hash_ranges(ranges)):
+            path = os.path.join(directory, "{:04d}.geojsonld".format(i))
+            parts.append((path, executor.submit(export_range, dataset_id, bounds, path, fetch_size, precision)))
+        for path, future in parts:
+            part_features, _ = future.result()
+            features += part_features
+            with open(path, "rb") as part:
+                while True:
+                    chunk = part.read(COPY_BUFFER_SIZE)
+                    if not chunk:
+                        break
+                    written += out.write(chunk)
+            os.remove(path)
+    return features, written
+
+
+def export_file(dataset_id, path, workers=0, ranges=RANGES, fetch_size=FETCH_SIZE):
+    """Export a dataset to `path`; returns (features, bytes written)."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    connection = connect()
+    try:
+        with open(path, "wb") as out:
+            return export_geojsonl(connection, dataset_id, out, workers, ranges, fetch_size)
+    finally:
+        connection.close()
+
+
+def ogr2ogr_export(dataset_id, path):
+    """Export a dataset to `path` with ogr2ogr, as the Makefile does."""
+    if os.path.exists(path):
+        os.remove(path)
+    connection = "PG:host={} port={} user='{}' dbname='{}' password='{}'".format(
+        os.getenv("PG_HOST"),
+        os.getenv("PG_PORT"),
+        os.getenv("PG_USER"),
+        os.getenv("PG_DBNAME"),
+        os.getenv("PG_PASSWORD"),
+    )
+    subprocess.run(
+        ["ogr2ogr", "-wrapdateline", "-f", "GeoJSONSeq", path, connection, "-sql", export_query(dataset_id)],
+        check=True,
+    )
+
+
+def _features(path):
+    """The features of a GeoJSONSeq file, keyed by their geometry with
+    the coordinates rounded, for comparing two exports."""
+
+    def rounded(value):
+        if isinstance(value, list):
+            return tuple(rounded(v) for v in value)
+        return round(value, 6)
+
+    features = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip("\x1e\n ")
+            if not line:
+                continue
+            feature = json.loads(line)
+            geometry = feature["geometry"]
+            features[(geometry["type"], rounded(geometry["coordinates"]))] = feature["properties"]
+    return features
+
+
+def benchmark(dataset_id, directory, workers, ranges, fetch_size):
+    """Export a dataset with ogr2ogr and with `export_file`, time both
+    and check they have the same features."""
+    results = {}
+    paths = {
+        "ogr2ogr": os.path.join(directory, "{}.ogr2ogr.geojsonld".format(dataset_id)),
+        "native": os.path.join(directory, "{}.native.geojsonld".format(dataset_id)),
+    }
+    os.makedirs(directory, exist_ok=True)
+    for name, path in paths.items():
+        started = time.perf_counter()
+        if name == "ogr2ogr":
+            ogr2ogr_export(dataset_id, path)
+        else:
+            export_file(dataset_id, path, workers, ranges, fetch_size)
+        elapsed = time.perf_counter() - started
+        results[name] = elapsed
+        print(f"{name}: {elapsed:.2f}s, {os.path.getsize(path):,} bytes")
+
+    expected = _features(paths["ogr2ogr"])
+    actual = _features(paths["native"])
+    differ = sum(1 for key, properties in expected.items() if actual.get(key) != properties)
+    missing = len(expected.keys() - actual.keys())
+    extra = len(actual.keys() - expected.keys())
+    print(
+        f"{len(actual):,} features; {missing:,} missing, {extra:,} extra, {differ:,} different; "
+        f"{results['ogr2ogr'] / results['native']:.1f}x the speed of ogr2ogr"
+    )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a dataset's cells as GeoJSONSeq without ogr2ogr")
+    parser.add_argument("dataset_id", type=int)
+    parser.add_argument("--output", help="Where to write it, default /tmp/data/mapbox/mts/<dataset_id>.geojsonld")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="Encoding processes, default one per CPU; 0 for none"
+    )
+    parser.add_argument("--ranges", type=int, default=RANGES, help="Ranges of cells to split the work into")
+    parser.add_argument("--fetch-size", type=int, default=FETCH_SIZE, help="Rows fetched and encoded at a time")
+    parser.add_argument(
+        "--benchmark", action="store_true", help="Export with ogr2ogr and natively, compare the time and the output"
+    )
+    parser.add_argument("--benchmark-dir", default="/tmp/data/mapbox/benchmark")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.dataset_id, args.benchmark_dir, args.workers, args.ranges, args.fetch_size)
+        return
+    path = args.output or f"/tmp/data/mapbox/mts/{args.dataset_id}.geojsonld"
+    started = time.perf_counter()
+    features, written = export_file(args.dataset_id, path, args.workers, args.ranges, args.fetch_size)
+    elapsed = time.perf_counter() - started
+    print(f"Wrote {features:,} features ({written:,} bytes) to {path} in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
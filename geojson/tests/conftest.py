@@ -0,0 +1,6 @@
+import os
+import sys
+
+# export.py and upload.py are imported by name, as app.py does when
+# run from geojson.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
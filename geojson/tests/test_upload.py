@@ -0,0 +1,168 @@
+import gzip
+import time
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import export
+import upload
+from export import EXPORT_COLUMNS, export_file
+from upload import MultipartWriter, export_to_s3
+
+BUCKET = "pf-geojson"
+# Parts this small are only allowed with moto's minimum lowered.
+PART_SIZE = 1024
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr("moto.s3.models.S3_UPLOAD_PART_MIN_SIZE", 256)
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def parts(client, monkeypatch):
+    """The (part number, body) of every `upload_part` call."""
+    uploaded = []
+    upload_part = client.upload_part
+
+    def recorded(**kwargs):
+        uploaded.append((kwargs["PartNumber"], kwargs["Body"]))
+        return upload_part(**kwargs)
+
+    monkeypatch.setattr(client, "upload_part", recorded)
+    return uploaded
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = list(rows)
+        self.itersize = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query):
+        pass
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+class FakeConnection:
+    """Hands out the rows of `cell_query` to a named cursor."""
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self, name=None):
+        return FakeCursor(self.rows)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def cells(count):
+    """Rows of `cell_query`: cells along the equator, the last one
+    across the antimeridian, with a NaN and a null among the values."""
+    rows = []
+    for i in range(count):
+        xmin = -180 + i * 0.2 if i < count - 1 else 179.9
+        values = ["{:.1f}".format(i + j / 10) for j in range(len(EXPORT_COLUMNS))]
+        values[0] = "NaN" if i % 7 == 0 else values[0]
+        values[1] = None if i % 11 == 0 else values[1]
+        rows.append((xmin, -0.1, xmin + 0.2, 0.1, *values))
+    return rows
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """Point the exporter at rows instead of Postgres."""
+    rows = []
+    monkeypatch.setattr(export, "connect", lambda: FakeConnection(rows))
+    monkeypatch.setattr(upload, "connect", lambda: FakeConnection(rows))
+    return rows
+
+
+def uploaded(client, key):
+    return client.get_object(Bucket=BUCKET, Key=key)["Body"].read()
+
+
+def test_parts_are_numbered_and_joined_in_order(client, parts, monkeypatch):
+    data = b"".join(bytes([i]) * PART_SIZE for i in range(1, 6)) + b"tail"
+    upload_part = client.upload_part
+
+    def first_part_last(**kwargs):
+        # Part 1 finishes after the others.
+        if kwargs["PartNumber"] == 1:
+            time.sleep(0.2)
+        return upload_part(**kwargs)
+
+    monkeypatch.setattr(client, "upload_part", first_part_last)
+    with MultipartWriter(client, BUCKET, "parts.bin", part_size=PART_SIZE, threads=4, max_pending=3) as out:
+        for i in range(0, len(data), 300):
+            out.write(data[i : i + 300])
+
+    assert uploaded(client, "parts.bin") == data
+    assert sorted(number for number, _ in parts) == [1, 2, 3, 4, 5, 6]
+    for number, body in parts:
+        assert body == data[(number - 1) * PART_SIZE : number * PART_SIZE]
+    assert client.head_object(Bucket=BUCKET, Key="parts.bin")["ETag"].endswith('-6"')
+
+
+def test_the_gzipped_upload_is_the_file_export(client, parts, database, tmp_path):
+    database.extend(cells(500))
+    path = str(tmp_path / "20104.geojsonld")
+    file_features, file_written = export_file(20104, path)
+
+    features, written, sent = export_to_s3(
+        20104, client, BUCKET, "20104.geojsonld.gz", compress=True, part_size=PART_SIZE
+    )
+
+    with open(path, "rb") as f:
+        expected = f.read()
+    body = uploaded(client, "20104.geojsonld.gz")
+    assert gzip.decompress(body) == expected
+    assert (features, written) == (file_features, file_written) == (500, len(expected))
+    assert sent == len(body)
+    assert len(parts) > 1
+
+
+def test_an_empty_export_completes(client, parts, database):
+    features, written, sent = export_to_s3(20104, client, BUCKET, "empty.geojsonld", part_size=PART_SIZE)
+
+    assert (features, written, sent) == (0, 0, 0)
+    assert uploaded(client, "empty.geojsonld") == b""
+    assert [number for number, _ in parts] == [1]
+
+
+def test_a_failed_part_aborts_the_upload(client, parts, database, monkeypatch):
+    database.extend(cells(500))
+    upload_part = client.upload_part
+
+    def failing(**kwargs):
+        if kwargs["PartNumber"] == 3:
+            raise RuntimeError("connection reset")
+        return upload_part(**kwargs)
+
+    monkeypatch.setattr(client, "upload_part", failing)
+
+    with pytest.raises(RuntimeError, match="connection reset"):
+        export_to_s3(20104, client, BUCKET, "failed.geojsonld", part_size=PART_SIZE)
+
+    assert client.list_multipart_uploads(Bucket=BUCKET).get("Uploads", []) == []
+    assert client.list_objects_v2(Bucket=BUCKET).get("KeyCount") == 0
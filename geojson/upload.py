@@ -0,0 +1,149 @@
+import gzip
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from export import connect, export_geojsonl
+
+"""
+Streams an export straight into an S3 multipart upload, so the file
+never has to fit in /tmp and the upload runs while the export does.
+
+`MultipartWriter` is a binary file object: what's written to it is
+cut into parts of `PART_SIZE`, which are uploaded on a small thread
+pool. At most `MAX_PENDING_PARTS` parts are held in memory at a time;
+a write that would go over waits for an upload to finish. Closing it
+completes the upload; if anything fails the upload is aborted, so no
+half-written object (or orphaned parts) are left behind.
+
+Set S3_ENDPOINT_URL to point it at a local S3 stand-in (moto's server,
+MinIO) instead of AWS.
+
+"""
+
+# S3 parts have to be at least 5 MB, apart from the last one.
+PART_SIZE = 16 * 1024 * 1024
+MAX_PENDING_PARTS = 4
+UPLOAD_THREADS = 4
+GZIP_LEVEL = 6
+
+
+class MultipartWriter:
+    """A write-only binary file that's an S3 multipart upload of
+    `bucket`/`key`. Use it as a context manager, or call `close()`
+    (or `abort()`) when done."""
+
+    def __init__(
+        self,
+        client,
+        bucket,
+        key,
+        part_size=PART_SIZE,
+        threads=UPLOAD_THREADS,
+        max_pending=MAX_PENDING_PARTS,
+        **create_args,
+    ):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=key, **create_args)["UploadId"]
+        self.buffer = bytearray()
+        self.futures = []
+        self.written = 0
+        self.closed = False
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._executor = ThreadPoolExecutor(threads)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        self.written += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[: self.part_size])
+            del self.buffer[: self.part_size]
+            self._submit(part)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, number, part):
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=part
+        )
+        return {"PartNumber": number, "ETag": response["ETag"]}
+
+    def _submit(self, part):
+        # Fail as soon as an earlier part has, rather than at the end.
+        for future in self.futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        self._pending.acquire()
+        future = self._executor.submit(self._upload_part, len(self.futures) + 1, part)
+        future.add_done_callback(lambda _: self._pending.release())
+        self.futures.append(future)
+
+    def close(self):
+        """Upload what's left and complete the upload."""
+        if self.closed:
+            return
+        try:
+            # An empty object still needs one (empty) part.
+            if self.buffer or not self.futures:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            parts = [future.result() for future in self.futures]
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": parts}
+            )
+        except BaseException:
+            self.abort()
+            raise
+        self.closed = True
+        self._executor.shutdown()
+
+    def abort(self):
+        """Throw away the upload and any parts already uploaded."""
+        if self.closed:
+            return
+        self.closed = True
+        self._executor.shutdown(cancel_futures=True)
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def export_to_s3(
+    dataset_id,
+    client,
+    bucket,
+    key,
+    compress=False,
+    workers=0,
+    part_size=PART_SIZE,
+    threads=UPLOAD_THREADS,
+    max_pending=MAX_PENDING_PARTS,
+):
+    """Export a dataset as GeoJSONSeq into `bucket`/`key` as it's
+    generated, gzipped with `compress`. Returns (features, bytes of
+    GeoJSON, bytes uploaded)."""
+    connection = connect()
+    try:
+        with MultipartWriter(client, bucket, key, part_size, threads, max_pending) as upload:
+            if compress:
+                with gzip.GzipFile(fileobj=upload, mode="wb", compresslevel=GZIP_LEVEL) as out:
+                    features, written = export_geojsonl(connection, dataset_id, out, workers)
+            else:
+                features, written = export_geojsonl(connection, dataset_id, upload, workers)
+        return features, written, upload.written
+    finally:
+        connection.close()
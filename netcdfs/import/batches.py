@@ -0,0 +1,297 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import xarray
+from oyaml import safe_load
+from rich import print
+
+from helpers import NoDatasetWithThatIDError, batch_slices
+
+"""
+Plans the Lambda batches of a dataset and, if asked, runs them.
+
+`pfimport.py --batch N --batch-size CELLS` loads one batch of a file:
+a run of whole longitudes (see `helpers.batch_slices`) that it reads
+with `isel()`, so an invocation only decodes its own part of the file,
+and it only replaces its own coordinates' stats, so batches can run at
+the same time. Given a dataset and how much memory an invocation has,
+this works out the batch size and the list of batches, and prints them
+or sends one Lambda event per batch, a few at a time.
+
+There are two invokers: `LambdaInvoker` calls the deployed function,
+`StubInvoker` calls `lambda_function.lambda_handler` right here, which
+is how to try a plan locally (it runs `pfimport.py` against the
+database in the PG_HOST, PG_DBNAME, PG_USER and PG_PASSWORD
+environment variables, like the function does).
+
+"""
+
+# What the process needs before it reads anything: the interpreter,
+# numpy/pandas/xarray and the open file.
+BASELINE_MB = 300
+
+# Peak bytes held per cell of a batch while it's converted: the
+# variables in `to_dataframe()` and the copy `dropna()` makes, the
+# index, the hashes and stats of the rows with data and their CSV. It
+# depends on the number of variables and how much of the file is
+# empty; this is about what a three variable RCM file with data in
+# every cell takes. Measure yours with `pfimport.py --profile` (peak
+# RSS over cells) and pass it as --bytes-per-cell.
+BYTES_PER_CELL = 400
+
+# Times a failed batch is tried again before it's reported.
+RETRIES = 1
+
+
+def batch_size_for(memory_mb, bytes_per_cell=BYTES_PER_CELL, baseline_mb=BASELINE_MB):
+    """How many cells a batch can have to fit in `memory_mb`."""
+    budget = (memory_mb - baseline_mb) * 2 ** 20
+    if budget <= 0:
+        raise ValueError("{} MB doesn't leave room for any data".format(memory_mb))
+    return max(1, int(budget // bytes_per_cell))
+
+
+def plan_batches(cdf, file_path, batch_size, netcdf_object_key=None, add_dataset_record=False):
+    """The batches of a dataset's file: one dict per batch with the
+    Lambda event that loads it, its cells and its longitudes.
+    `add_dataset_record` goes on the first batch only, since replacing
+    the record wipes the dataset's stats; `run_batches` runs that one
+    before the rest."""
+    with xarray.open_dataset(file_path) as ds:
+        lon = list(ds.dims)[0]
+        column = 1
+        for dim in list(ds.dims)[1:]:
+            column *= ds.sizes[dim]
+        lons = ds[lon].values
+        plan = []
+        for i, indexer in enumerate(batch_slices(ds, batch_size)):
+            piece = lons[indexer[lon]]
+            event = {
+                "dataset_id": str(cdf["dataset"]),
+                "netcdf_object_key": netcdf_object_key or os.path.basename(file_path),
+                "batch": str(i + 1),
+                "batch_size": str(batch_size),
+            }
+            if add_dataset_record and i == 0:
+                event["add_dataset_record"] = True
+            plan.append(
+                {
+                    "event": event,
+                    "cells": len(piece) * column,
+                    "lon": [float("{:g}".format(piece[0])), float("{:g}".format(piece[-1]))],
+                }
+            )
+    return plan
+
+
+class StubInvoker:
+    """Invokes `lambda_function.lambda_handler` in this process instead
+    of on AWS, and keeps every event with its response in `calls`. Pass
+    a `handler` to stand in for the real one."""
+
+    def __init__(self, handler=None):
+        if handler is None:
+            from lambda_function import lambda_handler
+
+            handler = lambda_handler
+        self.handler = handler
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        response = self.handler(dict(event), None)
+        with self._lock:
+            self.calls.append((event, response))
+        return response
+
+
+class LambdaInvoker:
+    """Invokes the deployed function and waits for it to finish."""
+
+    def __init__(self, function_name, timeout=900):
+        import boto3
+        from botocore.config import Config
+
+        self.function_name = function_name
+        # A batch can take as long as the function's timeout, and a
+        # retry would only run the same batch again.
+        self.client = boto3.client(
+            "lambda", config=Config(read_timeout=timeout, retries={"max_attempts": 0})
+        )
+
+    def __call__(self, event):
+        response = self.client.invoke(
+            FunctionName=self.function_name,
+            InvocationType="RequestResponse",
+            Payload=json.dumps(event),
+        )
+        payload = json.loads(response["Payload"].read() or "null")
+        if "FunctionError" in response:
+            return {"statusCode": 500, "body": payload}
+        return payload
+
+
+def run_batches(plan, invoke, concurrency, retries=RETRIES):
+    """Send every batch of a plan to `invoke`, `concurrency` at a time,
+    trying a failed batch up to `retries` more times (a batch only
+    replaces its own cells, so running it again is safe). A batch that
+    adds the dataset record goes first, on its own, and if it fails
+    nothing else is sent. Returns a list of (batch, last response) for
+    the batches that failed, in plan order."""
+    failures = {}
+
+    def run(entry):
+        event = entry["event"]
+        for attempt in range(retries + 1):
+            if attempt:
+                print("[Notice] Retrying batch {} ({} of {})".format(event["batch"], attempt, retries))
+            print("[Notice] Invoking batch {} of {}".format(event["batch"], event["dataset_id"]))
+            try:
+                response = invoke(event)
+            except Exception as e:
+                response = {"statusCode": 500, "body": repr(e)}
+            if response and response.get("statusCode") == 200:
+                print("[Notice] Batch {} is done".format(event["batch"]))
+                return
+            print("[Error] Batch {} failed: {}".format(event["batch"], response))
+        failures[event["batch"]] = response
+
+    rest = plan
+    if plan and plan[0]["event"].get("add_dataset_record"):
+        run(plan[0])
+        if failures:
+            return list(failures.items())
+        rest = plan[1:]
+    with ThreadPoolExecutor(max(1, concurrency)) as pool:
+        list(pool.map(run, rest))
+    batches = [entry["event"]["batch"] for entry in plan]
+    return [(batch, failures[batch]) for batch in batches if batch in failures]
+
+
+@click.command()
+@click.option("--conf", default="conf.yaml", help='YAML config file, default "conf.yaml"')
+@click.option("--dataset", type=int, required=True, help="Dataset ID to plan, i.e. 20104")
+@click.option(
+    "--file",
+    "file_path",
+    default=None,
+    help="Local copy of the dataset's file, default its filename in the config. Only its dimensions are read.",
+)
+@click.option(
+    "--netcdf-object-key",
+    default=None,
+    help="S3 key of the file for the Lambda events, default the file's name",
+)
+@click.option(
+    "--memory-mb",
+    type=int,
+    default=2048,
+    help="Memory of one invocation in MB, default 2048",
+)
+@click.option(
+    "--bytes-per-cell",
+    type=float,
+    default=BYTES_PER_CELL,
+    help="Peak bytes a batch holds per cell, default {}".format(BYTES_PER_CELL),
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=None,
+    help="Cells per batch; overrides the estimate from --memory-mb",
+)
+@click.option(
+    "--add-dataset-record",
+    is_flag=True,
+    default=False,
+    help="Have the first batch (re)create the dataset record before the others run",
+)
+@click.option(
+    "--invoke",
+    type=click.Choice(["none", "stub", "lambda"]),
+    default="none",
+    help='Run the plan: "stub" calls lambda_handler in this process, "lambda" the deployed function.'
+    + ' Default "none" just prints it.',
+)
+@click.option(
+    "--function-name",
+    default=os.environ.get("PFIMPORT_FUNCTION_NAME"),
+    help="Name of the Lambda function for --invoke lambda, default $PFIMPORT_FUNCTION_NAME",
+)
+@click.option(
+    "--concurrency",
+    type=int,
+    default=4,
+    help="Number of batches run at once, default 4",
+)
+@click.option(
+    "--retries",
+    type=int,
+    default=RETRIES,
+    help="Times to try a failed batch again, default {}".format(RETRIES),
+)
+@click.option("--output", default=None, help="Also write the plan to this JSON file")
+def __main__(
+    conf,
+    dataset,
+    file_path,
+    netcdf_object_key,
+    memory_mb,
+    bytes_per_cell,
+    batch_size,
+    add_dataset_record,
+    invoke,
+    function_name,
+    concurrency,
+    retries,
+    output,
+):
+    conf = safe_load(open(conf))
+    cdf = next((x for x in conf["datasets"] if x["dataset"] == dataset), None)
+    if cdf is None:
+        print("I could not find a dataset with ID {}".format(dataset))
+        raise NoDatasetWithThatIDError(dataset)
+
+    if batch_size is None:
+        batch_size = batch_size_for(memory_mb, bytes_per_cell)
+    plan = plan_batches(
+        cdf,
+        file_path or cdf["filename"],
+        batch_size,
+        netcdf_object_key=netcdf_object_key,
+        add_dataset_record=add_dataset_record,
+    )
+    print(
+        "[Notice] {} in {} batch(es) of at most {:,} cells".format(dataset, len(plan), batch_size)
+    )
+    for entry in plan:
+        print(
+            "[Notice] Batch {}: {:,} cells, lon {} to {}".format(
+                entry["event"]["batch"], entry["cells"], *entry["lon"]
+            )
+        )
+    if output:
+        with open(output, "w") as f:
+            json.dump(plan, f, indent=2)
+
+    if invoke == "none":
+        return
+    if invoke == "lambda":
+        if not function_name:
+            print("[Error] --invoke lambda needs --function-name")
+            exit(1)
+        invoker = LambdaInvoker(function_name)
+    else:
+        invoker = StubInvoker()
+    failures = run_batches(plan, invoker, concurrency, retries)
+    if failures:
+        print("[Error] {} batch(es) failed: {}".format(len(failures), ", ".join(b for b, _ in failures)))
+        exit(1)
+    print("[Notice] All {} batches of {} are loaded".format(len(plan), dataset))
+
+
+if __name__ == "__main__":
+    __main__()
@@ -0,0 +1,545 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import click
+import numpy as np
+import pandas
+import psycopg2
+import xarray
+from oyaml import safe_dump, safe_load
+from rich import print
+from rich.console import Console
+from rich.table import Table
+
+from helpers import hash_index, to_ewkt
+from coordinates import GridHashTable
+from bulk import (
+    COPY_CHUNK_ROWS,
+    STATISTICS_TABLE,
+    copy_frame,
+    copy_statistics,
+    copy_values,
+    render_statistics,
+    staged_update_values,
+    values_chunks,
+)
+from enrich import DatasetArrays, Enricher, GridIndex
+from fixtures import FIXTURE_DATASETS, LAYOUTS, fixture_grid, make_fixture
+from stats import percentile_frame, to_cmip_columns, to_percentile_columns, to_remo_columns
+from store import Store
+
+"""
+Times each stage of an import on synthetic files (see `fixtures.py`):
+opening the file, `to_dataframe()`, hashing coordinates (on the fly
+and from a grid hash table), building the stats columns, rendering
+them for COPY and writing them to Postgres, and looking up
+`--enrich-points` random points at a time in them with `enrich.py`,
+both from memory and from a memory-mapped `store.py`.
+The database is a throwaway one that's created from `util/temp.sql`
+at the start and dropped at the end, so never point this at a
+database you care about; it refuses to use one that already exists.
+
+With the database, it also times how long `pfimport.py` takes to
+start: importing it, reflecting the schema the way it used to against
+the explicit tables in `tables.py`, and a whole run on one of the
+fixtures up to its first row going into the database.
+
+Every run appends one JSON object to `--output` (JSON Lines), with the
+timings of each stage and enough about the machine and the code to
+compare runs over time.
+
+"""
+
+ENRICH_POINTS = [10000, 1000000, 10000000]
+
+
+def measure(fn, repeat):
+    """Call `fn` `repeat` times; return its last result and the wall
+    time of each call in seconds."""
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - started)
+    return result, samples
+
+
+def connect(dbhost, dbname, dbuser, dbpassword):
+    return psycopg2.connect(host=dbhost or None, dbname=dbname, user=dbuser, password=dbpassword)
+
+
+def create_database(dbhost, dbname, dbuser, dbpassword, schema):
+    """Create `dbname` and load `schema` into it with psql. Quits if the
+    database is already there."""
+    connection = connect(dbhost, "postgres", dbuser, dbpassword)
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_database WHERE datname = %s", (dbname,))
+        if cursor.fetchone():
+            print(
+                "[Error] Database {} already exists. The benchmark drops its database when it's done, "
+                "so give it a --dbname that doesn't exist yet.".format(dbname)
+            )
+            exit(1)
+        cursor.execute('CREATE DATABASE "{}"'.format(dbname))
+    connection.close()
+
+    # temp.sql starts by creating probable_futures; we've already made
+    # our own database, so leave that line out.
+    with open(schema) as f:
+        sql = "".join(line for line in f if not line.lower().startswith("create database"))
+    command = ["psql", "-q", "-d", dbname]
+    if dbhost:
+        command += ["-h", dbhost]
+    if dbuser:
+        command += ["-U", dbuser]
+    env = dict(os.environ, PGPASSWORD=dbpassword or "")
+    subprocess.run(command, input=sql, text=True, env=env, check=True, capture_output=True)
+
+
+def drop_database(dbhost, dbname, dbuser, dbpassword):
+    connection = connect(dbhost, "postgres", dbuser, dbpassword)
+    connection.autocommit = True
+    with connection.cursor() as cursor:
+        cursor.execute('DROP DATABASE IF EXISTS "{}"'.format(dbname))
+    connection.close()
+
+
+def load_fixture_coordinates(cursor, grid, df):
+    """Put the coordinates of every cell in `df` into
+    `pf_grid_coordinates`, so the stats' foreign keys hold. The points
+    come from the same index levels `hash_index` hashes."""
+    cells = df.index.droplevel(list(range(2, df.index.nlevels))).unique()
+    points = to_ewkt(grid, cells.get_level_values(0).to_numpy(), cells.get_level_values(1).to_numpy())
+    frame = pandas.DataFrame({"grid": grid, "point": points})
+    # Layouts on the same grid share cells, so we only add the ones
+    # that aren't there yet.
+    cursor.execute(
+        "CREATE TEMPORARY TABLE stage_coordinates AS "
+        "SELECT grid, point FROM pf_public.pf_grid_coordinates WITH NO DATA"
+    )
+    copy_frame(cursor, "stage_coordinates", frame, ["grid", "point"])
+    cursor.execute(
+        "INSERT INTO pf_public.pf_grid_coordinates (grid, point) "
+        "SELECT grid, point FROM stage_coordinates ON CONFLICT DO NOTHING"
+    )
+    cursor.execute("DROP TABLE stage_coordinates")
+    return len(frame)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_enrich(layout, dataset, grid_conf, enrich_points, repeat, record):
+    """Time `Enricher.enrich` on random points over a fixture's part of
+    its grid, for every column of the fixture, with the arrays in
+    memory and mapped from a `store.Store`."""
+    grid_index = GridIndex.from_conf(grid_conf)
+    arrays, samples = measure(lambda: DatasetArrays.from_file(dataset, grid_index, dataset["filename"]), repeat)
+    record(layout, "enrich_load", grid_index.cells * len(arrays.columns), samples)
+    enricher = Enricher({grid_index.grid: grid_index}, {arrays.dataset: arrays})
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = Store(directory)
+        store.write_grid(grid_conf)
+        values, samples = measure(lambda: store.write_dataset(dataset, grid_conf, dataset["filename"]), repeat)
+        record(layout, "store_write", values, samples)
+        mapped, samples = measure(lambda: Store(directory).enricher(), repeat)
+        record(layout, "store_open", 1, samples)
+
+        rng = np.random.default_rng(0)
+        for points in enrich_points:
+            lons = rng.uniform(grid_index.lon.min(), grid_index.lon.max(), points)
+            lats = rng.uniform(grid_index.lat.min(), grid_index.lat.max(), points)
+            _, samples = measure(lambda: enricher.enrich(lons, lats), repeat)
+            record(layout, "enrich", points, samples, columns=len(arrays.columns))
+            _, samples = measure(lambda: mapped.enrich(lons, lats), repeat)
+            record(layout, "store_enrich", points, samples, columns=len(arrays.columns))
+
+
+def benchmark_layout(layout, dataset, grid_conf, repeat, connection, copy_chunk_rows, enrich_points, record):
+    """Time every stage for one fixture file."""
+    grid = dataset["grid"]
+
+    ds, samples = measure(lambda: xarray.open_dataset(dataset["filename"]).load(), repeat)
+    cells = int(np.prod(list(ds.sizes.values())))
+    record(layout, "open", cells, samples)
+
+    if layout == "percentiles":
+        df, samples = measure(lambda: percentile_frame(ds), repeat)
+    else:
+        df, samples = measure(lambda: ds.to_dataframe().dropna(how="all"), repeat)
+    record(layout, "to_dataframe", len(df), samples)
+
+    hashes, samples = measure(lambda: hash_index(df, grid), repeat)
+    record(layout, "hash", len(df), samples)
+
+    table, samples = measure(lambda: GridHashTable.build(grid_conf), repeat)
+    record(layout, "hash_table_build", table.digests.shape[0] * table.digests.shape[1], samples)
+
+    table_hashes, samples = measure(lambda: hash_index(df, grid, table), repeat)
+    record(layout, "hash_table_lookup", len(df), samples)
+    if not np.array_equal(hashes, table_hashes):
+        print("[Error] The hash table disagrees with hashing on the fly for {}".format(layout))
+
+    hashed = df.assign(coordinate_hash=hashes)
+    if layout == "gcm":
+        variables = [var["name"] for var in dataset["variables"]]
+        build = lambda: to_cmip_columns(hashed, dataset["dataset"], dataset["unit"], variables)  # noqa: E731
+    elif layout == "rcm":
+        renames = {var["name"]: var["method"] for var in dataset["variables"]}
+        renamed = hashed.rename(columns=renames)
+        build = lambda: to_remo_columns(renamed, dataset["dataset"], dataset["unit"])  # noqa: E731
+    else:
+        build = lambda: to_percentile_columns(hashed, dataset["dataset"], dataset["unit"])  # noqa: E731
+    stats, samples = measure(build, repeat)
+    record(layout, "stats", len(stats), samples)
+
+    if layout == "percentiles":
+        _, samples = measure(lambda: list(values_chunks(stats)), repeat)
+    else:
+        _, samples = measure(lambda: render_statistics(stats), repeat)
+    record(layout, "render", len(stats), samples)
+
+    # Every percentile of every point would be too much to gather.
+    if layout != "percentiles":
+        benchmark_enrich(layout, dataset, grid_conf, enrich_points, repeat, record)
+
+    if connection is None:
+        return
+
+    cursor = connection.cursor()
+    coordinates, samples = measure(lambda: load_fixture_coordinates(cursor, grid, df), 1)
+    cursor.execute(
+        "INSERT INTO pf_public.pf_datasets (id, slug, name, unit) VALUES (%s, %s, %s, %s) "
+        "ON CONFLICT (id) DO NOTHING",
+        (dataset["dataset"], dataset["slug"], dataset["name"], dataset["unit"]),
+    )
+    connection.commit()
+    record(layout, "db_coordinates", coordinates, samples)
+
+    for chunk_rows in copy_chunk_rows:
+
+        def write():
+            cursor.execute(
+                "DELETE FROM {} WHERE dataset_id = %s".format(STATISTICS_TABLE), (dataset["dataset"],)
+            )
+            connection.commit()
+            started = time.perf_counter()
+            if layout == "percentiles":
+                copy_values(cursor, STATISTICS_TABLE, stats, chunk_rows)
+            else:
+                copy_statistics(cursor, stats, chunk_rows)
+            connection.commit()
+            return time.perf_counter() - started
+
+        # The delete before each write isn't part of the timing.
+        samples = [write() for _ in range(repeat)]
+        record(layout, "db_write", len(stats), samples, copy_chunk_rows=chunk_rows)
+
+    if layout == "percentiles":
+        _, samples = measure(lambda: staged_update_values(connection, stats), repeat)
+        record(layout, "db_staged_update", len(stats), samples)
+
+
+def benchmark_startup(dataset, grid_conf, repeat, dbhost, dbname, dbuser, dbpassword, record):
+    """Time the cold start of `pfimport.py`. `dataset` has to have been
+    through `benchmark_layout` with the database, so its coordinates
+    and dataset record are there."""
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    def run(code):
+        subprocess.run([sys.executable, "-c", code], cwd=here, check=True)
+
+    _, samples = measure(lambda: run("pass"), repeat)
+    record("startup", "interpreter", 1, samples)
+    _, samples = measure(lambda: run("import pfimport"), repeat)
+    record("startup", "import_pfimport", 1, samples)
+    _, samples = measure(lambda: run("import pfimport, xarray, sqlalchemy, scheduler, tables"), repeat)
+    record("startup", "import_pfimport_and_deferred", 1, samples)
+
+    from sqlalchemy import MetaData, create_engine
+    from sqlalchemy.ext.automap import automap_base
+    from sqlalchemy.orm import configure_mappers
+    import geoalchemy2  # noqa: F401
+    import citext  # noqa: F401
+    from tables import check_tables
+
+    engine = create_engine(
+        "postgresql://{}:{}@{}/{}".format(dbuser, dbpassword, dbhost or "", dbname)
+    )
+
+    def reflect():
+        metadata = MetaData(schema="pf_public")
+        metadata.reflect(engine)
+        automap_base(metadata=metadata).prepare()
+
+    _, samples = measure(reflect, repeat)
+    record("startup", "schema_reflect_all", 1, samples)
+    _, samples = measure(configure_mappers, repeat)
+    record("startup", "schema_explicit", 1, samples)
+    missing = check_tables(engine)
+    if missing:
+        print("[Error] tables.py has columns the database doesn't: {}".format(", ".join(missing)))
+    engine.dispose()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        conf_path = os.path.join(tmp, "conf.yaml")
+        with open(conf_path, "w") as f:
+            safe_dump({"grids": [grid_conf], "datasets": [dataset]}, f)
+        command = [
+            sys.executable, "pfimport.py", "--mutate", "--conf", conf_path,
+            "--hash-tables", os.path.join(tmp, "hashes"), "--dbhost", dbhost or "",
+            "--dbname", dbname, "--dbuser", dbuser, "--dbpassword", dbpassword,
+            "--load-one-cdf", str(dataset["dataset"]), "--cpu-workers", "0",
+        ]
+
+        def first_row():
+            # The first row is ready once the first piece is converted
+            # and save_cdf starts writing; that's when it says so.
+            started = time.perf_counter()
+            first = None
+            with subprocess.Popen(
+                command,
+                cwd=here,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+                env=dict(os.environ, PYTHONUNBUFFERED="1"),
+            ) as process:
+                for line in process.stdout:
+                    if first is None and "Inserting in the database" in line:
+                        first = time.perf_counter() - started
+            if process.returncode != 0:
+                raise RuntimeError("pfimport.py failed with status {}".format(process.returncode))
+            return first, time.perf_counter() - started
+
+        runs = [first_row() for _ in range(repeat)]
+    record("startup", "time_to_first_row", 1, [first for first, _ in runs], dataset=dataset["dataset"])
+    record("startup", "pfimport_run", 1, [total for _, total in runs], dataset=dataset["dataset"])
+
+
+@click.command()
+@click.option("--conf", default="conf.yaml", help='YAML config file the grids come from, default "conf.yaml"')
+@click.option(
+    "--layout",
+    "layouts",
+    multiple=True,
+    type=click.Choice(LAYOUTS),
+    help="Which synthetic file layouts to run; give it more than once for several. Default all of them.",
+)
+@click.option(
+    "--scale",
+    type=float,
+    default=0.05,
+    help="Fraction of each grid's longitudes to put in the files, default 0.05. 1 is the full grid.",
+)
+@click.option(
+    "--nan-fraction",
+    type=float,
+    default=0.7,
+    help="Fraction of cells that are NaN (\"ocean\") in the files, default 0.7",
+)
+@click.option(
+    "--percentile-step",
+    type=int,
+    default=1,
+    help="Step between the perc_* variables of the percentiles file, default 1 (perc_0 ... perc_100)",
+)
+@click.option("--repeat", type=int, default=3, help="Times to run each stage, default 3")
+@click.option(
+    "--copy-chunk-rows",
+    type=int,
+    multiple=True,
+    help="Rows per COPY chunk to try for the DB write; give it more than once to compare. Default {}.".format(
+        COPY_CHUNK_ROWS
+    ),
+)
+@click.option(
+    "--enrich-points",
+    type=int,
+    multiple=True,
+    help="Points to look up at a time when timing enrich.py; give it more than once to compare. "
+    + "Default {}.".format(", ".join("{:,}".format(points) for points in ENRICH_POINTS)),
+)
+@click.option(
+    "--fixtures",
+    default=None,
+    help="Directory to write the synthetic files to, default a temporary one that's removed afterwards",
+)
+@click.option("--skip-db", is_flag=True, default=False, help="Only time the stages that don't touch Postgres")
+@click.option(
+    "--skip-startup",
+    is_flag=True,
+    default=False,
+    help="Don't time the cold start of pfimport.py (import time, schema setup, time to first row)",
+)
+@click.option("--dbhost", default="localhost", help='Postgresql host/server name, default "localhost"')
+@click.option(
+    "--dbname",
+    default="pf_benchmark",
+    help='Name of the throwaway database to create and drop, default "pf_benchmark". It must not exist yet.',
+)
+@click.option("--dbuser", nargs=1, help="Postgresql username; needs to be able to create databases")
+@click.option("--dbpassword", nargs=1, help="Postgresql password")
+@click.option(
+    "--schema",
+    default="util/temp.sql",
+    help='SQL file that sets up the database schema, default "util/temp.sql". It needs PostGIS.',
+)
+@click.option("--keep-db", is_flag=True, default=False, help="Don't drop the database at the end")
+@click.option(
+    "--output",
+    default="benchmarks.jsonl",
+    help='File to append this run\'s results to as one line of JSON, default "benchmarks.jsonl"',
+)
+def __main__(
+    conf,
+    layouts,
+    scale,
+    nan_fraction,
+    percentile_step,
+    repeat,
+    copy_chunk_rows,
+    enrich_points,
+    fixtures,
+    skip_db,
+    skip_startup,
+    dbhost,
+    dbname,
+    dbuser,
+    dbpassword,
+    schema,
+    keep_db,
+    output,
+):
+    conf = safe_load(open(conf))
+    layouts = list(layouts) or LAYOUTS
+    copy_chunk_rows = list(copy_chunk_rows) or [COPY_CHUNK_ROWS]
+    enrich_points = list(enrich_points) or ENRICH_POINTS
+    results = []
+
+    def record(layout, stage, rows, samples, **params):
+        median = statistics.median(samples)
+        results.append(
+            {
+                "layout": layout,
+                "stage": stage,
+                "rows": int(rows),
+                "seconds": samples,
+                "best": min(samples),
+                "median": median,
+                "rows_per_second": rows / median if median > 0 else None,
+                **params,
+            }
+        )
+
+    connection = None
+    if not skip_db:
+        print("[Notice] Creating the throwaway database {}".format(dbname))
+        create_database(dbhost, dbname, dbuser, dbpassword, schema)
+        connection = connect(dbhost, dbname, dbuser, dbpassword)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = fixtures or tmp
+        try:
+            for layout in layouts:
+                path = os.path.join(
+                    directory, "{}-{}-{}-{}.nc".format(layout, scale, nan_fraction, percentile_step)
+                )
+                print("[Notice] Writing the {} fixture to {}".format(layout, path))
+                dataset = make_fixture(
+                    path, conf, layout, scale, nan_fraction, percentile_step
+                )
+                benchmark_layout(
+                    layout,
+                    dataset,
+                    fixture_grid(conf, layout, scale),
+                    repeat,
+                    connection,
+                    copy_chunk_rows,
+                    enrich_points,
+                    record,
+                )
+                # pfimport.py doesn't read the percentiles layout.
+                if connection is not None and not skip_startup and layout != "percentiles":
+                    print("[Notice] Timing the start of pfimport.py on the {} fixture".format(layout))
+                    benchmark_startup(
+                        dataset,
+                        fixture_grid(conf, layout, scale),
+                        repeat,
+                        dbhost,
+                        dbname,
+                        dbuser,
+                        dbpassword,
+                        record,
+                    )
+                    skip_startup = True
+        finally:
+            if connection is not None:
+                connection.close()
+                if keep_db:
+                    print("[Notice] Leaving the database {} in place".format(dbname))
+                else:
+                    print("[Notice] Dropping the database {}".format(dbname))
+                    drop_database(dbhost, dbname, dbuser, dbpassword)
+
+    run = {
+        "started": datetime.now(timezone.utc).isoformat(),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "versions": {
+            "numpy": np.__version__,
+            "pandas": pandas.__version__,
+            "xarray": xarray.__version__,
+        },
+        "parameters": {
+            "layouts": layouts,
+            "scale": scale,
+            "nan_fraction": nan_fraction,
+            "percentile_step": percentile_step,
+            "repeat": repeat,
+            "enrich_points": enrich_points,
+            "datasets": {layout: FIXTURE_DATASETS[layout] for layout in layouts},
+        },
+        "results": results,
+    }
+    with open(output, "a") as f:
+        f.write(json.dumps(run) + "\n")
+
+    summary = Table("layout", "stage", "rows", "median s", "rows/s")
+    for result in results:
+        stage = result["stage"]
+        if "copy_chunk_rows" in result:
+            stage += " ({:,} rows/chunk)".format(result["copy_chunk_rows"])
+        if "columns" in result:
+            stage += " ({} columns)".format(result["columns"])
+        summary.add_row(
+            result["layout"],
+            stage,
+            "{:,}".format(result["rows"]),
+            "{:.3f}".format(result["median"]),
+            "{:,.0f}".format(result["rows_per_second"] or 0),
+        )
+    Console().print(summary)
+    print("[Notice] Appended the results to {}".format(output))
+
+
+if __name__ == "__main__":
+    __main__()
@@ -0,0 +1,270 @@
+import re
+import time
+
+import numpy as np
+from rich import print
+
+"""
+Bulk writers that stream rows into Postgres with COPY ... FROM STDIN
+rather than going through the ORM one object at a time. They take a
+DBAPI (psycopg2) cursor so callers decide what transaction the COPY is
+part of; use `session.connection().connection.cursor()` to write inside
+an ORM session.
+
+"""
+
+STATISTICS_TABLE = "pf_public.pf_dataset_statistics"
+
+STAT_COLUMNS = [
+    "dataset_id",
+    "coordinate_hash",
+    "warming_scenario",
+    "low_value",
+    "mid_value",
+    "high_value",
+]
+
+VALUE_COLUMNS = [
+    "dataset_id",
+    "coordinate_hash",
+    "warming_scenario",
+    "values",
+]
+
+# How many rows we turn into CSV at a time, and how many bytes psycopg2
+# asks for on each read. Only one chunk of CSV text is in memory at once.
+COPY_CHUNK_ROWS = 100000
+COPY_BUFFER_SIZE = 1 << 20
+
+
+class IteratorFile:
+    """Just enough of a file for `copy_expert`: `read()` hands out the
+    bytes of an iterator of byte strings as they are produced."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = b""
+        self._pos = 0
+
+    def read(self, size=-1):
+        while self._pos >= len(self._chunk):
+            self._chunk = next(self._chunks, None)
+            self._pos = 0
+            if self._chunk is None:
+                self._chunk = b""
+                return b""
+        if size is None or size < 0:
+            size = len(self._chunk) - self._pos
+        data = self._chunk[self._pos : self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+def csv_chunks(frame, columns, chunk_rows=COPY_CHUNK_ROWS, on_chunk=None):
+    """Yield a DataFrame as CSV for COPY, `chunk_rows` rows at a time.
+    Missing values (None/NaN) come out as empty fields, which COPY reads
+    as NULL."""
+    for start in range(0, len(frame), chunk_rows):
+        part = frame.iloc[start : start + chunk_rows]
+        yield part.to_csv(header=False, index=False, columns=columns).encode()
+        if on_chunk is not None:
+            on_chunk(len(part))
+
+
+def report_throughput(message, rows, started):
+    """Print `message` with the time since `started` and the rows/s."""
+    elapsed = time.perf_counter() - started
+    print(
+        "[Notice] {} in {:.1f}s ({:,.0f} rows/s)".format(
+            message, elapsed, rows / elapsed if elapsed > 0 else 0
+        )
+    )
+
+
+def copy_csv(cursor, table, columns, chunks, rows):
+    """Stream CSV `chunks` (byte strings) of `rows` rows into the
+    `columns` of `table` with COPY FROM STDIN and report throughput.
+    Returns the number of rows copied."""
+    sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(table, ", ".join(columns))
+    started = time.perf_counter()
+    cursor.copy_expert(sql, IteratorFile(chunks), size=COPY_BUFFER_SIZE)
+    report_throughput("Copied {:,} rows into {}".format(rows, table), rows, started)
+    return rows
+
+
+def copy_frame(cursor, table, frame, columns, chunk_rows=COPY_CHUNK_ROWS, on_chunk=None):
+    """Stream the `columns` of `frame` into `table` with COPY FROM STDIN
+    and report throughput. Returns the number of rows copied."""
+    return copy_csv(
+        cursor, table, columns, csv_chunks(frame, columns, chunk_rows, on_chunk), len(frame)
+    )
+
+
+# A CSV line of three key fields followed by the array elements, and
+# the leftovers of NaN elements (empty fields) inside an array literal.
+_VALUES_LINE = re.compile(r"^([^,\n]*),([^,\n]*),([^,\n]*),?(.*)$", re.MULTILINE)
+_EMPTY_ELEMENTS = re.compile(r"(?P<edge>(?<=\{),+|,+(?=\}))|,{2,}")
+
+
+def values_chunks(frame, chunk_rows=COPY_CHUNK_ROWS, on_chunk=None):
+    """Yield a frame of dataset_id, coordinate_hash, warming_scenario
+    and then one column per array element as COPY text lines, with the
+    elements packed into a numeric[] literal, e.g. "{1,2.5}". Missing
+    elements are dropped from the literal. This works on a chunk's CSV
+    text with two regexes, so no per-row lists are ever built."""
+    for start in range(0, len(frame), chunk_rows):
+        part = frame.iloc[start : start + chunk_rows]
+        text = part.to_csv(header=False, index=False)
+        text = _VALUES_LINE.sub(r"\1\t\2\t\3\t{\4}", text)
+        text = _EMPTY_ELEMENTS.sub(lambda m: "" if m.group("edge") else ",", text)
+        yield text.encode()
+        if on_chunk is not None:
+            on_chunk(len(part))
+
+
+def copy_values(cursor, table, frame, chunk_rows=COPY_CHUNK_ROWS, on_chunk=None):
+    """COPY a frame laid out as in `values_chunks` into the `VALUE_COLUMNS`
+    of `table`. Returns the number of rows copied."""
+    sql = "COPY {} ({}) FROM STDIN".format(table, ", ".join(VALUE_COLUMNS))
+    started = time.perf_counter()
+    cursor.copy_expert(
+        sql,
+        IteratorFile(values_chunks(frame, chunk_rows, on_chunk)),
+        size=COPY_BUFFER_SIZE,
+    )
+    report_throughput("Copied {:,} rows into {}".format(len(frame), table), len(frame), started)
+    return len(frame)
+
+
+STAGED_UPDATE = """
+    UPDATE {} ds
+    SET values = st.values
+    FROM stage_stats st
+    WHERE ds.dataset_id = st.dataset_id
+    AND ds.coordinate_hash = st.coordinate_hash
+    AND ds.warming_scenario = st.warming_scenario
+"""
+
+
+def key_ranges(parts):
+    """Split the md5 coordinate hash space into `parts` ranges of about
+    equal size, as (low, high) bounds; None means unbounded.
+    geojson/export.py has a copy, `hash_ranges`."""
+    bounds = [None] + [
+        "{:04x}".format(i * 0x10000 // parts) for i in range(1, parts)
+    ] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def staged_update_values(connection, frame, parts=1):
+    """Set the `values` of existing `pf_dataset_statistics` rows from a
+    frame laid out as in `values_chunks`.
+
+    All of the new rows are COPYed into a temporary table (temporary
+    tables are never WAL-logged), which gets an index on the key and
+    fresh statistics, and then one set-based UPDATE joins it against
+    the statistics table. With `parts` > 1 the UPDATE is split into
+    that many coordinate_hash ranges, each committed on its own.
+    `connection` is a DBAPI connection; the staging table lives on it.
+    Returns (rows matched, rows of the dataset left untouched)."""
+    cursor = connection.cursor()
+    print("[Notice] Creating staging table..")
+    cursor.execute(
+        """
+        CREATE TEMPORARY TABLE stage_stats AS
+        SELECT dataset_id, coordinate_hash, warming_scenario, values
+        FROM {} WITH NO DATA
+        """.format(
+            STATISTICS_TABLE
+        )
+    )
+    copy_values(cursor, "stage_stats", frame)
+    cursor.execute(
+        "CREATE INDEX ON stage_stats (dataset_id, coordinate_hash, warming_scenario)"
+    )
+    cursor.execute("ANALYZE stage_stats")
+    connection.commit()
+
+    matched = 0
+    started = time.perf_counter()
+    for low, high in key_ranges(parts):
+        conditions = ""
+        if low is not None:
+            conditions += " AND st.coordinate_hash >= %(low)s"
+        if high is not None:
+            conditions += " AND st.coordinate_hash < %(high)s"
+        cursor.execute(STAGED_UPDATE.format(STATISTICS_TABLE) + conditions, {"low": low, "high": high})
+        matched += cursor.rowcount
+        connection.commit()
+    report_throughput("Updated {:,} rows of {}".format(matched, STATISTICS_TABLE), matched, started)
+
+    cursor.execute(
+        "SELECT count(*) FROM {} WHERE dataset_id IN "
+        "(SELECT DISTINCT dataset_id FROM stage_stats)".format(STATISTICS_TABLE)
+    )
+    untouched = cursor.fetchone()[0] - matched
+    print(
+        "[Notice] {:,} staged rows, {:,} matched and updated, {:,} had no matching row, "
+        "{:,} existing rows left untouched".format(
+            len(frame), matched, len(frame) - matched, untouched
+        )
+    )
+    cursor.execute("DROP TABLE stage_stats")
+    connection.commit()
+    return matched, untouched
+
+
+def copy_statistics(cursor, frame, chunk_rows=COPY_CHUNK_ROWS, on_chunk=None):
+    """COPY a frame of stats, with the columns in `STAT_COLUMNS`, into
+    `pf_dataset_statistics`."""
+    return copy_frame(cursor, STATISTICS_TABLE, frame, STAT_COLUMNS, chunk_rows, on_chunk)
+
+
+def render_statistics(frame, chunk_rows=COPY_CHUNK_ROWS):
+    """Render a frame of stats to the (rows, CSV chunks) that
+    `copy_rendered_statistics` takes, so the CSV can be written in one
+    process and COPYed from another."""
+    return len(frame), list(csv_chunks(frame, STAT_COLUMNS, chunk_rows))
+
+
+def copy_rendered_statistics(cursor, rendered, table=STATISTICS_TABLE):
+    """COPY stats rendered by `render_statistics` into
+    `pf_dataset_statistics`, or another `table` with its columns."""
+    rows, chunks = rendered
+    return copy_csv(cursor, table, STAT_COLUMNS, chunks, rows)
+
+
+DELETE_HASHES_TABLE = "pf_delete_hashes"
+
+
+def delete_cells(cursor, dataset_id, hashes, chunk_rows=COPY_CHUNK_ROWS):
+    """Delete the dataset's stats for the coordinate `hashes` (a batch's
+    cells, which can be a million or more) in the caller's transaction.
+    The hashes are COPYed into a temporary table and the delete joins on
+    it, rather than sending them all as one array parameter. Returns the
+    number of rows deleted."""
+    cursor.execute(
+        "CREATE TEMPORARY TABLE {} ON COMMIT DROP AS SELECT coordinate_hash FROM {} WITH NO DATA".format(
+            DELETE_HASHES_TABLE, STATISTICS_TABLE
+        )
+    )
+    hashes = np.asarray(hashes, dtype=str)
+    # Hex digests need no CSV quoting.
+    chunks = (
+        ("\n".join(hashes[start : start + chunk_rows]) + "\n").encode()
+        for start in range(0, len(hashes), chunk_rows)
+    )
+    copy_csv(cursor, DELETE_HASHES_TABLE, ["coordinate_hash"], chunks, len(hashes))
+    cursor.execute("ANALYZE {}".format(DELETE_HASHES_TABLE))
+    cursor.execute(
+        "DELETE FROM {} s USING {} h WHERE s.dataset_id = %s AND s.coordinate_hash = h.coordinate_hash".format(
+            STATISTICS_TABLE, DELETE_HASHES_TABLE
+        ),
+        (int(dataset_id),),
+    )
+    deleted = cursor.rowcount
+    cursor.execute("DROP TABLE {}".format(DELETE_HASHES_TABLE))
+    return deleted
@@ -0,0 +1,210 @@
+from collections import namedtuple
+
+from rich import print
+
+from bulk import STAT_COLUMNS, STATISTICS_TABLE, copy_csv
+from helpers import IncompleteImportError
+
+"""
+Bookkeeping for resumable imports (`pfimport.py --resume`).
+
+A resumable import streams a file in `--chunk-size` pieces into a
+staging table of its own, committing each piece together with a row in
+`pf_dataset_import_chunks` that says which chunks it covered. If the
+run dies, the next run with the same file (same fingerprint) and chunk
+size finds the import, skips the chunks that were committed and carries
+on. Once every chunk is in, `finalize_import` swaps the staged rows in
+for the dataset's old ones in one transaction, so readers see either
+the old dataset or the whole new one, never a part.
+
+"""
+
+IMPORTS_TABLE = "pf_private.pf_dataset_imports"
+IMPORT_CHUNKS_TABLE = "pf_private.pf_dataset_import_chunks"
+
+CHECKPOINT_TABLES = """
+create schema if not exists pf_private;
+
+create table if not exists pf_private.pf_dataset_imports (
+  id serial primary key,
+  dataset_id integer not null,
+  fingerprint text not null,
+  chunk_size integer not null,
+  total_chunks integer not null,
+  staging_table text not null,
+  started_at timestamptz not null default now(),
+  finished_at timestamptz
+);
+
+create table if not exists pf_private.pf_dataset_import_chunks (
+  import_id integer not null references pf_private.pf_dataset_imports(id) on delete cascade,
+  chunk_from integer not null,
+  chunk_to integer not null,
+  rows integer not null,
+  committed_at timestamptz not null default now(),
+  primary key (import_id, chunk_from)
+);
+"""
+
+DatasetImport = namedtuple(
+    "DatasetImport", "id dataset_id fingerprint chunk_size total_chunks staging_table committed"
+)
+
+
+def ensure_checkpoint_tables(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(CHECKPOINT_TABLES)
+    connection.commit()
+
+
+def _staging_table(dataset_id, fingerprint):
+    return "pf_private.pf_dataset_statistics_import_{}_{}".format(int(dataset_id), fingerprint[:12])
+
+
+def find_import(connection, dataset_id, fingerprint, chunk_size):
+    """The unfinished import of this file at this chunk size, with the
+    number of chunks already committed, or None. Unfinished imports of
+    the dataset from another file or chunk size can't be resumed, so
+    they're thrown away."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT id, staging_table, fingerprint = %s AND chunk_size = %s "
+            "FROM {} WHERE dataset_id = %s AND finished_at IS NULL".format(IMPORTS_TABLE),
+            (fingerprint, chunk_size, dataset_id),
+        )
+        found = None
+        for import_id, staging_table, same in cursor.fetchall():
+            if same and found is None:
+                found = import_id
+                continue
+            print(
+                "[Notice] Discarding an unfinished import of {} from a different file or chunk size".format(
+                    dataset_id
+                )
+            )
+            cursor.execute("DROP TABLE IF EXISTS {}".format(staging_table))
+            cursor.execute("DELETE FROM {} WHERE id = %s".format(IMPORTS_TABLE), (import_id,))
+        connection.commit()
+        if found is None:
+            return None
+        cursor.execute(
+            "SELECT id, dataset_id, fingerprint, chunk_size, total_chunks, staging_table, "
+            "(SELECT coalesce(max(chunk_to), 0) FROM {} WHERE import_id = i.id) "
+            "FROM {} i WHERE id = %s".format(IMPORT_CHUNKS_TABLE, IMPORTS_TABLE),
+            (found,),
+        )
+        return DatasetImport(*cursor.fetchone())
+
+
+def start_import(connection, dataset_id, fingerprint, chunk_size, total_chunks):
+    """Record a new import and create its empty staging table."""
+    staging_table = _staging_table(dataset_id, fingerprint)
+    with connection.cursor() as cursor:
+        cursor.execute("DROP TABLE IF EXISTS {}".format(staging_table))
+        cursor.execute(
+            "CREATE TABLE {} AS SELECT {} FROM {} WITH NO DATA".format(
+                staging_table, ", ".join(STAT_COLUMNS), STATISTICS_TABLE
+            )
+        )
+        cursor.execute(
+            "INSERT INTO {} (dataset_id, fingerprint, chunk_size, total_chunks, staging_table) "
+            "VALUES (%s, %s, %s, %s, %s) RETURNING id".format(IMPORTS_TABLE),
+            (dataset_id, fingerprint, chunk_size, total_chunks, staging_table),
+        )
+        import_id = cursor.fetchone()[0]
+    connection.commit()
+    return DatasetImport(import_id, dataset_id, fingerprint, chunk_size, total_chunks, staging_table, 0)
+
+
+def lock_dataset(connection, dataset_id):
+    """Take a session advisory lock on the dataset so two resumable
+    imports of it can't run at once. Returns False if it's taken."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_try_advisory_lock(%s)", (int(dataset_id),))
+        return cursor.fetchone()[0]
+
+
+def commit_chunks(connection, dataset_import, chunk_from, chunk_to, rendered):
+    """COPY the stats of chunks [chunk_from, chunk_to) (as made by
+    `render_statistics`, or None if they were empty) into the staging
+    table and record them, in one transaction."""
+    rows = 0
+    with connection.cursor() as cursor:
+        if rendered is not None:
+            rows, chunks = rendered
+            copy_csv(cursor, dataset_import.staging_table, STAT_COLUMNS, chunks, rows)
+        cursor.execute(
+            "INSERT INTO {} (import_id, chunk_from, chunk_to, rows) VALUES (%s, %s, %s, %s)".format(
+                IMPORT_CHUNKS_TABLE
+            ),
+            (dataset_import.id, chunk_from, chunk_to, rows),
+        )
+    connection.commit()
+    return rows
+
+
+def describe_failure(connection, dataset_import):
+    """What's left of a resumable import that failed, and how to go on
+    from it or throw it away, for the error report."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT finished_at IS NOT NULL, "
+            "(SELECT coalesce(max(chunk_to), 0) FROM {} WHERE import_id = i.id) "
+            "FROM {} i WHERE id = %s".format(IMPORT_CHUNKS_TABLE, IMPORTS_TABLE),
+            (dataset_import.id,),
+        )
+        row = cursor.fetchone()
+    connection.rollback()
+    if row is None:
+        return "the import was discarded, so its next run starts from the beginning"
+    finished, committed = row
+    if finished:
+        return "every chunk was committed and its new stats are in pf_dataset_statistics"
+    return (
+        "its stats in pf_dataset_statistics are unchanged, and {:,} of its {:,} chunks are committed in {}. "
+        "Run the same command again to resume from chunk {:,}, or discard them with "
+        "DROP TABLE {}; DELETE FROM {} WHERE id = {};".format(
+            committed,
+            dataset_import.total_chunks,
+            dataset_import.staging_table,
+            committed,
+            dataset_import.staging_table,
+            IMPORTS_TABLE,
+            dataset_import.id,
+        )
+    )
+
+
+def staged_rows(cursor, dataset_import):
+    """How many rows the committed chunks of an import hold."""
+    cursor.execute(
+        "SELECT coalesce(sum(rows), 0) FROM {} WHERE import_id = %s".format(IMPORT_CHUNKS_TABLE),
+        (dataset_import.id,),
+    )
+    return cursor.fetchone()[0]
+
+
+def finalize_import(cursor, dataset_import):
+    """Move the staged rows into `pf_dataset_statistics` and close the
+    import. Runs on the caller's cursor, inside the transaction that
+    has already deleted the dataset's old rows, so the caller commits
+    the swap in one go. Returns the number of rows moved."""
+    cursor.execute(
+        "SELECT coalesce(max(chunk_to), 0) FROM {} WHERE import_id = %s".format(IMPORT_CHUNKS_TABLE),
+        (dataset_import.id,),
+    )
+    committed = cursor.fetchone()[0]
+    if committed < dataset_import.total_chunks:
+        raise IncompleteImportError(dataset_import.dataset_id, committed, dataset_import.total_chunks)
+    columns = ", ".join(STAT_COLUMNS)
+    cursor.execute(
+        "INSERT INTO {} ({}) SELECT {} FROM {}".format(
+            STATISTICS_TABLE, columns, columns, dataset_import.staging_table
+        )
+    )
+    rows = cursor.rowcount
+    cursor.execute(
+        "UPDATE {} SET finished_at = now() WHERE id = %s".format(IMPORTS_TABLE), (dataset_import.id,)
+    )
+    cursor.execute("DROP TABLE {}".format(dataset_import.staging_table))
+    return rows
@@ -0,0 +1,209 @@
+import os
+import time
+
+import numpy as np
+from rich import print
+
+from bulk import COPY_CHUNK_ROWS, copy_csv, report_throughput
+from helpers import EWKT_FORMATS, NoMatchingGridError, factorize, to_hashes
+
+"""
+Every dataset lives on one of two fixed grids, GCM or RCM, and the
+coordinate hash of a cell only depends on its grid and its lon/lat. So
+rather than md5 every cell of every dataset we hash each grid once,
+when the coordinates are loaded, and keep the result on disk as a
+(lon index, lat index) -> md5 digest table. Imports then find the
+index of each lon/lat and gather the hash out of the table.
+
+Loading the coordinates themselves is a COPY of (grid, point) rows
+made with numpy string ops, with the table's secondary indexes dropped
+while it runs and built again afterwards.
+
+"""
+
+_HEX = np.frombuffer(b"0123456789abcdef", dtype="uint8")
+
+
+def digests_to_hex(digests):
+    """Turn an (N, 16) array of raw md5 digests into an object array of
+    the 32 character hex strings `to_hash` returns."""
+    digests = np.asarray(digests, dtype="uint8").reshape(-1, 16)
+    ascii = np.empty((len(digests), 32), dtype="uint8")
+    ascii[:, 0::2] = _HEX[digests >> 4]
+    ascii[:, 1::2] = _HEX[digests & 0x0F]
+    return ascii.view("S32").reshape(-1).astype("U32").astype(object)
+
+
+def hex_to_digests(hashes):
+    """The inverse of `digests_to_hex`."""
+    ascii = np.asarray(hashes, dtype="S32").view("uint8").reshape(-1, 32)
+    nibbles = np.where(ascii >= ord("a"), ascii - ord("a") + 10, ascii - ord("0"))
+    return (nibbles[:, 0::2] << 4 | nibbles[:, 1::2]).astype("uint8")
+
+
+class GridHashTable:
+    """The md5 coordinate hash of every cell in one grid, as an
+    (n_lon, n_lat, 16) array of raw digests plus the lon/lat axes it
+    was built from."""
+
+    def __init__(self, grid, lon, lat, digests):
+        self.grid = grid
+        self.lon = np.asarray(lon, dtype="float64")
+        self.lat = np.asarray(lat, dtype="float64")
+        self.digests = digests
+        fmt = EWKT_FORMATS[grid]
+        # Two coordinates hash the same exactly when they format the
+        # same, so that's what we match file coordinates on.
+        self._lon_index = {fmt.format(v): i for i, v in enumerate(self.lon)}
+        self._lat_index = {fmt.format(v): i for i, v in enumerate(self.lat)}
+
+    @classmethod
+    def build(cls, grid_conf):
+        """Hash every cell of a grid from `conf.yaml`."""
+        grid = grid_conf["grid"]
+        lon = np.asarray(grid_conf["lon"], dtype="float64")
+        lat = np.asarray(grid_conf["lat"], dtype="float64")
+        lons, lats = np.meshgrid(lon, lat, indexing="ij")
+        hashes = to_hashes(grid, lons.reshape(-1) + 0, lats.reshape(-1) + 0)
+        digests = hex_to_digests(hashes).reshape(len(lon), len(lat), 16)
+        return cls(grid, lon, lat, digests)
+
+    @staticmethod
+    def path(directory, grid):
+        return os.path.join(directory, "{}.npz".format(grid))
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        np.savez(
+            self.path(directory, self.grid),
+            grid=np.array(self.grid),
+            lon=self.lon,
+            lat=self.lat,
+            digests=self.digests,
+        )
+
+    @classmethod
+    def load(cls, directory, grid):
+        with np.load(cls.path(directory, grid)) as npz:
+            return cls(str(npz["grid"]), npz["lon"], npz["lat"], npz["digests"])
+
+    def matches(self, grid_conf):
+        """Whether this table was built from the same axes as the
+        `conf.yaml` grid."""
+        return np.array_equal(self.lon, grid_conf["lon"]) and np.array_equal(
+            self.lat, grid_conf["lat"]
+        )
+
+    def _axis_index(self, values, index, axis_name):
+        fmt = EWKT_FORMATS[self.grid]
+        distinct, inverse = factorize(values)
+        positions = np.array(
+            [index.get(fmt.format(v), -1) for v in distinct], dtype="int64"
+        )
+        missing = distinct[positions < 0]
+        if len(missing):
+            print(
+                "[Error] {} {} value(s) in the file are not on the {} hash table, e.g. {}".format(
+                    len(missing), axis_name, self.grid, missing[:5].tolist()
+                )
+            )
+            raise NoMatchingGridError(self.grid)
+        return positions[inverse]
+
+    def lookup(self, lons, lats):
+        """Gather the hash of every lon/lat pair. Raises
+        `NoMatchingGridError` if the file has a coordinate that isn't
+        on this grid."""
+        lon_idx = self._axis_index(np.asarray(lons).reshape(-1), self._lon_index, "lon")
+        lat_idx = self._axis_index(np.asarray(lats).reshape(-1), self._lat_index, "lat")
+        return digests_to_hex(self.digests[lon_idx, lat_idx])
+
+
+def build_hash_tables(directory, conf):
+    """Build and save a hash table for every grid in `conf.yaml`."""
+    for grid_conf in conf["grids"]:
+        print("[Notice] Building the coordinate hash table for {}.".format(grid_conf["grid"]))
+        GridHashTable.build(grid_conf).save(directory)
+
+
+def load_hash_tables(directory, conf):
+    """Load whichever grid hash tables are on disk and still agree with
+    `conf.yaml`, keyed by grid name. Grids without a usable table are
+    left out and get hashed on the fly."""
+    tables = {}
+    for grid_conf in conf["grids"]:
+        grid = grid_conf["grid"]
+        if not os.path.exists(GridHashTable.path(directory, grid)):
+            print("[Notice] No coordinate hash table for {}; hashing on the fly.".format(grid))
+            continue
+        table = GridHashTable.load(directory, grid)
+        if not table.matches(grid_conf):
+            print(
+                "[Notice] The {} hash table is out of date with the config; "
+                "rebuild it with --load-coordinates. Hashing on the fly.".format(grid)
+            )
+            continue
+        tables[grid] = table
+    return tables
+
+
+COORDINATES_TABLE = "pf_public.pf_grid_coordinates"
+
+
+def grid_points(grid_conf):
+    """The WKT point of every cell of a grid from `conf.yaml`, lon
+    major, as a numpy string array. The database hashes the point it
+    parses out of this text, so it's written exactly the way the ORM
+    loader always wrote it, "POINT({} {})".format(lon, lat): each lon
+    and lat is formatted once and the pairs are put together by numpy."""
+    lons = np.array(["POINT({} ".format(v) for v in grid_conf["lon"]])
+    lats = np.array(["{})".format(v) for v in grid_conf["lat"]])
+    return np.char.add(np.repeat(lons, len(lats)), np.tile(lats, len(lons)))
+
+
+def coordinate_chunks(grid, points, chunk_rows=COPY_CHUNK_ROWS, on_chunk=None):
+    """Yield `grid,point` CSV lines for COPY, `chunk_rows` at a time.
+    Neither field can have a comma or a quote in it, so no quoting."""
+    lines = np.char.add("{},".format(grid), points)
+    for start in range(0, len(lines), chunk_rows):
+        part = lines[start : start + chunk_rows]
+        yield ("\n".join(part) + "\n").encode()
+        if on_chunk is not None:
+            on_chunk(len(part))
+
+
+def drop_coordinate_indexes(cursor):
+    """Drop the indexes of the coordinates table that no constraint
+    needs (the point, hash and grid indexes) and return their
+    definitions for `create_coordinate_indexes`. The primary key and
+    the unique md5_hash the stats reference stay."""
+    cursor.execute(
+        "SELECT i.relname, pg_get_indexdef(x.indexrelid) FROM pg_index x "
+        "JOIN pg_class i ON i.oid = x.indexrelid "
+        "WHERE x.indrelid = %s::regclass "
+        "AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)",
+        (COORDINATES_TABLE,),
+    )
+    indexes = cursor.fetchall()
+    for name, _ in indexes:
+        cursor.execute("DROP INDEX pf_public.{}".format(name))
+    return [definition for _, definition in indexes]
+
+
+def create_coordinate_indexes(cursor, definitions, rows):
+    started = time.perf_counter()
+    for definition in definitions:
+        cursor.execute(definition)
+    report_throughput("Rebuilt {} index(es) on {}".format(len(definitions), COORDINATES_TABLE), rows, started)
+
+
+def load_grid_coordinates(cursor, grid_conf, on_chunk=None):
+    """Replace the coordinates of one grid with every lon/lat pair of
+    its `conf.yaml` entry. Runs on the caller's cursor, so the caller
+    decides when it commits. Returns the number of rows."""
+    grid = grid_conf["grid"]
+    points = grid_points(grid_conf)
+    cursor.execute("DELETE FROM {} WHERE grid = %s".format(COORDINATES_TABLE), (grid,))
+    return copy_csv(
+        cursor, COORDINATES_TABLE, ["grid", "point"], coordinate_chunks(grid, points, on_chunk=on_chunk), len(points)
+    )
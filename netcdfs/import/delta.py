@@ -0,0 +1,248 @@
+import time
+
+from rich import print
+
+from bulk import STATISTICS_TABLE, report_throughput
+
+"""
+Delta imports (`pfimport.py --delta`, `pfupdate.py --delta`): load a
+new version of a file by writing only the cells that changed.
+
+The new stats are COPYed into a temporary table (never WAL-logged, no
+indexes to keep up), where each cell, i.e. each coordinate_hash, gets a
+checksum of all of its rows. `pf_dataset_cell_checksums` keeps the
+checksums of what's stored, so only the cells whose checksum differs
+are looked at in `pf_dataset_statistics`: their rows that changed are
+UPDATEd in place, new rows are inserted, and rows of cells (or warming
+scenarios) that are gone are deleted. Unchanged cells aren't touched.
+
+The checksum is an md5 of the cell's rows as Postgres prints them, so
+values that round to the same numeric(6,1) count as unchanged. The
+first delta import of a dataset works out the stored checksums from
+the stats themselves. Checksums are kept per `kind`: "stats" for the
+low/mid/high values `pfimport.py` loads, "values" for the percentile
+arrays of `pfupdate.py`. Any other load of a dataset has to call
+`forget_checksums`, since they'd no longer say what's stored.
+
+"""
+
+CELL_CHECKSUMS_TABLE = "pf_private.pf_dataset_cell_checksums"
+
+CELL_CHECKSUM_TABLES = """
+create schema if not exists pf_private;
+
+create table if not exists pf_private.pf_dataset_cell_checksums (
+  dataset_id integer not null references pf_public.pf_datasets(id)
+    on update cascade
+    on delete cascade,
+  kind text not null,
+  coordinate_hash text not null,
+  checksum uuid not null,
+  primary key (dataset_id, kind, coordinate_hash)
+);
+"""
+
+DELTA_TABLE = "delta_stats"
+
+
+def ensure_checksum_tables(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(CELL_CHECKSUM_TABLES)
+    connection.commit()
+
+
+def forget_checksums(cursor, dataset_id, kind=None):
+    """Throw away the stored checksums of a dataset (of one `kind`, or
+    all of them), in the caller's transaction. For loads that write a
+    dataset some other way than `apply_delta`."""
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (CELL_CHECKSUMS_TABLE,))
+    if not cursor.fetchone()[0]:
+        return
+    if kind is None:
+        cursor.execute("DELETE FROM {} WHERE dataset_id = %s".format(CELL_CHECKSUMS_TABLE), (int(dataset_id),))
+    else:
+        cursor.execute(
+            "DELETE FROM {} WHERE dataset_id = %s AND kind = %s".format(CELL_CHECKSUMS_TABLE),
+            (int(dataset_id), kind),
+        )
+
+
+def create_delta_table(cursor, columns):
+    """Create the temporary table a delta import COPYs all of the new
+    stats into, with the types of `columns` in the stats table. It goes
+    away at the end of the transaction."""
+    cursor.execute(
+        "CREATE TEMPORARY TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA".format(
+            DELTA_TABLE, ", ".join(columns), STATISTICS_TABLE
+        )
+    )
+    return DELTA_TABLE
+
+
+def _checksum(alias, value_columns):
+    # Every row of a cell as text, in warming scenario order. format()
+    # prints NULL as nothing, so each value keeps its place.
+    fields = ", ".join(["{}.warming_scenario".format(alias)] + ["{}.{}".format(alias, c) for c in value_columns])
+    return "md5(string_agg(format('{}', {}), ';' ORDER BY {}.warming_scenario))::uuid".format(
+        ",".join(["%%s"] * (len(value_columns) + 1)), fields, alias
+    )
+
+
+def apply_delta(cursor, dataset_id, kind, value_columns, insert=True):
+    """Write the difference between the delta table and what's stored
+    for the dataset, in the caller's transaction. `value_columns` are
+    the columns the checksum covers and that get updated. With `insert`
+    off (for loads that only ever update rows) rows are only updated,
+    never inserted or deleted, and only the checksums of the cells that
+    were updated are stored, worked out from what's stored. Returns a
+    dict of cell and row counts."""
+    started = time.perf_counter()
+    dataset_id = int(dataset_id)
+    key = (dataset_id, kind)
+    cursor.execute("ANALYZE {}".format(DELTA_TABLE))
+
+    cursor.execute(
+        "SELECT EXISTS (SELECT 1 FROM {} WHERE dataset_id = %s AND kind = %s)".format(CELL_CHECKSUMS_TABLE), key
+    )
+    if not cursor.fetchone()[0]:
+        print("[Notice] No cell checksums for {} yet; working them out from the stored stats".format(dataset_id))
+        cursor.execute(
+            "INSERT INTO {} (dataset_id, kind, coordinate_hash, checksum) "
+            "SELECT %s, %s, s.coordinate_hash, {} FROM {} s "
+            "WHERE s.dataset_id = %s AND s.coordinate_hash IS NOT NULL "
+            "GROUP BY s.coordinate_hash".format(
+                CELL_CHECKSUMS_TABLE, _checksum("s", value_columns), STATISTICS_TABLE
+            ),
+            key + (dataset_id,),
+        )
+
+    # The cells whose checksum is new or different, and the ones that
+    # aren't in the new file at all.
+    cursor.execute(
+        "CREATE TEMPORARY TABLE delta_cells ON COMMIT DROP AS "
+        "SELECT n.coordinate_hash, n.checksum, o.checksum IS NULL AS added "
+        "FROM (SELECT d.coordinate_hash, {} AS checksum FROM {} d GROUP BY d.coordinate_hash) n "
+        "LEFT JOIN {} o ON o.dataset_id = %s AND o.kind = %s AND o.coordinate_hash = n.coordinate_hash "
+        "WHERE o.checksum IS DISTINCT FROM n.checksum".format(
+            _checksum("d", value_columns), DELTA_TABLE, CELL_CHECKSUMS_TABLE
+        ),
+        key,
+    )
+    cursor.execute(
+        "CREATE TEMPORARY TABLE removed_cells ON COMMIT DROP AS "
+        "SELECT o.coordinate_hash FROM {} o WHERE o.dataset_id = %s AND o.kind = %s "
+        "AND NOT EXISTS (SELECT 1 FROM {} d WHERE d.coordinate_hash = o.coordinate_hash)".format(
+            CELL_CHECKSUMS_TABLE, DELTA_TABLE
+        ),
+        key,
+    )
+    cursor.execute("ANALYZE delta_cells")
+    cursor.execute("ANALYZE removed_cells")
+    cursor.execute(
+        "SELECT (SELECT count(*) FROM (SELECT DISTINCT coordinate_hash FROM {}) n), "
+        "count(*) FILTER (WHERE added), count(*) FILTER (WHERE NOT added), "
+        "(SELECT count(*) FROM removed_cells) FROM delta_cells".format(DELTA_TABLE)
+    )
+    cells, added, changed, removed = cursor.fetchone()
+    counts = {
+        "cells_added": added,
+        "cells_changed": changed,
+        "cells_removed": removed,
+        "cells_unchanged": cells - added - changed,
+    }
+
+    changed_rows = (
+        "FROM {} d JOIN delta_cells c ON c.coordinate_hash = d.coordinate_hash".format(DELTA_TABLE)
+    )
+    same_row = (
+        "s.dataset_id = %s AND s.coordinate_hash = d.coordinate_hash "
+        "AND s.warming_scenario = d.warming_scenario"
+    )
+    new_values = ", ".join("d.{}".format(c) for c in value_columns)
+    cursor.execute(
+        "UPDATE {} s SET ({}) = ROW({}) {} WHERE {} AND ROW({}) IS DISTINCT FROM ROW({})".format(
+            STATISTICS_TABLE,
+            ", ".join(value_columns),
+            new_values,
+            changed_rows,
+            same_row,
+            ", ".join("s.{}".format(c) for c in value_columns),
+            new_values,
+        ),
+        (dataset_id,),
+    )
+    counts["rows_updated"] = cursor.rowcount
+    counts["rows_inserted"] = counts["rows_deleted"] = 0
+    if insert:
+        cursor.execute(
+            "INSERT INTO {} (dataset_id, coordinate_hash, warming_scenario, {}) "
+            "SELECT d.dataset_id, d.coordinate_hash, d.warming_scenario, {} {} "
+            "WHERE NOT EXISTS (SELECT 1 FROM {} s WHERE {})".format(
+                STATISTICS_TABLE, ", ".join(value_columns), new_values, changed_rows, STATISTICS_TABLE, same_row
+            ),
+            (dataset_id,),
+        )
+        counts["rows_inserted"] = cursor.rowcount
+        # Rows of cells that are gone, and of warming scenarios a
+        # changed cell no longer has.
+        cursor.execute(
+            "DELETE FROM {} s WHERE s.dataset_id = %s AND ("
+            "s.coordinate_hash IN (SELECT coordinate_hash FROM removed_cells) "
+            "OR (s.coordinate_hash IN (SELECT coordinate_hash FROM delta_cells) "
+            "AND NOT EXISTS (SELECT 1 FROM {} d WHERE d.coordinate_hash = s.coordinate_hash "
+            "AND d.warming_scenario = s.warming_scenario)))".format(STATISTICS_TABLE, DELTA_TABLE),
+            (dataset_id,),
+        )
+        counts["rows_deleted"] = cursor.rowcount
+
+    if insert:
+        cursor.execute(
+            "DELETE FROM {} o USING removed_cells r WHERE o.dataset_id = %s AND o.kind = %s "
+            "AND o.coordinate_hash = r.coordinate_hash".format(CELL_CHECKSUMS_TABLE),
+            key,
+        )
+        cursor.execute(
+            "INSERT INTO {} (dataset_id, kind, coordinate_hash, checksum) "
+            "SELECT %s, %s, coordinate_hash, checksum FROM delta_cells "
+            "ON CONFLICT (dataset_id, kind, coordinate_hash) DO UPDATE SET checksum = excluded.checksum".format(
+                CELL_CHECKSUMS_TABLE
+            ),
+            key,
+        )
+    else:
+        # Only updates were written, so a changed cell may still be
+        # missing rows or have ones the file doesn't, and added and
+        # removed cells weren't touched at all. Checksum what's stored
+        # for the changed cells and leave the rest as they were.
+        cursor.execute(
+            "INSERT INTO {} (dataset_id, kind, coordinate_hash, checksum) "
+            "SELECT %s, %s, s.coordinate_hash, {} FROM {} s "
+            "JOIN delta_cells c ON c.coordinate_hash = s.coordinate_hash AND NOT c.added "
+            "WHERE s.dataset_id = %s GROUP BY s.coordinate_hash "
+            "ON CONFLICT (dataset_id, kind, coordinate_hash) DO UPDATE SET checksum = excluded.checksum".format(
+                CELL_CHECKSUMS_TABLE, _checksum("s", value_columns), STATISTICS_TABLE
+            ),
+            key + (dataset_id,),
+        )
+
+    print(
+        "[Notice] {}: {:,} cells added, {:,} changed, {:,} removed, {:,} unchanged; "
+        "{:,} rows inserted, {:,} updated, {:,} deleted".format(
+            dataset_id,
+            counts["cells_added"],
+            counts["cells_changed"],
+            counts["cells_removed"],
+            counts["cells_unchanged"],
+            counts["rows_inserted"],
+            counts["rows_updated"],
+            counts["rows_deleted"],
+        )
+    )
+    if not insert and (added or removed):
+        print(
+            "[Notice] {}: left {:,} added and {:,} removed cells alone, since this load only updates; "
+            "load the dataset in full to write them".format(dataset_id, added, removed)
+        )
+    written = counts["rows_inserted"] + counts["rows_updated"] + counts["rows_deleted"]
+    report_throughput("Applied the delta of {}".format(dataset_id), written, started)
+    return counts
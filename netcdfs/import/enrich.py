@@ -0,0 +1,236 @@
+import numpy as np
+import xarray
+from rich import print
+
+from helpers import EWKT_FORMATS, NoMatchingGridError, factorize
+from stats import CMIP_SCENARIOS, SCENARIO_NAMES, percentile_names
+from units import lookup_unit
+
+"""
+Bulk point lookups without the database: give `Enricher.enrich` the
+lon/lat of N points and it returns the values of any datasets at each
+of them, as columns.
+
+Both grids are regular, so a point is snapped to its cell with a
+little arithmetic on the grid's axes from `conf.yaml` (cells are one
+step wide, centred on the axis values; longitude wraps around on a
+grid that goes all the way round). Each dataset is held as one dense
+float32 array per column (`data_1c_mid` and so on, like the map
+properties) over every cell of its grid, converted the way
+`pfimport.py` converts it, so a lookup is one gather per column. Cells
+with no data, and points that aren't in any cell, come back NaN.
+
+    enricher = Enricher.from_conf(conf, [40104, 20101])
+    columns = enricher.enrich(lons, lats, scenarios=["1.5", "2.0"], methods=["mid"])
+    columns["40104_data_1_5c_mid"]
+
+"""
+
+METHODS = ["low", "mid", "high"]
+
+
+def column_name(scenario, method):
+    """The name of a column of values, e.g. ("1.5", "mid") -> "data_1_5c_mid"
+    and ("1.5", "perc_10") -> "data_1_5c_perc_10"."""
+    return "data_{}_{}".format(SCENARIO_NAMES[scenario], method)
+
+
+def _as_float32(values):
+    # The unit conversions give nullable integers for whole units.
+    if hasattr(values, "to_numpy"):
+        values = values.to_numpy(dtype="float32", na_value=np.nan)
+    return np.asarray(values, dtype="float32")
+
+
+def axis_positions(grid, axis, values, axis_name):
+    """The position on a grid axis of each of a file's coordinates,
+    matched the way coordinates are hashed: two values are the same
+    coordinate when they format the same. Raises `NoMatchingGridError`
+    for a coordinate that isn't on the axis."""
+    fmt = EWKT_FORMATS[grid]
+    index = {fmt.format(v): i for i, v in enumerate(axis)}
+    distinct, inverse = factorize(np.asarray(values) + 0)
+    positions = np.array([index.get(fmt.format(v), -1) for v in distinct], dtype="int64")
+    if (positions < 0).any():
+        print(
+            "[Error] {} {} value(s) are not on the {} grid, e.g. {}".format(
+                int((positions < 0).sum()), axis_name, grid, distinct[positions < 0][:5].tolist()
+            )
+        )
+        raise NoMatchingGridError(grid)
+    return positions[inverse]
+
+
+class GridIndex:
+    """Snaps points to the cells of one grid from `conf.yaml`."""
+
+    def __init__(self, grid, lon, lat):
+        self.grid = grid
+        self.lon = np.asarray(lon, dtype="float64")
+        self.lat = np.asarray(lat, dtype="float64")
+        self.cells = len(self.lon) * len(self.lat)
+
+    @classmethod
+    def from_conf(cls, grid_conf):
+        return cls(grid_conf["grid"], grid_conf["lon"], grid_conf["lat"])
+
+    @staticmethod
+    def _snap(axis, values, wraps=False):
+        # Position of the nearest axis value, or -1 if the value isn't
+        # within half a step of one.
+        step = (axis[-1] - axis[0]) / (len(axis) - 1) if len(axis) > 1 else 1.0
+        regular = np.allclose(np.diff(axis), step, rtol=0, atol=1e-6 * abs(step))
+        if regular:
+            positions = np.rint((values - axis[0]) / step).astype("int64")
+        else:
+            right = np.clip(np.searchsorted(axis, values), 1, len(axis) - 1)
+            positions = right - (values - axis[right - 1] < axis[right] - values)
+        if wraps and regular and abs(len(axis) * step - 360) < 1e-6:
+            return positions % len(axis)
+        inside = (positions >= 0) & (positions < len(axis))
+        clipped = np.clip(positions, 0, len(axis) - 1)
+        inside &= np.abs(values - axis[clipped]) <= step / 2 + 1e-9
+        return np.where(inside, clipped, -1)
+
+    def snap(self, lons, lats):
+        """The flat cell number (lon major) of each point; `self.cells`
+        for a point that isn't in any cell."""
+        lons = (np.asarray(lons, dtype="float64") + 180) % 360 - 180
+        lon_positions = self._snap(self.lon, lons, wraps=True)
+        lat_positions = self._snap(self.lat, np.asarray(lats, dtype="float64"))
+        outside = (lon_positions < 0) | (lat_positions < 0)
+        return np.where(outside, self.cells, lon_positions * len(self.lat) + lat_positions)
+
+
+class DatasetArrays:
+    """The values of one dataset over every cell of its grid: a
+    (columns, cells + 1) float32 array, one row per (warming scenario,
+    method) in `keys`, with a NaN on the end that points outside the
+    grid gather. The method is "low", "mid" or "high", or the name of a
+    percentile variable (e.g. "perc_10") for percentile files."""
+
+    def __init__(self, dataset, grid, keys, values):
+        self.dataset = int(dataset)
+        self.grid = grid
+        self.keys = [tuple(key) for key in keys]
+        self.columns = [column_name(scenario, method) for scenario, method in self.keys]
+        self.values = values
+
+    @staticmethod
+    def _file_columns(cdf, ds, axes):
+        # (scenario, method) -> the lazy (lon, lat) array of the file
+        # it comes from; `axes` are the file's lon and lat dimensions.
+        columns = {}
+        percentiles = percentile_names(ds.data_vars)
+        if cdf["model"] == "GCM, CMIP5" and not percentiles:
+            # One variable per warming scenario, in order.
+            for scenario, var in zip(CMIP_SCENARIOS, cdf["variables"]):
+                columns[(scenario, "mid")] = ds[var["name"]].transpose(*axes)
+            return columns, ["mid"]
+        if percentiles:
+            variables = [(name, name) for name in percentiles]
+            methods = percentiles
+        elif cdf["model"] == "global RegCM and REMO" or cdf["model"] == "global REMO":
+            variables = [(var["name"], var["method"].split("_")[0]) for var in cdf["variables"]]
+            methods = METHODS
+        else:
+            raise ValueError("Don't know how to read a {} dataset".format(cdf["model"]))
+        for name, method in variables:
+            if name not in ds:
+                continue
+            array = ds[name]
+            (level_dim,) = [dim for dim in array.dims if dim not in axes]
+            for i, level in enumerate(array[level_dim].to_numpy()):
+                if str(level) in SCENARIO_NAMES:
+                    columns[(str(level), method)] = array.isel({level_dim: i}).transpose(*axes)
+        return columns, methods
+
+    @classmethod
+    def from_file(cls, cdf, grid_index, file_path, allocate=None):
+        """Read and convert a `conf.yaml` dataset's file onto its grid,
+        a column at a time. `allocate(shape)` makes the array the values
+        go in (default a new one in memory); it has to come back all
+        NaN."""
+        conversion = lookup_unit(cdf["unit"])
+        with xarray.open_dataset(file_path) as ds:
+            # Lon and lat are the first two dimensions, whatever they're
+            # called, as in `hash_index` and `iter_slices`.
+            axes = tuple(ds.dims)[:2]
+            lon_positions = axis_positions(grid_index.grid, grid_index.lon, ds[axes[0]].to_numpy(), "lon")
+            lat_positions = axis_positions(grid_index.grid, grid_index.lat, ds[axes[1]].to_numpy(), "lat")
+            cells = (lon_positions[:, None] * len(grid_index.lat) + lat_positions[None, :]).reshape(-1)
+
+            columns, methods = cls._file_columns(cdf, ds, axes)
+            keys = [
+                (scenario, method)
+                for scenario in CMIP_SCENARIOS
+                for method in methods
+                if (scenario, method) in columns
+            ]
+            shape = (len(keys), grid_index.cells + 1)
+            if allocate is None:
+                values = np.full(shape, np.nan, dtype="float32")
+            else:
+                values = allocate(shape)
+            for i, key in enumerate(keys):
+                values[i, cells] = _as_float32(conversion.convert(columns[key].to_numpy().reshape(-1)))
+        return cls(cdf["dataset"], grid_index.grid, keys, values)
+
+    def select(self, scenarios=None, methods=None):
+        """The columns of the warming `scenarios` and `methods` (default
+        all of them)."""
+        return [
+            column
+            for (scenario, method), column in zip(self.keys, self.columns)
+            if (scenarios is None or scenario in scenarios) and (methods is None or method in methods)
+        ]
+
+    def gather(self, cells, columns=None):
+        """The values of `columns` (default all) at the flat cell
+        numbers `cells`, as a dict of arrays."""
+        return {
+            column: self.values[self.columns.index(column)].take(cells)
+            for column in (self.columns if columns is None else columns)
+            if column in self.columns
+        }
+
+
+class Enricher:
+    """Holds the grids and the arrays of some datasets, and looks up
+    points in them."""
+
+    def __init__(self, grids, datasets):
+        self.grids = grids
+        self.datasets = datasets
+
+    @classmethod
+    def from_conf(cls, conf, dataset_ids=None):
+        """Read the datasets of `conf.yaml` (only `dataset_ids`, if
+        given) into memory."""
+        grids = {grid_conf["grid"]: GridIndex.from_conf(grid_conf) for grid_conf in conf["grids"]}
+        datasets = {}
+        for cdf in conf["datasets"]:
+            if dataset_ids is not None and int(cdf["dataset"]) not in dataset_ids:
+                continue
+            datasets[int(cdf["dataset"])] = DatasetArrays.from_file(cdf, grids[cdf["grid"]], cdf["filename"])
+        return cls(grids, datasets)
+
+    def add(self, arrays):
+        self.datasets[arrays.dataset] = arrays
+
+    def enrich(self, lons, lats, dataset_ids=None, scenarios=None, methods=None):
+        """The values at each of the points `lons`/`lats` of the datasets
+        `dataset_ids` (default all of them), for the warming `scenarios`
+        (e.g. "1.5") and `methods` ("low", "mid", "high" or a percentile
+        like "perc_10"), default all of them, as a dict of arrays named
+        like "40104_data_1_5c_mid". Each grid the datasets are on is
+        snapped to once. `pandas.DataFrame(result)` makes a frame of it."""
+        snapped = {}
+        result = {}
+        for dataset_id in dataset_ids or sorted(self.datasets):
+            arrays = self.datasets[int(dataset_id)]
+            if arrays.grid not in snapped:
+                snapped[arrays.grid] = self.grids[arrays.grid].snap(lons, lats)
+            for column, values in arrays.gather(snapped[arrays.grid], arrays.select(scenarios, methods)).items():
+                result["{}_{}".format(arrays.dataset, column)] = values
+        return result
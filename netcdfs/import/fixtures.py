@@ -0,0 +1,113 @@
+import os
+
+import numpy as np
+import xarray
+
+from stats import CMIP_SCENARIOS
+
+"""
+Synthetic netCDF files laid out like the Woodwell ones, for
+benchmarks and for trying the importers without the real data. The
+lon/lat axes come from the grids in `conf.yaml` (cut down by `scale`),
+the values are random but in a plausible range, and about
+`nan_fraction` of the cells are NaN in every variable, like the ocean
+is in the real files. Dimensions are in the order the importers read
+the index of `to_dataframe()`: lon, then lat, then warming level.
+
+There are three layouts:
+
+- "gcm": a CMIP5 file, one variable per warming scenario on (lon, lat)
+- "rcm": a REMO file, low/mid/high variables on (lon, lat, time) where
+  `time` holds the warming levels
+- "percentiles": like "rcm" but with perc_0 ... perc_100 variables, as
+  `pfimport-new.py` and `pfupdate.py` expect
+
+"""
+
+LAYOUTS = ["gcm", "rcm", "percentiles"]
+
+WARMING_LEVELS = [float(level) for level in CMIP_SCENARIOS]
+
+# The dataset ids fixtures are loaded as. They're outside the ranges
+# conf.yaml uses so they can't be mistaken for real data.
+FIXTURE_DATASETS = {"gcm": 90101, "rcm": 90201, "percentiles": 90301}
+
+
+def fixture_grid(conf, layout, scale=1.0):
+    """The `conf.yaml` grid a layout lives on, with only the first
+    `scale` of its longitudes."""
+    grid = "GCM" if layout == "gcm" else "RCM"
+    grid_conf = next(g for g in conf["grids"] if g["grid"] == grid)
+    n_lon = max(1, int(round(len(grid_conf["lon"]) * scale)))
+    return dict(grid_conf, lon=grid_conf["lon"][:n_lon])
+
+
+def _values(rng, shape, land, unit):
+    low, high = (-3, 3) if unit == "z-score" else (0, 365)
+    values = rng.uniform(low, high, shape).astype("float32")
+    values[~land] = np.nan
+    return values
+
+
+def make_fixture(path, conf, layout, scale=1.0, nan_fraction=0.7, percentile_step=1, unit="days", seed=0):
+    """Write a synthetic file for `layout` to `path` and return the
+    `conf.yaml` dataset entry that loads it."""
+    rng = np.random.default_rng(seed)
+    grid_conf = fixture_grid(conf, layout, scale)
+    lon = np.array(grid_conf["lon"], dtype="float32")
+    lat = np.array(grid_conf["lat"], dtype="float32")
+    dataset = {
+        "dataset": FIXTURE_DATASETS[layout],
+        "filename": path,
+        "filename_new": path,
+        "slug": "fixture_{}".format(layout),
+        "name": "Synthetic {} fixture".format(layout),
+        "description": "",
+        "parent_category": None,
+        "sub_category": None,
+        "grid": grid_conf["grid"],
+        "unit": unit,
+    }
+
+    if layout == "gcm":
+        land = rng.random((len(lon), len(lat))) >= nan_fraction
+        names = ["fixture_{}C".format(level) for level in CMIP_SCENARIOS]
+        ds = xarray.Dataset(
+            {name: (("lon", "lat"), _values(rng, land.shape, land, unit)) for name in names},
+            coords={"lon": lon, "lat": lat},
+        )
+        dataset.update(
+            model="GCM, CMIP5",
+            dimensions=["lon", "lat"],
+            variables=[{"name": name, "method": "mid_value"} for name in names],
+        )
+    else:
+        shape = (len(lon), len(lat), len(WARMING_LEVELS))
+        land = np.broadcast_to(
+            (rng.random(shape[:2]) >= nan_fraction)[:, :, None], shape
+        )
+        if layout == "rcm":
+            names = ["pctl10", "mean", "pctl90"]
+            methods = ["low_value", "mid_value", "high_value"]
+        else:
+            names = ["perc_{}".format(p) for p in range(0, 101, percentile_step)]
+            methods = ["values"] * len(names)
+        ds = xarray.Dataset(
+            {name: (("lon", "lat", "time"), _values(rng, shape, land, unit)) for name in names},
+            coords={
+                "lon": lon,
+                "lat": lat,
+                "time": np.array(WARMING_LEVELS, dtype="float64"),
+            },
+        )
+        dataset.update(
+            model="global REMO",
+            dimensions=["lon", "lat", "time"],
+            variables=[
+                {"name": name, "method": method} for name, method in zip(names, methods)
+            ],
+        )
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    ds.to_netcdf(path)
+    return dataset
@@ -1,8 +1,10 @@
 import os
-from hashlib import md5
+from hashlib import md5, sha256
+import json
 from numpy import format_float_positional
-import boto3
-import tempfile
+import numpy as np
+
+from s3cache import S3Cache
 
 
 class NoMatchingUnitError(Exception):
@@ -25,6 +27,178 @@ def to_hash(grid, lon, lat):
     return hashed
 
 
+# EWKT is wild but basically it's POINT(X Y), where X and Y are
+# arbitrary precision numbers with signed negative but unsigned
+# positive and have no trailing zeroes. The decimal formatting is
+# key and if PF gives us data with 5 degrees of precision we'll
+# need to revisit this. The {:.4g} says turn the float into a
+# numeral with precision 4 and the 'g' gets rid of trailing
+# zeroes. So -179.0 becomes -179 while 20.1 is unchanged.
+#
+# These are the same formats `to_hash` uses, keyed by grid.
+EWKT_FORMATS = {"GCM": "{:.2f}", "RCM": "{:.4g}"}
+
+
+def factorize(values):
+    """Return the distinct values of a 1-D array and the inverse index
+    that rebuilds it. We compare on the raw bits rather than the float
+    value so -0.0 and 0.0 stay distinct, exactly like formatting does."""
+    values = np.ascontiguousarray(values)
+    if values.dtype.kind not in "fiu":
+        values = values.astype("float64")
+    bits = values.view("u{}".format(values.dtype.itemsize))
+    _, first, inverse = np.unique(bits, return_index=True, return_inverse=True)
+    return values[first], inverse.reshape(-1)
+
+
+def _hash_grid_column(grid, lons, lats):
+    if grid not in EWKT_FORMATS:
+        raise NoMatchingUnitError(grid)
+    fmt = EWKT_FORMATS[grid]
+    lon_values, lon_idx = factorize(lons)
+    lat_values, lat_idx = factorize(lats)
+    lon_strs = [fmt.format(v) for v in lon_values]
+    lat_strs = [fmt.format(v) for v in lat_values]
+
+    n_lat = len(lat_values)
+    pairs, pair_idx = np.unique(
+        lon_idx.astype("int64") * n_lat + lat_idx, return_inverse=True
+    )
+    prefix = grid + "SRID=4326;POINT("
+    hashes = np.array(
+        [
+            md5(
+                "{}{} {})".format(
+                    prefix, lon_strs[p // n_lat], lat_strs[p % n_lat]
+                ).encode()
+            ).hexdigest()
+            for p in pairs.tolist()
+        ],
+        dtype=object,
+    )
+    return hashes[pair_idx.reshape(-1)]
+
+
+def to_hashes(grid, lons, lats):
+    """Vectorized `to_hash`: hash whole lon/lat columns in one call.
+
+    `grid` is either a single grid name or an array the same length as
+    `lons`/`lats`. Every dataset sits on a fixed grid, so a column of
+    millions of rows holds only a few thousand distinct lons and lats;
+    we format each distinct value once, md5 each distinct (lon, lat)
+    pair once, and gather the hashes back out to the full column. The
+    result is an object array of the same hex strings `to_hash` gives.
+    """
+    lons = np.asarray(lons).reshape(-1)
+    lats = np.asarray(lats).reshape(-1)
+    if len(lons) != len(lats):
+        raise ValueError("lons and lats must be the same length")
+
+    if isinstance(grid, str):
+        return _hash_grid_column(grid, lons, lats)
+
+    grids = np.asarray(grid, dtype=object).reshape(-1)
+    hashes = np.empty(len(lons), dtype=object)
+    for name in set(grids.tolist()):
+        mask = grids == name
+        hashes[mask] = _hash_grid_column(name, lons[mask], lats[mask])
+    return hashes
+
+
+def to_ewkt(grid, lons, lats):
+    """The EWKT of every lon/lat pair, e.g. "SRID=4326;POINT(-179.8 -10)",
+    formatted the way `to_hash` formats it (so Postgres's own md5 of
+    the grid and the point's EWKT comes out the same). Each distinct
+    lon and lat is formatted once. Returns an object array."""
+    if grid not in EWKT_FORMATS:
+        raise NoMatchingUnitError(grid)
+    fmt = EWKT_FORMATS[grid]
+    lon_values, lon_idx = factorize(np.asarray(lons).reshape(-1) + 0)
+    lat_values, lat_idx = factorize(np.asarray(lats).reshape(-1) + 0)
+    lon_strs = np.array(["SRID=4326;POINT(" + fmt.format(v) + " " for v in lon_values], dtype=object)
+    lat_strs = np.array([fmt.format(v) + ")" for v in lat_values], dtype=object)
+    return lon_strs[lon_idx] + lat_strs[lat_idx]
+
+
+def hash_index(df, grid, table=None):
+    """Hash the lon/lat levels of a `to_dataframe()` index in one call.
+    These are the first two index levels, the same positions the stat
+    builders unpack from each record. If we have a precomputed
+    `GridHashTable` for the grid we gather from it instead of hashing."""
+    lons = df.index.get_level_values(0).to_numpy() + 0  # +0 so -0 becomes 0
+    lats = df.index.get_level_values(1).to_numpy() + 0  # +0 so -0 becomes 0
+    if table is not None:
+        return table.lookup(lons, lats)
+    return to_hashes(grid, lons, lats)
+
+
+def _slices(dims, sizes, max_cells):
+    rest = 1
+    for size in sizes[1:]:
+        rest *= size
+    if rest <= max_cells or len(dims) == 1:
+        step = max(1, max_cells // rest)
+        for start in range(0, sizes[0], step):
+            yield {dims[0]: slice(start, start + step)}
+    else:
+        for i in range(sizes[0]):
+            for inner in _slices(dims[1:], sizes[1:], max_cells):
+                yield {dims[0]: slice(i, i + 1), **inner}
+
+
+def iter_slices(ds, max_cells):
+    """Yield `isel()` indexers that cover an xarray dataset in pieces of
+    at most `max_cells` cells, i.e. rows of `to_dataframe()`. We cut
+    along the leading dimensions in the order `to_dataframe()` lays
+    them out, so the pieces come back in the same row order as the
+    whole file would."""
+    dims = list(ds.dims)
+    return _slices(dims, [ds.sizes[d] for d in dims], max(1, int(max_cells)))
+
+
+def batch_slices(ds, batch_size):
+    """The `isel()` indexers of the batches `--batch`/`--batch-size`
+    split a file into: runs of whole columns along the leading
+    dimension (lon) of at most `batch_size` cells each, or single
+    columns if a column is bigger than that. Batches are always whole
+    columns, so every coordinate is in exactly one batch and a batch
+    can replace its own coordinates' stats without touching anyone
+    else's."""
+    dims = list(ds.dims)
+    column = 1
+    for dim in dims[1:]:
+        column *= ds.sizes[dim]
+    step = max(1, int(batch_size) // column)
+    return [{dims[0]: slice(start, start + step)} for start in range(0, ds.sizes[dims[0]], step)]
+
+
+def slice_hashes(ds, indexer, grid, table=None):
+    """The coordinate hash of every lon/lat in a slice of a file,
+    whether or not the cell has any data, so we can clear out what an
+    earlier load put there."""
+    part = ds.isel(indexer)
+    dims = list(part.dims)
+    lons, lats = np.meshgrid(part[dims[0]].values, part[dims[1]].values, indexing="ij")
+    lons = lons.reshape(-1) + 0  # +0 so -0 becomes 0
+    lats = lats.reshape(-1) + 0
+    if table is not None:
+        return table.lookup(lons, lats)
+    return to_hashes(grid, lons, lats)
+
+
+def file_fingerprint(path, cdf=None, block_size=1 << 20):
+    """A sha256 of a file's bytes and, if given, of its `conf.yaml`
+    entry, so a changed file or a changed conversion (unit, variables,
+    model) gives a different fingerprint."""
+    digest = sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    if cdf is not None:
+        digest.update(json.dumps(cdf, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
 def stat_fmt(pandas_value, unit):
     if unit == "z-score":
         formatted_value = format_float_positional(pandas_value, precision=1)
@@ -34,61 +208,27 @@ def stat_fmt(pandas_value, unit):
         return int_value
 
 
-def to_remo_stat_new(row):
-    """Make a stat from the output of our dataframe."""
-    (
-        lon,
-        lat,
-        warming_levels,
-        dataset_id,
-        grid,
-        unit,
-        values,
-    ) = row
-    lon = lon + 0  # +0 incase we have lon = -0 so it becomes 0
-    lat = lat + 0  # +0 incase we have lat = -0 so it becomes 0
-    hashed = to_hash(grid, lon, lat)
-
-    stat_dict = {
-        "dataset_id": int(dataset_id),  # Because we inserted it into the numpy array
-        "coordinate_hash": hashed,
-        "warming_scenario": str(warming_levels),
-        "vaules": [stat_fmt(num, unit) for num in values],
-    }
-
-    return stat_dict
+_s3_cache = None
 
 
 def load_netcdf_file(netcdf_object_key):
+    """Path to a local copy of the file, from the download cache if it
+    already has this version of it (see `s3cache.py`)."""
     print("[Notice] Running on Lambda, downloading file from S3")
     if not netcdf_object_key:
         raise ValueError("The netcdf_object_key parameter is required but not provided.")
 
-    s3 = boto3.client("s3")
-    temp_file = tempfile.NamedTemporaryFile(delete=False)
+    global _s3_cache
+    if _s3_cache is None:
+        _s3_cache = S3Cache()
     try:
-        s3.download_file(
-            os.getenv("S3_BUCKET_NAME"),
-            netcdf_object_key,
-            temp_file.name,
-        )
-        return temp_file.name
+        # The entry stays in use, so it can't be evicted, until this
+        # process exits.
+        return _s3_cache.fetch(os.getenv("S3_BUCKET_NAME"), netcdf_object_key)
     except Exception as e:
         print(f"[Error] Failed to download file from S3: {e}")
         raise
 
-# Helper function to trigger the next Lambda execution
-def trigger_next_batch(next_batch):
-    import boto3
-
-    client = boto3.client("lambda")
-    response = client.invoke(
-        FunctionName=os.environ["AWS_LAMBDA_FUNCTION_NAME"],
-        InvocationType="Event",
-        Payload=json.dumps({"batch": next_batch}),
-    )
-    print(f"[Notice] Triggered Lambda for batch {next_batch}: {response}")
-
 
 class NoMatchingGridError(Exception):
     def __init__(self, grid):
@@ -98,3 +238,10 @@ class NoMatchingGridError(Exception):
 class NoDatasetWithThatIDError(Exception):
     def __init__(self, ident):
         self.ident = ident
+
+
+class IncompleteImportError(Exception):
+    def __init__(self, dataset_id, committed, total):
+        self.dataset_id = dataset_id
+        self.committed = committed
+        self.total = total
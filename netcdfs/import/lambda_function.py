@@ -8,6 +8,7 @@ def lambda_handler(event, context):
     batch = event.get("batch") or "1"
     batch_size = event.get("batch_size") or "1500000"
     add_dataset_record = event.get("add_dataset_record")
+    profile = event.get("profile")
 
     if not dataset_id:
         raise ValueError("Missing required parameter: dataset_id")
@@ -39,11 +40,26 @@ def lambda_handler(event, context):
         batch,
         "--batch-size",
         batch_size,
+        # Lambda has no /dev/shm, so no process pool; convert in-process.
+        "--cpu-workers",
+        "0",
     ]
 
     if add_dataset_record:
         command.append("--add-dataset-record")
 
+    if isinstance(profile, str):
+        profile = profile.lower() == "true"
+
+    if profile:
+        # Only /tmp is writable on Lambda. The per-stage summary is
+        # printed too, so it comes back in the body.
+        command += [
+            "--profile",
+            "--profile-report",
+            "/tmp/profiles/{}-{}.json".format(dataset_id, batch),
+        ]
+
     try:
         # Run the command
         result = subprocess.run(command, capture_output=True, text=True, check=True)
@@ -0,0 +1,168 @@
+import re
+import time
+
+from rich import print
+
+from bulk import STATISTICS_TABLE, report_throughput
+
+"""
+Swap loads (`pfimport.py --swap`): reloading a dataset without
+touching the live stats table until the very end.
+
+It needs `pf_dataset_statistics` partitioned by dataset, which
+`util/partition-statistics.sql` does to a database made from
+`util/temp.sql`. A swap load COPYs the new stats into a standalone
+table nobody reads, builds the parent's indexes, primary key and
+foreign keys on it, and adds a check that it only holds this dataset,
+so attaching it needs no scan. The swap itself is one short
+transaction: detach the dataset's old partition, attach the new one.
+The old one is dropped after that's committed.
+
+Stats loaded without --swap go into the default partition. Before the
+swap, `clear_default_partition` deletes the dataset's rows from it in a
+transaction of its own and proves they're gone with a validated
+`CHECK (dataset_id <> X)`, so the ATTACH doesn't scan the default
+partition either. The check is dropped once the partition is attached.
+
+"""
+
+STATISTICS_DEFAULT_PARTITION = "pf_public.pf_dataset_statistics_default"
+
+# How long the swap waits for a lock on the stats table before giving
+# up, rather than queueing every reader behind it.
+SWAP_LOCK_TIMEOUT = "10s"
+
+
+def statistics_partitioned(cursor):
+    """Whether `pf_dataset_statistics` is partitioned."""
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass", (STATISTICS_TABLE,))
+    return cursor.fetchone()[0]
+
+
+def partition_name(dataset_id):
+    return "pf_public.pf_dataset_statistics_{}".format(int(dataset_id))
+
+
+def _exists(cursor, table):
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (table,))
+    return cursor.fetchone()[0]
+
+
+def create_load_table(cursor, dataset_id):
+    """Create an empty standalone table shaped like the stats table for
+    a swap load of the dataset. Its name is unique to this load so the
+    indexes and constraints named after it are too."""
+    table = "{}_{}".format(partition_name(dataset_id), int(time.time() * 1000))
+    cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)".format(table, STATISTICS_TABLE))
+    return table
+
+
+def prepare_load_table(cursor, table, dataset_id, rows):
+    """Give a loaded table what it needs to become the dataset's
+    partition: a check on dataset_id and the parent's constraints and
+    indexes. Foreign keys are checked here, not during the swap."""
+    started = time.perf_counter()
+    cursor.execute(
+        "ALTER TABLE {} ADD CONSTRAINT {}_dataset_check CHECK (dataset_id = {})".format(
+            table, table.split(".")[-1], int(dataset_id)
+        )
+    )
+    cursor.execute(
+        "SELECT pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f') ORDER BY contype DESC",
+        (STATISTICS_TABLE,),
+    )
+    for (definition,) in cursor.fetchall():
+        cursor.execute("ALTER TABLE {} ADD {}".format(table, definition))
+    cursor.execute(
+        "SELECT pg_get_indexdef(x.indexrelid) FROM pg_index x "
+        "WHERE x.indrelid = %s::regclass "
+        "AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)",
+        (STATISTICS_TABLE,),
+    )
+    for (definition,) in cursor.fetchall():
+        # "CREATE INDEX name ON ONLY parent USING ..." -> an index on
+        # the load table that Postgres names after it.
+        cursor.execute(
+            re.sub(r"^CREATE (UNIQUE )?INDEX \S+ ON (ONLY )?\S+", r"CREATE \1INDEX ON {}".format(table), definition)
+        )
+    cursor.execute("ANALYZE {}".format(table))
+    report_throughput("Built the indexes and constraints of {}".format(table), rows, started)
+
+
+def _default_check(dataset_id):
+    return "{}_not_{}".format(STATISTICS_DEFAULT_PARTITION.split(".")[-1], int(dataset_id))
+
+
+def clear_default_partition(connection, dataset_id):
+    """Delete the dataset's rows from the default partition and add a
+    validated check that it has none, so attaching the dataset's
+    partition needs no scan of the default. Commits each step on
+    `connection`: the delete, adding the check (a moment's exclusive
+    lock) and validating it (a scan that doesn't block readers or
+    writers). Does nothing if there's no default partition."""
+    with connection.cursor() as cursor:
+        if not _exists(cursor, STATISTICS_DEFAULT_PARTITION):
+            return
+        cursor.execute(
+            "DELETE FROM {} WHERE dataset_id = %s".format(STATISTICS_DEFAULT_PARTITION), (int(dataset_id),)
+        )
+        if cursor.rowcount:
+            print(
+                "[Notice] Removed {:,} rows of {} from the default partition".format(cursor.rowcount, dataset_id)
+            )
+        connection.commit()
+        cursor.execute("SET lock_timeout = %s", (SWAP_LOCK_TIMEOUT,))
+        cursor.execute(
+            "ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}".format(
+                STATISTICS_DEFAULT_PARTITION, _default_check(dataset_id)
+            )
+        )
+        cursor.execute(
+            "ALTER TABLE {} ADD CONSTRAINT {} CHECK (dataset_id <> {}) NOT VALID".format(
+                STATISTICS_DEFAULT_PARTITION, _default_check(dataset_id), int(dataset_id)
+            )
+        )
+        cursor.execute("RESET lock_timeout")
+        connection.commit()
+        cursor.execute(
+            "ALTER TABLE {} VALIDATE CONSTRAINT {}".format(STATISTICS_DEFAULT_PARTITION, _default_check(dataset_id))
+        )
+        connection.commit()
+
+
+def drop_default_check(cursor, dataset_id):
+    """Drop the check `clear_default_partition` added, if it's there."""
+    if _exists(cursor, STATISTICS_DEFAULT_PARTITION):
+        cursor.execute(
+            "ALTER TABLE {} DROP CONSTRAINT IF EXISTS {}".format(
+                STATISTICS_DEFAULT_PARTITION, _default_check(dataset_id)
+            )
+        )
+
+
+def swap_partition(cursor, table, dataset_id):
+    """Put a prepared load table in as the dataset's partition. Runs on
+    the caller's cursor; the caller commits, and then drops the old
+    partition this returns (None if there wasn't one). Call
+    `clear_default_partition` first, in transactions of its own."""
+    partition = partition_name(dataset_id)
+    cursor.execute("SET LOCAL lock_timeout = %s", (SWAP_LOCK_TIMEOUT,))
+    old = None
+    if _exists(cursor, partition):
+        old = "{}_old_{}".format(partition, int(time.time() * 1000))
+        cursor.execute("ALTER TABLE {} DETACH PARTITION {}".format(STATISTICS_TABLE, partition))
+        cursor.execute("ALTER TABLE {} RENAME TO {}".format(partition, old.split(".")[-1]))
+    cursor.execute("ALTER TABLE {} RENAME TO {}".format(table, partition.split(".")[-1]))
+    cursor.execute(
+        "ALTER TABLE {} ATTACH PARTITION {} FOR VALUES IN ({})".format(
+            STATISTICS_TABLE, partition, int(dataset_id)
+        )
+    )
+    # The partition's bound keeps the dataset out of the default now.
+    drop_default_check(cursor, dataset_id)
+    return old
+
+
+def drop_table(cursor, table):
+    cursor.execute("DROP TABLE IF EXISTS {}".format(table))
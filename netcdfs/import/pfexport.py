@@ -0,0 +1,242 @@
+import os
+import time
+
+import click
+import numpy as np
+import xarray
+from oyaml import safe_load
+from rich import print
+
+from bulk import report_throughput
+from helpers import EWKT_FORMATS, NoDatasetWithThatIDError, NoMatchingGridError, batch_slices, factorize
+from stats import CMIP_SCENARIOS, SCENARIO_NAMES, build_stat_columns
+
+"""
+Writes the map source of a dataset, the GeoJSONSeq file the Mapbox
+tiling recipes in `vector-tiles/templates` read, straight from its
+netCDF file. No database: the stats are converted the way `pfimport.py`
+converts them, pivoted to one feature per cell with the
+`data_<scenario>_<low|mid|high>` properties of
+`pf_private.aggregate_pf_dataset_statistic_cells`, and each cell's
+polygon is worked out from its point with the half-widths
+`postgres/loaders/pf_dataset_coordinates.load` builds `cell` with.
+
+Everything is done a batch of whole lon columns at a time, with array
+arithmetic: no row of the file is looked at on its own. The output is
+written like `geojson/export.py` writes it (same coordinates, same
+rings, values as Postgres prints a numeric(6,1)), so the two can be
+compared line for line once sorted.
+
+    python pfexport.py --conf conf.yaml --dataset-id 40104 --output-dir /tmp/data/mapbox/mts
+
+"""
+
+# Half the width and height of a cell, per grid; see `cell` in
+# postgres/loaders/pf_dataset_coordinates.load.
+CELL_HALF_SIZES = {
+    "RCM": (0.09999999660721, 0.099999999999991),
+    "GCM": (0.625, 0.471204188481675),
+}
+
+METHODS = ["low_value", "mid_value", "high_value"]
+EXPORT_COLUMNS = [
+    "data_{}_{}".format(SCENARIO_NAMES[scenario], method.split("_")[0])
+    for scenario in CMIP_SCENARIOS
+    for method in METHODS
+]
+
+# Exported with every scenario added to the baseline, like
+# pf_private.aggregate_pf_statistic_cells_change_to_absolute (see
+# CHANGE_MAPS_IDS in geojson/Makefile).
+CHANGE_MAPS_IDS = {40601, 40614, 40607, 40616, 40612, 40613, 40703, 40704}
+
+COORDINATE_PRECISION = 7
+# Cells (rows of `to_dataframe()`) converted at a time.
+BATCH_SIZE = 1000000
+
+
+def _text(values, fmt):
+    # Format each distinct value once.
+    distinct, inverse = factorize(values)
+    return np.array([fmt.format(v) for v in distinct], dtype=object)[inverse]
+
+
+def _coordinates(values, precision):
+    def fmt(value):
+        text = "{:.{}f}".format(value, precision).rstrip("0").rstrip(".")
+        return "0" if text == "-0" else text
+
+    distinct, inverse = factorize(values)
+    return np.array([fmt(v) for v in distinct], dtype=object)[inverse]
+
+
+def _values(values):
+    # numeric(6,1) as Postgres prints it, NULL for NaN.
+    distinct, inverse = factorize(values)
+    texts = ["null" if np.isnan(v) else "{:.1f}".format(v + 0) for v in distinct]
+    return np.array(texts, dtype=object)[inverse]
+
+
+def _ring(x0, y0, x1, y1):
+    # Counterclockwise, as RFC 7946 wants outer rings.
+    return (
+        "[[" + x0 + "," + y0 + "],[" + x1 + "," + y0 + "],[" + x1 + "," + y1 + "],["
+        + x0 + "," + y1 + "],[" + x0 + "," + y0 + "]]"
+    )
+
+
+def cell_geometries(grid, lons, lats, precision=COORDINATE_PRECISION):
+    """The GeoJSON geometry of the cell around each point, as an object
+    array. Points are first rounded the way they're stored in
+    `pf_grid_coordinates`. Cells that cross the antimeridian are split
+    into a MultiPolygon, like ogr2ogr's -wrapdateline."""
+    if grid not in CELL_HALF_SIZES:
+        raise NoMatchingGridError(grid)
+    half_width, half_height = CELL_HALF_SIZES[grid]
+    x = _text(lons + 0, EWKT_FORMATS[grid]).astype(float)
+    y = _text(lats + 0, EWKT_FORMATS[grid]).astype(float)
+    xmin, xmax = x - half_width, x + half_width
+    ymin = _coordinates(y - half_height, precision)
+    ymax = _coordinates(y + half_height, precision)
+
+    geometries = (
+        '{"type":"Polygon","coordinates":['
+        + _ring(_coordinates(xmin, precision), ymin, _coordinates(xmax, precision), ymax)
+        + "]}"
+    )
+    east = xmax > 180
+    west = xmin < -180
+    for wraps, east_x0, east_x1, west_x0, west_x1 in [
+        (east, xmin, 180.0, -180.0, xmax - 360),
+        (west, xmin + 360, 180.0, -180.0, xmax),
+    ]:
+        if not wraps.any():
+            continue
+        east_ring = _ring(
+            _coordinates(np.broadcast_to(east_x0, x.shape)[wraps], precision),
+            ymin[wraps],
+            _coordinates(np.full(wraps.sum(), east_x1), precision),
+            ymax[wraps],
+        )
+        west_ring = _ring(
+            _coordinates(np.full(wraps.sum(), west_x0), precision),
+            ymin[wraps],
+            _coordinates(np.broadcast_to(west_x1, x.shape)[wraps], precision),
+            ymax[wraps],
+        )
+        geometries[wraps] = '{"type":"MultiPolygon","coordinates":[[' + east_ring + "],[" + west_ring + "]]}"
+    return geometries
+
+
+def cell_values(stats, cells, change_maps=False):
+    """Pivot a frame of stats, with the cell number of each row as its
+    coordinate_hash, to a (cells, len(EXPORT_COLUMNS)) array."""
+    values = np.full((cells, len(EXPORT_COLUMNS)), np.nan)
+    scenarios = {scenario: i for i, scenario in enumerate(CMIP_SCENARIOS)}
+    labels = stats["warming_scenario"].to_numpy()
+    distinct, inverse = np.unique(labels.astype(str), return_inverse=True)
+    scenario = np.array([scenarios.get(label, -1) for label in distinct])[inverse]
+    known = scenario >= 0
+    rows = stats["coordinate_hash"].to_numpy()[known].astype("int64")
+    for m, method in enumerate(METHODS):
+        column = stats[method].to_numpy(dtype="float64", na_value=np.nan)[known]
+        values[rows, scenario[known] * len(METHODS) + m] = column
+    if change_maps:
+        values[:, len(METHODS):] += np.tile(values[:, : len(METHODS)], len(CMIP_SCENARIOS) - 1)
+    return values
+
+
+_KEYS = ['"{}":'.format(column) for column in EXPORT_COLUMNS]
+
+
+def encode_cells(cdf, df, precision=COORDINATE_PRECISION):
+    """GeoJSONSeq lines, as bytes, for the cells of a `to_dataframe()`
+    piece of a file made of whole cells (all of a cell's rows, one
+    after the other). Returns (features, bytes)."""
+    lons = df.index.get_level_values(0).to_numpy()
+    lats = df.index.get_level_values(1).to_numpy()
+    starts = np.ones(len(df), dtype=bool)
+    starts[1:] = (lons[1:] != lons[:-1]) | (lats[1:] != lats[:-1])
+    cell = np.cumsum(starts) - 1
+    stats = build_stat_columns(cdf, df.assign(coordinate_hash=cell))
+    if stats is None:
+        raise ValueError("Don't know how to export a {} dataset".format(cdf["model"]))
+
+    cells = int(starts.sum())
+    values = cell_values(stats, cells, int(cdf["dataset"]) in CHANGE_MAPS_IDS)
+    texts = _values(values.reshape(-1)).reshape(values.shape)
+    lines = np.full(cells, '{"type":"Feature","properties":{', dtype=object)
+    for i, key in enumerate(_KEYS):
+        lines = lines + ((key if i == 0 else "," + key) + texts[:, i])
+    lines = lines + '},"geometry":' + cell_geometries(cdf["grid"], lons[starts], lats[starts], precision) + "}\n"
+    return cells, "".join(lines).encode()
+
+
+def export_cdf(cdf, file_path, out, batch_size=BATCH_SIZE):
+    """Write the map source of one `conf.yaml` dataset from its file to
+    the binary file `out`. Returns (features, bytes written)."""
+    features = written = 0
+    with xarray.open_dataset(file_path) as ds:
+        for indexer in batch_slices(ds, batch_size):
+            # Only all-NaN rows are dropped, as when importing.
+            df = ds.isel(indexer).to_dataframe().dropna(how="all")
+            if len(df) == 0:
+                continue
+            cells, lines = encode_cells(cdf, df)
+            features += cells
+            written += out.write(lines)
+    return features, written
+
+
+@click.command()
+@click.option("--conf", default="conf.yaml", help='YAML config file, default "conf.yaml"')
+@click.option(
+    "--dataset-id",
+    "dataset_ids",
+    multiple=True,
+    type=int,
+    help="Export this dataset (repeat for more); default every dataset in the config",
+)
+@click.option(
+    "--output-dir",
+    default="/tmp/data/mapbox/mts",
+    help='Where to write <dataset>.geojsonld, default "/tmp/data/mapbox/mts"',
+)
+@click.option(
+    "--batch-size",
+    default=BATCH_SIZE,
+    type=int,
+    help="Rows of a file converted at a time, in whole lon columns, default {}".format(BATCH_SIZE),
+)
+def __main__(conf, dataset_ids, output_dir, batch_size):
+    with open(conf) as f:
+        datasets = safe_load(f)["datasets"]
+    if dataset_ids:
+        known = {int(cdf["dataset"]) for cdf in datasets}
+        for dataset_id in dataset_ids:
+            if dataset_id not in known:
+                raise NoDatasetWithThatIDError(dataset_id)
+        datasets = [cdf for cdf in datasets if int(cdf["dataset"]) in dataset_ids]
+
+    os.makedirs(output_dir, exist_ok=True)
+    for cdf in datasets:
+        path = os.path.join(output_dir, "{}.geojsonld".format(cdf["dataset"]))
+        started = time.perf_counter()
+        try:
+            with open(path + ".part", "wb") as out:
+                features, written = export_cdf(cdf, cdf["filename"], out, batch_size)
+        except Exception as e:
+            print("[Error] Could not export {}: {!r}".format(cdf["dataset"], e))
+            if os.path.exists(path + ".part"):
+                os.remove(path + ".part")
+            continue
+        os.replace(path + ".part", path)
+        report_throughput(
+            "Wrote {:,} features ({:,} bytes) of {} to {}".format(features, written, cdf["dataset"], path),
+            features,
+            started,
+        )
+
+
+if __name__ == "__main__":
+    __main__()
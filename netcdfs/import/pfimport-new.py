@@ -10,7 +10,13 @@ from sqlalchemy import (  # noqa: F401
 )
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import sessionmaker
-from helpers import to_remo_stat_new, NoDatasetWithThatIDError
+from helpers import file_fingerprint, hash_index, NoDatasetWithThatIDError
+from coordinates import load_hash_tables
+from stats import percentile_frame, to_percentile_columns
+from bulk import copy_values, STATISTICS_TABLE
+from profiling import Profiler, write_report
+from statcache import StatCache
+from store import Store
 
 
 import xarray
@@ -18,8 +24,9 @@ import xarray
 import click
 from rich.progress import Progress
 from rich import print
-from tqdm.contrib.concurrent import process_map
 from oyaml import safe_load
+from datetime import datetime
+import os
 
 
 """
@@ -50,6 +57,11 @@ Futures database schema.
 @click.option(
     "--conf", default="conf.yaml", help='YAML config file, default "conf.yaml"'
 )
+@click.option(
+    "--hash-tables",
+    default="hashes",
+    help='Directory of per-grid coordinate hash tables built by --load-coordinates, default "hashes"',
+)
 @click.option(
     "--dbhost",
     default="localhost",
@@ -74,8 +86,48 @@ Futures database schema.
     default=False,
     help="Log SQLAlchemy SQL calls to screen for debugging",
 )
+@click.option(
+    "--stat-cache",
+    default=None,
+    help="Directory to cache the converted stats of each file in. A file that's been converted before (same"
+    + " file, same conf.yaml entry) is loaded from the cache instead of converted again. Not used with"
+    + " --sample-data.",
+)
+@click.option(
+    "--store",
+    default=None,
+    help="Also write each dataset, once it's loaded, to the memory-mapped store in this directory (see"
+    + " store.py), for serving lookups without the database. Not used with --sample-data.",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    default=False,
+    help="Record the wall time, CPU time, rows and peak memory of each stage of every dataset and write them"
+    + " to a JSON report",
+)
+@click.option(
+    "--profile-tracemalloc",
+    is_flag=True,
+    default=False,
+    help="With --profile, also trace the peak of Python/NumPy allocations in each stage. Slows things down.",
+)
+@click.option(
+    "--profile-stage",
+    type=click.Choice(
+        ["open", "to_dataframe", "hash", "stats", "cache_read", "cache_write", "delete", "copy", "commit", "store"]
+    ),
+    default=None,
+    help="With --profile, also run this stage under cProfile and dump a .prof file for each run of it",
+)
+@click.option(
+    "--profile-report",
+    default=None,
+    help='Where --profile writes its report, default "profiles/pfimport-new-<time>.json"',
+)
 def __main__(
     conf,
+    hash_tables,
     dbhost,
     dbname,
     dbuser,
@@ -84,6 +136,12 @@ def __main__(
     load_cdfs,
     log_sql,
     sample_data,
+    stat_cache,
+    store,
+    profile,
+    profile_tracemalloc,
+    profile_stage,
+    profile_report,
 ):
 
     # This is boilerplate SQLAlchemy introspection; it makes classes
@@ -123,58 +181,61 @@ def __main__(
         )
         exit(0)
 
+    if profile_report is None:
+        profile_report = os.path.join(
+            "profiles", "pfimport-new-{}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S"))
+        )
+    profiler = Profiler(
+        profile,
+        profile_tracemalloc,
+        profile_stage,
+        os.path.dirname(profile_report) or ".",
+    )
+
     def update_cdf(cdf, stats):
         with Session() as session:
-            print("[Notice] Deleting old data from {}".format(cdf["dataset"]))
-            session.query(DatasetStatistic).filter(
-                DatasetStatistic.dataset_id == cdf["dataset"]
-            ).delete()
-
-            print("[Notice] Deleting the DataSet record.")
-            session.query(Dataset).filter(Dataset.id == cdf["dataset"]).delete()
-            d = Dataset(
-                id=cdf["dataset"],
-                name=cdf["name"],
-                slug=cdf["slug"],
-                description=cdf["description"],
-                parent_category=cdf["parent_category"],
-                sub_category=cdf["sub_category"],
-                model=cdf["model"],
-                unit=cdf["unit"],
-            )
-            print("[Notice] Adding dataset '{}'".format(cdf["dataset"]))
-            session.add(d)
+            with profiler.stage(cdf["dataset"], "delete"):
+                print("[Notice] Deleting old data from {}".format(cdf["dataset"]))
+                session.query(DatasetStatistic).filter(
+                    DatasetStatistic.dataset_id == cdf["dataset"]
+                ).delete()
+
+                print("[Notice] Deleting the DataSet record.")
+                session.query(Dataset).filter(Dataset.id == cdf["dataset"]).delete()
+                d = Dataset(
+                    id=cdf["dataset"],
+                    name=cdf["name"],
+                    slug=cdf["slug"],
+                    description=cdf["description"],
+                    parent_category=cdf["parent_category"],
+                    sub_category=cdf["sub_category"],
+                    model=cdf["model"],
+                    unit=cdf["unit"],
+                )
+                print("[Notice] Adding dataset '{}'".format(cdf["dataset"]))
+                session.add(d)
 
-            session.commit()
+                session.commit()
 
             print("[Notice] Updating {:,} stats".format(len(stats)))
             task_stats = progress.add_task(
                 "Updating stats for {}".format(cdf["dataset"]), total=len(stats)
             )
 
-            batch_size = 100000
-            total_records = len(stats)
-
-            for i in range(0, total_records, batch_size):
-                batch_stats = stats[i : i + batch_size]
-                session.execute(
-                    text(
-                        """
-                        insert into pf_public.pf_dataset_statistics (dataset_id,coordinate_hash,warming_scenario,values)
-                        values (:dataset_id, :coordinate_hash, :warming_scenario, :values)
-                        """
-                    ),
-                    batch_stats,
-                )
-
-                print(
-                    f"[Notice] Committing to the database: "
-                    f"Batch {i / batch_size} "
-                    f"out of {round(total_records / batch_size)}"
+            # The values arrays are packed into numeric[] literals a
+            # chunk at a time and streamed in with COPY.
+            cursor = session.connection().connection.cursor()
+            with profiler.stage(cdf["dataset"], "copy", len(stats)):
+                copy_values(
+                    cursor,
+                    STATISTICS_TABLE,
+                    stats,
+                    on_chunk=lambda rows: progress.update(task_stats, advance=rows),
                 )
 
+            print("[Notice] Committing to the database.")
+            with profiler.stage(cdf["dataset"], "commit", len(stats)):
                 session.commit()
-                progress.update(task_stats, advance=len(batch_stats))
 
     if load_cdfs is True or load_one_cdf is not None:
         with Progress() as progress:
@@ -183,6 +244,8 @@ def __main__(
                 "Loading NetCDF files", total=len(conf["datasets"])
             )
 
+            grid_hash_tables = load_hash_tables(hash_tables, conf)
+
             datasets = conf.get("datasets")
             if load_one_cdf is not None:
                 datasets = [x for x in datasets if x["dataset"] == int(load_one_cdf)]
@@ -196,65 +259,67 @@ def __main__(
                         cdf.get("filename_new")
                     )
                 )
-                ds = xarray.open_dataset(cdf.get("filename_new"))
 
                 def make_stats():
 
-                    print("[Notice] Converting CDF file to list.")
-
-                    df = (
-                        ds.to_dataframe()
-                        .dropna(how="all")
-                        .assign(
-                            dataset_id=cdf["dataset"],
-                            grid=cdf["grid"],
-                            unit=cdf["unit"],
-                        )
-                    )
+                    print("[Notice] Converting CDF file to arrays.")
 
-                    # Combine values from columns x1 to x30 into a single
-                    # array column
-                    df["values"] = df.filter(regex=r"^perc_\d{1,3}$").apply(
-                        lambda row: row.dropna().tolist(), axis=1
-                    )
-
-                    # Drop individual x1 to x30 columns
-                    columns_to_drop = ["perc_" + str(i) for i in range(0, 101)]
-                    existing_columns_to_drop = [
-                        col for col in columns_to_drop if col in df.columns
-                    ]
-                    df = df.drop(columns=existing_columns_to_drop)
+                    # Stack the perc_0 ... perc_100 variables into one
+                    # (cells x percentiles) array; each row becomes one
+                    # `values` array.
+                    with profiler.stage(cdf["dataset"], "to_dataframe") as stage:
+                        df = percentile_frame(ds)
+                        stage["rows"] = len(df)
 
                     if sample_data:
                         df = df.head(100)
 
-                    df = df.reindex(
-                        columns=[
-                            "dataset_id",
-                            "grid",
-                            "unit",
-                            "values",
-                        ]
-                    )
-
-                    # And now we transform to records
-                    recs = df.to_records()
-
-                    print(
-                        "[Notice] Using lots of processors to convert data to SQL-friendly data."
-                    )
-
-                    stats = process_map(to_remo_stat_new, recs, chunksize=10000)
-                    return stats
-
-                    return None
-
-                stats = make_stats()
+                    table = grid_hash_tables.get(cdf["grid"])
+                    with profiler.stage(cdf["dataset"], "hash", len(df)):
+                        df = df.assign(coordinate_hash=hash_index(df, cdf["grid"], table))
+
+                    with profiler.stage(cdf["dataset"], "stats", len(df)):
+                        return to_percentile_columns(df, cdf["dataset"], cdf["unit"])
+
+                stats = None
+                cache = None
+                if stat_cache and not sample_data:
+                    cache = StatCache(stat_cache, "values", file_fingerprint(cdf.get("filename_new"), cdf))
+                    with profiler.stage(cdf["dataset"], "cache_read") as stage:
+                        stats = cache.read()
+                        stage["rows"] = 0 if stats is None else len(stats)
+                if stats is not None:
+                    print("[Notice] Loaded the stats of {} from the cache at {}".format(cdf["dataset"], cache.path))
+                else:
+                    with profiler.stage(cdf["dataset"], "open"):
+                        ds = xarray.open_dataset(cdf.get("filename_new"))
+                    stats = make_stats()
+                    if cache is not None:
+                        with profiler.stage(cdf["dataset"], "cache_write", len(stats)):
+                            cache.write(stats, dataset=cdf["dataset"], file=cdf.get("filename_new"))
+                            print("[Notice] Cached the stats of {} in {}".format(cdf["dataset"], cache.path))
 
                 # Finally, let's do the real work and step through
                 update_cdf(cdf, stats)
+                if store and not sample_data:
+                    grid_conf = next(grid for grid in conf["grids"] if grid["grid"] == cdf["grid"])
+                    with profiler.stage(cdf["dataset"], "store") as stage:
+                        stage["rows"] = Store(store).write_dataset(
+                            cdf, grid_conf, cdf.get("filename_new"), grid_hash_tables.get(cdf["grid"])
+                        )
+                    print("[Notice] Wrote {} to the store at {}".format(cdf["dataset"], store))
                 progress.update(task_loading, advance=1)
 
+            if profile:
+                write_report(
+                    profile_report,
+                    profiler,
+                    {
+                        "sample_data": sample_data,
+                        "datasets": [cdf["dataset"] for cdf in datasets],
+                    },
+                )
+
 
 if __name__ == "__main__":
     __main__()
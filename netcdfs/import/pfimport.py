@@ -1,22 +1,14 @@
-from geoalchemy2 import Geometry  # noqa: F401
-
-from citext import CIText  # noqa: F401
-from sqlalchemy import create_engine, MetaData, Table, Column, ForeignKey  # noqa: F401
-from sqlalchemy.ext.automap import automap_base
-from sqlalchemy.orm import sessionmaker
 import os
 
-import xarray
-from numpy import array
-from helpers import to_hash, stat_fmt, NoDatasetWithThatIDError, load_netcdf_file
+from profiling import Profiler, write_report
 
 import click
 from rich.progress import Progress
 from rich import print
-from tqdm.contrib.concurrent import process_map, thread_map
 from oyaml import safe_load
+from datetime import datetime
 import itertools
-import math
+import time
 
 """
 CDF is a hierarchical format that allows you to have lots of
@@ -26,99 +18,6 @@ Futures database schema.
 
 """
 
-# Defining functions in the global scope allows us to use
-# multiprocessing to churn through records, which speeds import up
-# quite a bit. So these functions are up top.
-
-# EWKT is wild but basically it's POINT(X Y), where X and Y are
-# arbitrary precision numbers with signed negative but unsigned
-# positive and have no trailing zeroes. The decimal formatting is
-# key and if PF gives us data with 5 degrees of precision we'll
-# need to revisit this. The {:.4g} says turn the float into a
-# numeral with precision 4 and the 'g' gets rid of trailing
-# zeroes. So -179.0 becomes -179 while 20.1 is unchanged.
-
-
-def to_cmip_stats(row):
-    """Make a stat from the output of our dataframe."""
-    (
-        lon,
-        lat,
-        deg_baseline,
-        deg_1,
-        deg_1_5,
-        deg_2,
-        deg_2_5,
-        deg_3,
-        dataset_id,
-        grid,
-        unit,
-    ) = row
-    hashed = to_hash(grid, lon, lat)
-    scenarios = ["0.5", "1.0", "1.5", "2.0", "2.5", "3.0"]
-    stats = [deg_baseline, deg_1, deg_1_5, deg_2, deg_2_5, deg_3]
-
-    def to_stats(i, scenario):
-        new_mid = stat_fmt(stats[i], unit)
-        stat_dict = {
-            "dataset_id": int(
-                dataset_id
-            ),  # Because we inserted it into the numpy array
-            "coordinate_hash": hashed,
-            "warming_scenario": str(scenario),
-            "low_value": None,
-            "high_value": None,
-            "mid_value": new_mid,
-        }
-        return stat_dict
-
-    new_stats = [to_stats(i, scenario) for i, scenario in enumerate(scenarios)]
-    return new_stats
-
-
-def to_remo_stat(row):
-    """Make a stat from the output of our dataframe."""
-    (
-        lon,
-        lat,
-        warming_levels,
-        low_value,
-        mid_value,
-        high_value,
-        dataset_id,
-        grid,
-        unit,
-    ) = row
-    lon = lon + 0  # +0 incase we have lon = -0 so it becomes 0
-    lat = lat + 0  # +0 incase we have lat = -0 so it becomes 0
-    hashed = to_hash(grid, lon, lat)
-
-    if math.isnan(low_value):
-        new_low = None
-    else:
-        new_low = stat_fmt(low_value, unit)
-
-    if math.isnan(mid_value):
-        new_mid = None
-    else:
-        new_mid = stat_fmt(mid_value, unit)
-
-    if math.isnan(high_value):
-        new_high = None
-    else:
-        new_high = stat_fmt(high_value, unit)
-
-    stat_dict = {
-        "dataset_id": int(dataset_id),  # Because we inserted it into the numpy array
-        "coordinate_hash": hashed,
-        "warming_scenario": str(warming_levels),
-        "low_value": new_low,
-        "mid_value": new_mid,
-        "high_value": new_high,
-    }
-
-    return stat_dict
-
 
 # The command starts here
 @click.command()
@@ -155,6 +54,11 @@ def to_remo_stat(row):
 @click.option(
     "--conf", default="conf.yaml", help='YAML config file, default "conf.yaml"'
 )
+@click.option(
+    "--hash-tables",
+    default="hashes",
+    help='Directory of per-grid coordinate hash tables built by --load-coordinates, default "hashes"',
+)
 @click.option(
     "--dbhost",
     default="localhost",
@@ -189,7 +93,9 @@ def to_remo_stat(row):
     is_flag=False,
     nargs=1,
     type=int,
-    help="Batch number to process (used for splitting datasets into chunks)",
+    help="Batch number to process, from 1. A file is split into batches of whole longitudes of at most"
+    + " --batch-size cells; each batch reads only its own slice of the file and replaces only its own"
+    + " coordinates' stats, so batches can run at the same time. See batches.py.",
 )
 @click.option(
     "--batch-size",
@@ -197,7 +103,115 @@ def to_remo_stat(row):
     nargs=1,
     type=int,
     default=1500000,
-    help="Number of records to process per batch",
+    help="Number of cells of the file (counting empty ones) per batch, default 1500000",
+)
+@click.option(
+    "--chunk-size",
+    is_flag=False,
+    nargs=1,
+    type=int,
+    default=None,
+    help="Stream each file through in pieces of at most this many cells, writing each piece before reading"
+    + " the next, so memory is bounded by the chunk size instead of the file size. Not used with --batch.",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="With --chunk-size, commit each chunk to a staging table as it's loaded and record it, so a run that"
+    + " fails can be started again and pick up at the first chunk that wasn't committed. The dataset is"
+    + " swapped in in one transaction at the end.",
+)
+@click.option(
+    "--stat-cache",
+    default=None,
+    help="Directory to cache the converted stats of each file in. A file that's been converted before (same"
+    + " file, same conf.yaml entry, same --chunk-size) is loaded from the cache instead of converted again."
+    + " Not used with --batch or --sample-data.",
+)
+@click.option(
+    "--store",
+    default=None,
+    help="Also write each dataset, once it's loaded, to the memory-mapped store in this directory (see"
+    + " store.py), for serving lookups without the database. Not used with --batch or --sample-data.",
+)
+@click.option(
+    "--swap",
+    is_flag=True,
+    default=False,
+    help="Load each dataset into a table of its own, build its indexes there and then swap it in as the"
+    + " dataset's partition of pf_dataset_statistics in one short transaction, so readers never wait on"
+    + " the load. Needs the partitioned stats table (see util/partition-statistics.sql). Not used with"
+    + " --batch or --resume.",
+)
+@click.option(
+    "--delta",
+    is_flag=True,
+    default=False,
+    help="Compare each cell of the file with what's stored, by checksum, and only insert, update or delete"
+    + " the stats of cells that changed. The first delta import of a dataset works out the checksums of"
+    + " what's stored. Not used with --batch, --resume or --swap.",
+)
+@click.option(
+    "--cpu-workers",
+    is_flag=False,
+    nargs=1,
+    type=int,
+    default=os.cpu_count(),
+    help="Number of worker processes that read and convert files, default one per CPU. 0 converts in this"
+    + " process, for places without multiprocessing like Lambda.",
+)
+@click.option(
+    "--db-connections",
+    is_flag=False,
+    nargs=1,
+    type=int,
+    default=2,
+    help="Number of datasets loaded into the database at once, each over its own connection and in its own"
+    + " transaction, default 2",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    default=False,
+    help="Record the wall time, CPU time, rows and peak memory of each stage of every dataset and write them"
+    + " to a JSON report",
+)
+@click.option(
+    "--profile-tracemalloc",
+    is_flag=True,
+    default=False,
+    help="With --profile, also trace the peak of Python/NumPy allocations in each stage. Slows things down.",
+)
+@click.option(
+    "--profile-stage",
+    type=click.Choice(
+        [
+            "open",
+            "to_dataframe",
+            "hash",
+            "stats",
+            "cache_read",
+            "cache_write",
+            "render",
+            "delete",
+            "copy",
+            "commit",
+            "finalize",
+            "index",
+            "clear",
+            "swap",
+            "delta",
+            "store",
+        ]
+    ),
+    default=None,
+    help="With --profile, also run this stage under cProfile and dump a .prof file for each run of it",
+)
+@click.option(
+    "--profile-report",
+    default=None,
+    help='Where --profile writes its report, default "profiles/pfimport-<time>.json"; .prof files go next to it',
 )
 @click.option(
     "--add-dataset-record",
@@ -208,6 +222,7 @@ def to_remo_stat(row):
 def __main__(
     mutate,
     conf,
+    hash_tables,
     dbhost,
     dbname,
     dbuser,
@@ -220,19 +235,79 @@ def __main__(
     netcdf_object_key,
     batch,
     batch_size,
+    chunk_size,
+    resume,
+    stat_cache,
+    store,
+    swap,
+    delta,
+    cpu_workers,
+    db_connections,
+    profile,
+    profile_tracemalloc,
+    profile_stage,
+    profile_report,
     add_dataset_record
 ):
-    # This is boilerplate SQLAlchemy introspection; it makes classes
-    # that behave about how you'd expect for the tables in the current
-    # schema. These objects aren't smart about PostGIS but that's
-    # okay.
+    # The heavy imports are down here rather than at the top, so
+    # --help and bad arguments come back right away, and so the worker
+    # processes (which import this module afresh) don't pay for
+    # SQLAlchemy.
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import xarray
+
+    from helpers import (
+        batch_slices,
+        file_fingerprint,
+        iter_slices,
+        NoDatasetWithThatIDError,
+        load_netcdf_file,
+        slice_hashes,
+    )
+    from coordinates import (
+        build_hash_tables,
+        create_coordinate_indexes,
+        drop_coordinate_indexes,
+        grid_points,
+        load_grid_coordinates,
+        load_hash_tables,
+    )
+    from bulk import STAT_COLUMNS, copy_rendered_statistics, delete_cells, report_throughput
+    from delta import apply_delta, create_delta_table, ensure_checksum_tables, forget_checksums
+    from partitions import (
+        clear_default_partition,
+        create_load_table,
+        drop_default_check,
+        drop_table,
+        prepare_load_table,
+        statistics_partitioned,
+        swap_partition,
+    )
+    from scheduler import init_worker, run_imports
+    from store import Store
+    from checkpoints import (
+        commit_chunks,
+        describe_failure,
+        ensure_checkpoint_tables,
+        finalize_import,
+        find_import,
+        lock_dataset,
+        staged_rows,
+        start_import,
+    )
+
+    # The two tables we use are defined in tables.py rather than
+    # reflected from the database on every run.
+    from tables import Dataset, DatasetStatistic
+    from statcache import StatCache
 
     engine = None
     try:
         engine = create_engine(
             "postgresql://" + dbuser + ":" + dbpassword + "@" + dbhost + "/" + dbname,
             echo=log_sql,
-            pool_size=20,
+            pool_size=max(20, db_connections),
         )
     except Exception:
         print(
@@ -240,15 +315,6 @@ def __main__(
         )
         exit(0)
 
-    metadata = MetaData(schema="pf_public")
-    metadata.reflect(engine)
-    Base = automap_base(metadata=metadata)
-    Base.prepare()
-
-    Dataset = Base.classes.pf_datasets
-    Coordinates = Base.classes.pf_grid_coordinates
-    DatasetStatistic = Base.classes.pf_dataset_statistics
-
     Session = sessionmaker(bind=engine)
 
     # Load YAML file and do some very basic checking around provided conditions.
@@ -262,45 +328,246 @@ def __main__(
         )
         exit(0)
 
+    if chunk_size is not None and batch is not None:
+        print("[Error] --chunk-size streams the whole file; it can't be combined with --batch")
+        exit(0)
+
+    if resume and (chunk_size is None or sample_data):
+        print("[Error] --resume needs --chunk-size, and can't be used with --sample-data")
+        exit(0)
+
+    if store and (batch is not None or sample_data):
+        print("[Error] --store writes whole datasets; it can't be combined with --batch or --sample-data")
+        exit(0)
+
+    if swap and (batch is not None or resume):
+        print("[Error] --swap loads whole datasets; it can't be combined with --batch or --resume")
+        exit(0)
+
+    if delta and (batch is not None or resume or swap):
+        print("[Error] --delta compares whole datasets; it can't be combined with --batch, --resume or --swap")
+        exit(0)
+
     if mutate is False:
         print("[Notice] Since --mutate was not invoked I will not change the database")
     else:
         print("[Notice] Since --mutate was invoked I *WILL* change the database")
 
-    def save_cdf(cdf, stats):
-        with Session() as session:
+    if swap and mutate:
+        connection = engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                partitioned = statistics_partitioned(cursor)
+        finally:
+            connection.close()
+        if not partitioned:
+            print(
+                "[Error] --swap needs pf_dataset_statistics partitioned by dataset; "
+                "run util/partition-statistics.sql first"
+            )
+            exit(0)
+
+    if delta and mutate:
+        connection = engine.raw_connection()
+        try:
+            ensure_checksum_tables(connection)
+        finally:
+            connection.close()
+
+    if profile_report is None:
+        profile_report = os.path.join(
+            "profiles", "pfimport-{}.json".format(datetime.now().strftime("%Y%m%d-%H%M%S"))
+        )
+    profiler = Profiler(
+        profile,
+        profile_tracemalloc,
+        profile_stage,
+        os.path.dirname(profile_report) or ".",
+    )
+
+    def dataset_record(cdf):
+        return Dataset(
+            id=cdf["dataset"],
+            name=cdf["name"],
+            slug=cdf["slug"],
+            description=cdf["description"],
+            parent_category=cdf["parent_category"],
+            sub_category=cdf["sub_category"],
+            model=cdf["model"],
+            unit=cdf["unit"],
+        )
+
+    def replace_dataset(session, cdf):
+        # Clear out the dataset's old stats (and its record, if we're
+        # adding one) in the caller's transaction. A batch only clears
+        # out its own coordinates.
+        if cdf["dataset"] in batch_hashes:
+            print("[Notice] Deleting old data from {} in batch {}".format(cdf["dataset"], batch))
+            delete_cells(session.connection().connection.cursor(), cdf["dataset"], batch_hashes[cdf["dataset"]])
+        else:
             print("[Notice] Deleting old data from {}".format(cdf["dataset"]))
             session.query(DatasetStatistic).filter(
                 DatasetStatistic.dataset_id == cdf["dataset"]
             ).delete()
 
-            if add_dataset_record == True:
-                print("[Notice] Deleting the DataSet record.")
-                session.query(Dataset).filter(Dataset.id == cdf["dataset"]).delete()
-                d = Dataset(
-                    id=cdf["dataset"],
-                    name=cdf["name"],
-                    slug=cdf["slug"],
-                    description=cdf["description"],
-                    parent_category=cdf["parent_category"],
-                    sub_category=cdf["sub_category"],
-                    model=cdf["model"],
-                    unit=cdf["unit"],
-                )
-                print("[Notice] Adding dataset '{}'".format(cdf["dataset"]))
-                session.add(d)
-            print("[Notice] Inserting {:,} stats".format(len(stats)))
+        if add_dataset_record == True:
+            # This cascades to all of the dataset's stats, so with
+            # batches only the first one should add the record.
+            print("[Notice] Deleting the DataSet record.")
+            session.query(Dataset).filter(Dataset.id == cdf["dataset"]).delete()
+            print("[Notice] Adding dataset '{}'".format(cdf["dataset"]))
+            session.add(dataset_record(cdf))
+        # The delta checksums no longer say what's stored.
+        forget_checksums(session.connection().connection.cursor(), cdf["dataset"])
+        # The dataset record has to be there before COPY checks the
+        # foreign key, and the COPY runs on the session's own
+        # connection so the delete and every chunk of the insert commit
+        # together.
+        session.flush()
+
+    def save_cdf(cdf, stat_chunks, total_chunks=1):
+        with Session() as session:
+            with profiler.stage(cdf["dataset"], "delete"):
+                replace_dataset(session, cdf)
+            print("[Notice] Inserting in the database.")
+            cursor = session.connection().connection.cursor()
             task_stats = progress.add_task(
-                "Loading stats for {}".format(cdf["dataset"]), total=len(stats)
+                "Loading stats for {}".format(cdf["dataset"]), total=total_chunks
             )
+            inserted = 0
+            for stats in stat_chunks:
+                with profiler.stage(cdf["dataset"], "copy", stats[0]):
+                    inserted += copy_rendered_statistics(cursor, stats)
+                progress.update(task_stats, advance=1)
+            print("[Notice] Inserted {:,} stats".format(inserted))
+            print("[Notice] Committing to the database.")
+            with profiler.stage(cdf["dataset"], "commit", inserted):
+                session.commit()
 
-            print("[Notice] Inserting in the database.")
-            for stat in stats:
-                ds = DatasetStatistic(**stat)
-                session.add(ds)
+    def swap_cdf(cdf, stat_chunks, total_chunks=1):
+        # The stats go into a table nobody reads yet, which gets its
+        # indexes once it's full; only the swap touches the live table.
+        with Session() as session:
+            if add_dataset_record:
+                # Deleting the record would cascade to the live stats,
+                # so it's updated in place instead.
+                print("[Notice] Updating dataset '{}'".format(cdf["dataset"]))
+                session.merge(dataset_record(cdf))
+                session.flush()
+            cursor = session.connection().connection.cursor()
+            table = create_load_table(cursor, cdf["dataset"])
+            print("[Notice] Loading {} into {}".format(cdf["dataset"], table))
+            task_stats = progress.add_task(
+                "Loading stats for {}".format(cdf["dataset"]), total=total_chunks
+            )
+            inserted = 0
+            for stats in stat_chunks:
+                with profiler.stage(cdf["dataset"], "copy", stats[0]):
+                    inserted += copy_rendered_statistics(cursor, stats, table)
                 progress.update(task_stats, advance=1)
+            print("[Notice] Inserted {:,} stats".format(inserted))
+            with profiler.stage(cdf["dataset"], "index", inserted):
+                prepare_load_table(cursor, table, cdf["dataset"], inserted)
+            with profiler.stage(cdf["dataset"], "commit", inserted):
+                session.commit()
+
+        connection = engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                try:
+                    with profiler.stage(cdf["dataset"], "clear", inserted):
+                        clear_default_partition(connection, cdf["dataset"])
+                    with profiler.stage(cdf["dataset"], "swap", inserted):
+                        old = swap_partition(cursor, table, cdf["dataset"])
+                        forget_checksums(cursor, cdf["dataset"])
+                        connection.commit()
+                except Exception:
+                    connection.rollback()
+                    drop_table(cursor, table)
+                    drop_default_check(cursor, cdf["dataset"])
+                    connection.commit()
+                    raise
+                print("[Notice] Swapped in the new stats of {}".format(cdf["dataset"]))
+                if old is not None:
+                    drop_table(cursor, old)
+                    connection.commit()
+        finally:
+            connection.close()
+
+    def delta_cdf(cdf, stat_chunks, total_chunks=1):
+        # Everything goes into a temporary table first; only the cells
+        # whose checksum changed are written to the stats table.
+        with Session() as session:
+            if add_dataset_record:
+                print("[Notice] Updating dataset '{}'".format(cdf["dataset"]))
+                session.merge(dataset_record(cdf))
+                session.flush()
+            cursor = session.connection().connection.cursor()
+            table = create_delta_table(cursor, STAT_COLUMNS)
+            task_stats = progress.add_task(
+                "Comparing stats for {}".format(cdf["dataset"]), total=total_chunks
+            )
+            staged = 0
+            for stats in stat_chunks:
+                with profiler.stage(cdf["dataset"], "copy", stats[0]):
+                    staged += copy_rendered_statistics(cursor, stats, table)
+                progress.update(task_stats, advance=1)
+            with profiler.stage(cdf["dataset"], "delta", staged):
+                apply_delta(cursor, cdf["dataset"], "stats", ["low_value", "mid_value", "high_value"])
             print("[Notice] Committing to the database.")
-            session.commit()
+            with profiler.stage(cdf["dataset"], "commit", staged):
+                session.commit()
+
+    def resume_cdf(cdf, stat_chunks, dataset_import):
+        # Each chunk is committed to the import's staging table with
+        # its checkpoint, on a connection of its own.
+        task_stats = progress.add_task(
+            "Loading stats for {}".format(cdf["dataset"]),
+            total=dataset_import.total_chunks,
+            completed=dataset_import.committed,
+        )
+        connection = engine.raw_connection()
+        try:
+            chunk = dataset_import.committed
+            for stats in stat_chunks:
+                with profiler.stage(cdf["dataset"], "copy", 0 if stats is None else stats[0]):
+                    commit_chunks(connection, dataset_import, chunk, chunk + 1, stats)
+                chunk += 1
+                progress.update(task_stats, advance=1)
+        finally:
+            connection.close()
+
+        # Then the old rows are swapped for the staged ones in one
+        # transaction, so nobody ever sees half a dataset.
+        with Session() as session:
+            cursor = session.connection().connection.cursor()
+            if staged_rows(cursor, dataset_import) == 0:
+                print("[Notice] No stats to save for {}".format(cdf["dataset"]))
+            else:
+                with profiler.stage(cdf["dataset"], "delete"):
+                    replace_dataset(session, cdf)
+            with profiler.stage(cdf["dataset"], "finalize") as stage:
+                stage["rows"] = finalize_import(cursor, dataset_import)
+            print("[Notice] Moved {:,} staged stats into place".format(stage["rows"]))
+            print("[Notice] Committing to the database.")
+            with profiler.stage(cdf["dataset"], "commit", stage["rows"]):
+                session.commit()
+
+    def resume_from(connection, cdf, fingerprint, total_chunks):
+        # Find this file's unfinished import of the dataset, or start
+        # one.
+        if not lock_dataset(connection, cdf["dataset"]):
+            raise RuntimeError("Another resumable import of {} is running".format(cdf["dataset"]))
+        dataset_import = find_import(connection, cdf["dataset"], fingerprint, chunk_size)
+        if dataset_import is not None:
+            print(
+                "[Notice] Resuming {} at chunk {:,} of {:,}".format(
+                    cdf["dataset"], dataset_import.committed, dataset_import.total_chunks
+                )
+            )
+            return dataset_import
+        print("[Notice] Starting a resumable import of {}".format(cdf["dataset"]))
+        return start_import(connection, cdf["dataset"], fingerprint, chunk_size, total_chunks)
 
     # We make a table of all possible coordinates and put them into
     # the database. The database will hash them and that will become
@@ -309,29 +576,37 @@ def __main__(
     if load_coordinates is True:
         print("[Notice] Loading coordinates using data in the config file.")
 
+        # Rather than an ORM object per lon/lat pair, the points are
+        # formatted with numpy and COPYed in, with the point, hash and
+        # grid indexes dropped until every grid is in.
+        total = sum(len(grid["lon"]) * len(grid["lat"]) for grid in conf["grids"])
         with Progress() as progress:
-            with Session() as session:
-                task_progress = progress.add_task(
-                    "Loading coords", total=len(conf.get("grids"))
-                )
-
-                def to_record(coord, grid_name):
-                    pt = "POINT({} {})".format(*coord)
-                    return Coordinates(grid=grid_name, point=pt)
-
+            task_progress = progress.add_task("Loading coords", total=total)
+
+            def advance(rows):
+                progress.update(task_progress, advance=rows)
+
+            if mutate:
+                connection = engine.raw_connection()
+                try:
+                    with connection.cursor() as cursor:
+                        started = time.perf_counter()
+                        indexes = drop_coordinate_indexes(cursor)
+                        for grid in conf["grids"]:
+                            print("[Notice] Loading coordinates for {}.".format(grid["grid"]))
+                            load_grid_coordinates(cursor, grid, on_chunk=advance)
+                        create_coordinate_indexes(cursor, indexes, total)
+                    connection.commit()
+                    report_throughput("Loaded {:,} coordinates".format(total), total, started)
+                finally:
+                    connection.close()
+            else:
                 for grid in conf["grids"]:
-                    print("[Notice] Loading coordinates for {}.".format(grid["grid"]))
-                    grid_name = grid["grid"]
-                    coords = list(itertools.product(grid["lon"], grid["lat"]))
-                    records = [to_record(coord, grid_name) for coord in coords]
-
-                    if mutate:
-                        session.query(Coordinates).filter(
-                            Coordinates.grid == grid_name
-                        ).delete()
-                        session.bulk_save_objects(records)
-                        session.commit()
-                    progress.update(task_progress, advance=1)
+                    advance(len(grid_points(grid)))
+
+        # Every dataset import looks its coordinate hashes up in these
+        # tables instead of hashing each cell again.
+        build_hash_tables(hash_tables, conf)
 
     if load_cdfs is True or load_one_cdf is not None:
         with Progress() as progress:
@@ -340,6 +615,8 @@ def __main__(
                 "Loading NetCDF files", total=len(conf["datasets"])
             )
 
+            grid_hash_tables = load_hash_tables(hash_tables, conf)
+
             datasets = conf.get("datasets")
             if load_one_cdf is not None:
                 datasets = [x for x in datasets if x["dataset"] == int(load_one_cdf)]
@@ -347,133 +624,220 @@ def __main__(
                     print("I could not find a dataset with ID {}".format(load_one_cdf))
                     raise NoDatasetWithThatIDError(load_one_cdf)
 
+            # Work out the pieces of every file up front. Each piece is
+            # read and converted in a worker process; the stats for a
+            # dataset are then loaded in one transaction on a database
+            # thread while the workers move on to the next pieces.
+            jobs = []
+            failures = {}
+            left_over = {}
+            imports = {}
+            batch_hashes = {}
+            caches = {}
+            store_files = {}
+            if resume and mutate:
+                # Held for the whole run; it keeps the advisory locks
+                # on the datasets we're resuming.
+                checkpoint_connection = engine.raw_connection()
+                ensure_checkpoint_tables(checkpoint_connection)
             for cdf in datasets:
                 print(
                     "[Notice] Loading and converting CDF file {}".format(
                         cdf.get("filename")
                     )
                 )
-                file_path = (
-                    load_netcdf_file(netcdf_object_key)
-                    if run_env == "development"
-                    or run_env == "production"
-                    else cdf.get("filename")
-                )
-
-                ds = xarray.open_dataset(file_path)
-
-                def make_stats():
-
-                    print("[Notice] Converting CDF file to list.")
-                    # This is really where most of the work is
-                    # happening. We take our xarray dataset, drop all
-                    # the Na* values, add a few columns using our
-                    # existing data (this is verrrrry fast in a
-                    # dataframe), and finally make it into records(),
-                    # i.e. a list. Worth noting that the values are
-                    # all still pandas data types, not native Python,
-                    # so they need some love to make them good for
-                    # SQLAlchemy.
-                    df = (
-                        ds.to_dataframe()
-                        .dropna(how="all")
-                        .assign(
-                            dataset_id=cdf["dataset"],
-                            grid=cdf["grid"],
-                            unit=cdf["unit"],
-                        )
+                try:
+                    file_path = (
+                        load_netcdf_file(netcdf_object_key)
+                        if run_env == "development"
+                        or run_env == "production"
+                        else cdf.get("filename")
                     )
+                    limit = 100 if sample_data else None
+                    cache = None
+                    fingerprint = None
+                    if (stat_cache and batch is None and not sample_data) or (resume and mutate):
+                        print("[Notice] Fingerprinting {}".format(file_path))
+                        fingerprint = file_fingerprint(file_path, cdf)
+                    if stat_cache and batch is None and not sample_data:
+                        cache = StatCache(stat_cache, "stats", fingerprint, chunk_size)
+                    if cache is not None and cache.pieces() is not None:
+                        print(
+                            "[Notice] Loading the stats of {} from the cache at {}".format(
+                                cdf["dataset"], cache.path
+                            )
+                        )
+                        tasks = [(cdf, None, None, None, cache.piece_path(i)) for i in range(cache.pieces())]
+                    elif chunk_size is not None:
+                        with xarray.open_dataset(file_path) as ds:
+                            indexers = list(iter_slices(ds, chunk_size))
+                        print(
+                            "[Notice] Streaming the file in {:,} pieces of at most {:,} cells.".format(
+                                len(indexers), chunk_size
+                            )
+                        )
+                        if sample_data:
+                            # One task that stops reading at 100 rows.
+                            tasks = [(cdf, file_path, indexers, limit)]
+                        else:
+                            tasks = [(cdf, file_path, [indexer]) for indexer in indexers]
+                    elif batch is not None:
+                        with xarray.open_dataset(file_path) as ds:
+                            indexers = batch_slices(ds, batch_size)
+                            if batch > len(indexers):
+                                print("[Notice] No data left to process for batch {}.".format(batch))
+                                tasks = []
+                            else:
+                                print("[Notice] Processing batch {}/{}.".format(batch, len(indexers)))
+                                indexer = indexers[batch - 1]
+                                tasks = [(cdf, file_path, [indexer], limit)]
+                                batch_hashes[cdf["dataset"]] = slice_hashes(
+                                    ds, indexer, cdf["grid"], grid_hash_tables.get(cdf["grid"])
+                                )
+                    else:
+                        tasks = [(cdf, file_path, [None], limit)]
+                    if cache is not None and cache.pieces() is None:
+                        # Convert as usual and save each piece's stats
+                        # on the way.
+                        cache.prepare()
+                        tasks = [task[:3] + (None, cache.piece_path(i)) for i, task in enumerate(tasks)]
+                        caches[cdf["dataset"]] = (cache, len(tasks))
+                    if store:
+                        store_files[cdf["dataset"]] = file_path
+                    if resume and mutate:
+                        dataset_import = resume_from(checkpoint_connection, cdf, fingerprint, len(tasks))
+                        imports[cdf["dataset"]] = dataset_import
+                        tasks = tasks[dataset_import.committed :]
+                except Exception as e:
+                    print("[Error] Could not open {}: {!r}".format(cdf.get("filename"), e))
+                    failures[cdf["dataset"]] = e
+                    progress.update(task_loading, advance=1)
+                    continue
+                jobs.append((cdf, tasks))
+
+            pieces_per_dataset = {cdf["dataset"]: len(tasks) for cdf, tasks in jobs}
+
+            grids = {grid["grid"]: grid for grid in conf["grids"]}
+            if store:
+                # The cell index of each grid is written once, up front,
+                # rather than by whichever load gets to it first.
+                for grid in sorted({cdf["grid"] for cdf, _ in jobs}):
+                    if Store(store).matches(grids[grid]):
+                        continue
+                    if grid in Store(store).grids():
+                        print(
+                            "[Error] The {} grid in the store at {} is out of date with the config; "
+                            "write the store again from scratch".format(grid, store)
+                        )
+                        exit(1)
+                    print("[Notice] Writing the {} cell index to the store at {}".format(grid, store))
+                    Store(store).write_grid(grids[grid], grid_hash_tables.get(grid))
+
+            def rendered(pieces, keep_empty=False):
+                # Take the worker's profile records off each piece.
+                for piece, records in pieces:
+                    profiler.add(records)
+                    if piece is not None or keep_empty:
+                        yield piece
+
+            def load(cdf, pieces):
+                try:
+                    load_pieces(cdf, pieces)
+                except Exception as e:
+                    print("[Error] Loading {} failed, rolled it back: {!r}".format(cdf["dataset"], e))
+                    raise
+                if cdf["dataset"] in caches:
+                    # Every piece has been converted by now.
+                    cache, total = caches[cdf["dataset"]]
+                    if cache.finish(total, dataset=cdf["dataset"], file=cdf.get("filename")):
+                        print("[Notice] Cached the stats of {} in {}".format(cdf["dataset"], cache.path))
+                if cdf["dataset"] in store_files:
+                    # Straight from the file, a column at a time, so
+                    # it doesn't hold on to the stats.
+                    with profiler.stage(cdf["dataset"], "store") as stage:
+                        stage["rows"] = Store(store).write_dataset(
+                            cdf, grids[cdf["grid"]], store_files[cdf["dataset"]]
+                        )
+                    print("[Notice] Wrote {} to the store at {}".format(cdf["dataset"], store))
+                progress.update(task_loading, advance=1)
 
-                    if sample_data:
-                        df = df.head(100)
-                    
-                    if(batch is not None and batch_size is not None):
-                        batch_size_to_int = int(batch_size)
-                        batch_to_int = int(batch)
-                        print(f"[Notice] Processing batch {batch}")
-                        print(f"[Notice] Batch size {batch_size_to_int}")
-                        total_records = len(df)
-                        total_batches = (total_records + batch_size_to_int - 1) // batch_size_to_int  # Round up
-                        start_idx = (batch_to_int - 1) * batch_size_to_int
-                        end_idx = min(batch_to_int * batch_size_to_int, total_records)
-
-                        if batch_to_int > total_batches:
-                            print(f"[Notice] No data left to process for batch {batch}.")
-                            return None
-                    
-                        print(f"[Notice] Processing batch {batch_to_int}/{total_batches}.")
-                        df = df.iloc[start_idx:end_idx]
-                    
-                    # We need to flatten our dataframe and the resulting rows
-                    # need to be in this structure:
-                    #
-                    # lon, lat, time, low, mid, high, dataset_id, grid, unit = row
-                    #
-                    # We use the variables from the yaml file and rename those
-                    # columns to the method.
-                    #
-                    renames = {}
-                    for var in cdf["variables"]:
-                        renames[var["name"]] = var["method"]
-
-                    df = df.rename(columns=renames)
-
-                    # Then we put everything in the order you would expect.
-                    # Empty columns will be added in case low_value or high_value
-                    # are not present in the netcdf file.
-                    df = df.reindex(
-                        columns=[
-                            "low_value",
-                            "mid_value",
-                            "high_value",
-                            "dataset_id",
-                            "grid",
-                            "unit",
-                        ]
-                    )
+            def load_pieces(cdf, pieces):
+                # Nothing is deleted until there's something to put in
+                # its place.
+                if cdf["dataset"] in imports:
+                    resume_cdf(cdf, rendered(pieces, keep_empty=True), imports[cdf["dataset"]])
+                    return
+                pieces = rendered(pieces)
+                first = next(pieces, None)
+                if first is None:
+                    print("[Notice] No stats to save for {}".format(cdf["dataset"]))
+                elif mutate and delta:
+                    delta_cdf(cdf, itertools.chain([first], pieces), pieces_per_dataset[cdf["dataset"]])
+                elif mutate and swap:
+                    swap_cdf(cdf, itertools.chain([first], pieces), pieces_per_dataset[cdf["dataset"]])
+                elif mutate:
+                    save_cdf(cdf, itertools.chain([first], pieces), pieces_per_dataset[cdf["dataset"]])
+                else:
+                    for _ in pieces:
+                        pass
+
+            cpu_workers = min(cpu_workers, sum(len(tasks) for _, tasks in jobs))
+            print(
+                "[Notice] Loading {} dataset(s) with {} CPU worker(s) and {} database connection(s).".format(
+                    len(jobs), cpu_workers, db_connections
+                )
+            )
+            for cdf, e in run_imports(
+                jobs,
+                load,
+                cpu_workers,
+                db_connections,
+                initializer=init_worker,
+                initargs=(grid_hash_tables, profiler.settings()),
+            ):
+                failures[cdf["dataset"]] = e
+                progress.update(task_loading, advance=1)
 
-                    # And now we transform to records
-                    recs = df.to_records()
+            if resume and mutate:
+                # Committed chunks outlive a failure; say what's left.
+                for dataset_id in failures:
+                    if dataset_id in imports:
+                        left_over[dataset_id] = describe_failure(checkpoint_connection, imports[dataset_id])
+                checkpoint_connection.close()
+
+            if profile:
+                write_report(
+                    profile_report,
+                    profiler,
+                    {
+                        "cpu_workers": cpu_workers,
+                        "db_connections": db_connections,
+                        "chunk_size": chunk_size,
+                        "batch": batch,
+                        "batch_size": batch_size,
+                        "sample_data": sample_data,
+                        "datasets": [cdf["dataset"] for cdf in datasets],
+                    },
+                )
 
-                    print(
-                        "[Notice] Using lots of processors to convert data to SQL-friendly data."
+        if failures:
+            for dataset_id, e in failures.items():
+                if dataset_id in left_over:
+                    print("[Error] Dataset {} was not loaded: {!r}; {}".format(dataset_id, e, left_over[dataset_id]))
+                    continue
+                # The stats are only ever written in one transaction here;
+                # a swap load commits the updated record before the swap.
+                kept = (
+                    "its stats are unchanged but its dataset record was updated"
+                    if swap and add_dataset_record
+                    else "nothing of it was committed"
+                )
+                print(
+                    "[Error] Dataset {} was not loaded: {!r}; {}. Run the same command again to load it.".format(
+                        dataset_id, e, kept
                     )
-
-                    if run_env == "development" or run_env == "production":
-                        print("[Notice] Using thread_map for development environment.")
-                        map_fn = thread_map
-                        max_workers = 4  # Adjust based on Lambda resource limits
-                    else:
-                        print("[Notice] Using process_map for local environment.")
-                        map_fn = process_map
-                        max_workers = None  # Let process_map decide
-
-                    if cdf["model"] == "GCM, CMIP5":
-                        stats = map_fn(to_cmip_stats, recs, chunksize=10000)
-                        flattened = array(stats).flatten()
-                        return flattened
-                    elif (
-                        cdf["model"] == "global RegCM and REMO"
-                        or cdf["model"] == "global REMO"
-                    ):
-                        stats = map_fn(to_remo_stat, recs, chunksize=10000)
-                        return stats
-
-                    return None
-
-                stats = make_stats()
-
-                # Finally, let's do the real work and step through
-                # REMO files
-                if mutate:
-                    save_cdf(cdf, stats)
-                progress.update(task_loading, advance=1)
-
-                # # Trigger next batch if applicable
-                # if batch is not None and batch < total_batches:
-                #     next_batch = batch + 1
-                #     print(f"[Notice] Triggering next batch: {next_batch}")
-                #     trigger_next_batch(next_batch)
+                )
+            exit(1)
 
 
 if __name__ == "__main__":
@@ -10,14 +10,18 @@ from sqlalchemy import (  # noqa: F401
 )
 from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.orm import sessionmaker
-from helpers import to_remo_stat_new, NoDatasetWithThatIDError
+from helpers import file_fingerprint, hash_index, NoDatasetWithThatIDError
+from coordinates import load_hash_tables
+from stats import percentile_frame, to_percentile_columns
+from bulk import VALUE_COLUMNS, copy_values, staged_update_values
+from delta import apply_delta, create_delta_table, ensure_checksum_tables, forget_checksums
+from statcache import StatCache
 
 import xarray
 
 import click
 from rich.progress import Progress
 from rich import print
-from tqdm.contrib.concurrent import process_map
 from oyaml import safe_load
 
 
@@ -49,6 +53,11 @@ Futures database schema.
 @click.option(
     "--conf", default="conf.yaml", help='YAML config file, default "conf.yaml"'
 )
+@click.option(
+    "--hash-tables",
+    default="hashes",
+    help='Directory of per-grid coordinate hash tables built by --load-coordinates, default "hashes"',
+)
 @click.option(
     "--dbhost",
     default="localhost",
@@ -73,8 +82,38 @@ Futures database schema.
     default=False,
     help="Log SQLAlchemy SQL calls to screen for debugging",
 )
+@click.option(
+    "--stat-cache",
+    default=None,
+    help="Directory to cache the converted stats of each file in. A file that's been converted before (same"
+    + " file, same conf.yaml entry) is loaded from the cache instead of converted again. Not used with"
+    + " --sample-data.",
+)
+@click.option(
+    "--staged",
+    is_flag=True,
+    default=False,
+    help="COPY all of a dataset's new values into an indexed staging table and apply them with one"
+    + " set-based UPDATE, instead of inserting and joining 200k rows at a time.",
+)
+@click.option(
+    "--key-ranges",
+    nargs=1,
+    type=int,
+    default=1,
+    help="With --staged, split the UPDATE into this many coordinate_hash ranges, each committed"
+    + " separately, default 1",
+)
+@click.option(
+    "--delta",
+    is_flag=True,
+    default=False,
+    help="Compare each cell's values with what's stored, by checksum, and only update the rows of cells"
+    + " that changed.",
+)
 def __main__(
     conf,
+    hash_tables,
     dbhost,
     dbname,
     dbuser,
@@ -83,6 +122,10 @@ def __main__(
     load_cdfs,
     log_sql,
     sample_data,
+    stat_cache,
+    staged,
+    key_ranges,
+    delta,
 ):
 
     # This is boilerplate SQLAlchemy introspection; it makes classes
@@ -119,6 +162,37 @@ def __main__(
         )
         exit(0)
 
+    def staged_update_cdf(cdf, stats):
+        print("[Notice] Updating {:,} stats for {} through a staging table".format(len(stats), cdf["dataset"]))
+        connection = engine.raw_connection()
+        try:
+            staged_update_values(connection, stats, parts=key_ranges)
+        finally:
+            connection.close()
+
+    def delta_update_cdf(cdf, stats):
+        print("[Notice] Comparing {:,} stats for {} with what's stored".format(len(stats), cdf["dataset"]))
+        connection = engine.raw_connection()
+        try:
+            ensure_checksum_tables(connection)
+            with connection.cursor() as cursor:
+                table = create_delta_table(cursor, VALUE_COLUMNS)
+                copy_values(cursor, table, stats)
+                apply_delta(cursor, cdf["dataset"], "values", ["values"], insert=False)
+            connection.commit()
+        finally:
+            connection.close()
+
+    def forget_values(cdf):
+        # The other updates don't keep the delta checksums up to date.
+        connection = engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                forget_checksums(cursor, cdf["dataset"], "values")
+            connection.commit()
+        finally:
+            connection.close()
+
     def update_cdf(cdf, stats):
         with Session() as session:
             print("[Notice] Updating {:,} stats".format(len(stats)))
@@ -146,16 +220,9 @@ def __main__(
             print("[Notice] Finished creating temp table..")
 
             for i in range(0, total_records, batch_size):
-                batch_stats = stats[i : i + batch_size]
-                session.execute(
-                    text(
-                        """
-                            insert into temp_stats (dataset_id, coordinate_hash, warming_scenario, values)
-                            values (:dataset_id, :coordinate_hash, :warming_scenario, :values)
-                        """
-                    ),
-                    batch_stats,
-                )
+                batch_stats = stats.iloc[i : i + batch_size]
+                cursor = session.connection().connection.cursor()
+                copy_values(cursor, "temp_stats", batch_stats)
                 session.execute(
                     text(
                         """
@@ -190,6 +257,8 @@ def __main__(
                 "Loading NetCDF files", total=len(conf["datasets"])
             )
 
+            grid_hash_tables = load_hash_tables(hash_tables, conf)
+
             datasets = conf.get("datasets")
             if load_one_cdf is not None:
                 datasets = [x for x in datasets if x["dataset"] == int(load_one_cdf)]
@@ -203,63 +272,47 @@ def __main__(
                         cdf.get("filename_new")
                     )
                 )
-                ds = xarray.open_dataset(cdf.get("filename_new"))
 
                 def make_stats():
 
-                    print("[Notice] Converting CDF file to list.")
-
-                    df = (
-                        ds.to_dataframe()
-                        .dropna(how="all")
-                        .assign(
-                            dataset_id=cdf["dataset"],
-                            grid=cdf["grid"],
-                            unit=cdf["unit"],
-                        )
-                    )
+                    print("[Notice] Converting CDF file to arrays.")
 
-                    # Combine values from columns x1 to x30 into a single
-                    # array column
-                    df["values"] = df.filter(regex=r"^perc_\d{1,3}$").apply(
-                        lambda row: row.dropna().tolist(), axis=1
-                    )
-
-                    # Drop individual x1 to x30 columns
-                    columns_to_drop = ["perc_" + str(i) for i in range(0, 101)]
-                    existing_columns_to_drop = [
-                        col for col in columns_to_drop if col in df.columns
-                    ]
-                    df = df.drop(columns=existing_columns_to_drop)
+                    # Stack the perc_0 ... perc_100 variables into one
+                    # (cells x percentiles) array; each row becomes one
+                    # `values` array.
+                    df = percentile_frame(ds)
 
                     if sample_data:
                         df = df.head(100)
 
-                    df = df.reindex(
-                        columns=[
-                            "dataset_id",
-                            "grid",
-                            "unit",
-                            "values",
-                        ]
-                    )
-
-                    # And now we transform to records
-                    recs = df.to_records()
-
-                    print(
-                        "[Notice] Using lots of processors to convert data to SQL-friendly data."
-                    )
-
-                    stats = process_map(to_remo_stat_new, recs, chunksize=10000)
-                    return stats
-
-                    return None
-
-                stats = make_stats()
+                    table = grid_hash_tables.get(cdf["grid"])
+                    df = df.assign(coordinate_hash=hash_index(df, cdf["grid"], table))
+
+                    return to_percentile_columns(df, cdf["dataset"], cdf["unit"])
+
+                stats = None
+                cache = None
+                if stat_cache and not sample_data:
+                    cache = StatCache(stat_cache, "values", file_fingerprint(cdf.get("filename_new"), cdf))
+                    stats = cache.read()
+                if stats is not None:
+                    print("[Notice] Loaded the stats of {} from the cache at {}".format(cdf["dataset"], cache.path))
+                else:
+                    ds = xarray.open_dataset(cdf.get("filename_new"))
+                    stats = make_stats()
+                    if cache is not None:
+                        cache.write(stats, dataset=cdf["dataset"], file=cdf.get("filename_new"))
+                        print("[Notice] Cached the stats of {} in {}".format(cdf["dataset"], cache.path))
 
                 # Finally, let's do the real work and step through
-                update_cdf(cdf, stats)
+                if delta:
+                    delta_update_cdf(cdf, stats)
+                elif staged:
+                    forget_values(cdf)
+                    staged_update_cdf(cdf, stats)
+                else:
+                    forget_values(cdf)
+                    update_cdf(cdf, stats)
                 progress.update(task_loading, advance=1)
 
 
@@ -0,0 +1,289 @@
+import io
+import json
+import math
+import os
+import time
+
+import click
+import numpy as np
+import pandas
+import xarray
+from oyaml import safe_load
+from rich import print
+
+from bulk import STATISTICS_TABLE, report_throughput
+from coordinates import load_hash_tables
+from helpers import NoDatasetWithThatIDError, to_hashes
+from stats import to_stat_columns
+from units import lookup_unit
+
+"""
+Checks what's in `pf_dataset_statistics` after an import against the
+netCDF file it came from. The file is converted the way `pfimport.py`
+converts it (same hashes, same unit conversions), the dataset's rows
+are COPYed out of Postgres in one go, and the two are joined on
+coordinate hash and warming scenario as whole columns. Per warming
+scenario it reports:
+
+- rows missing from the database, and rows in it the file doesn't have;
+- values that differ by no more than the unit's precision (drift, e.g.
+  a value truncated the other way) and values that differ by more, or
+  are NULL on one side only (mismatches);
+- the largest difference seen.
+
+Cells (coordinate hashes) missing from or extra in the database are
+counted too. With `--sample` only a stratified sample of cells is
+read from the file and the database: `--sample` of the cells of every
+`SAMPLE_BAND_DEGREES` band of latitude, picked at random, so every
+part of the globe is looked at. That's quick enough to run after
+every load.
+
+    python pfverify.py --dbuser ford --dbpassword ford --dataset-id 40104 --sample 0.01
+
+It exits with 1 if anything is off.
+
+"""
+
+SAMPLE_BAND_DEGREES = 10
+STAT_VALUE_COLUMNS = ["low_value", "mid_value", "high_value"]
+KEY = ["coordinate_hash", "warming_scenario"]
+
+
+def sample_cells(ds, fraction, seed=0):
+    """A stratified sample of the (lon, lat) cells of a file: `fraction`
+    of the cells in each band of latitude, at least one per band.
+    Returns arrays of lon and lat positions."""
+    rng = np.random.default_rng(seed)
+    lats = ds["lat"].to_numpy()
+    bands = np.floor(lats / SAMPLE_BAND_DEGREES).astype("int64")
+    lon_count = ds.sizes["lon"]
+    lon_positions, lat_positions = [], []
+    for band in np.unique(bands):
+        band_lats = np.flatnonzero(bands == band)
+        cells = len(band_lats) * lon_count
+        picked = rng.choice(cells, size=max(1, math.ceil(cells * fraction)), replace=False)
+        lon_positions.append(picked // len(band_lats))
+        lat_positions.append(band_lats[picked % len(band_lats)])
+    return np.concatenate(lon_positions), np.concatenate(lat_positions)
+
+
+def file_frame(ds, cells=None):
+    """`to_dataframe()` of the whole file, or of just the (lon, lat)
+    `cells`, indexed by lon, lat and then the file's other dimensions,
+    without the all-NaN rows the importers drop."""
+    if cells is None:
+        return ds.to_dataframe().dropna(how="all")
+    lon_positions, lat_positions = cells
+    picked = ds.isel(
+        lon=xarray.DataArray(lon_positions, dims="cell"), lat=xarray.DataArray(lat_positions, dims="cell")
+    )
+    others = [dim for dim in ds.dims if dim not in ("lon", "lat")]
+    df = picked.to_dataframe().reset_index().set_index(["lon", "lat"] + others)
+    return df[list(ds.data_vars)].dropna(how="all")
+
+
+def database_frame(cursor, dataset_id, hashes=None):
+    """The dataset's rows of `pf_dataset_statistics` (only those of the
+    coordinate `hashes`, if given), COPYed out as CSV."""
+    query = cursor.mogrify(
+        "SELECT coordinate_hash, warming_scenario, low_value, mid_value, high_value FROM {} "
+        "WHERE dataset_id = %s".format(STATISTICS_TABLE),
+        (int(dataset_id),),
+    ).decode()
+    if hashes is not None:
+        query += cursor.mogrify(" AND coordinate_hash = ANY(%s)", (list(hashes),)).decode()
+    buffer = io.BytesIO()
+    cursor.copy_expert("COPY ({}) TO STDOUT WITH CSV".format(query), buffer)
+    buffer.seek(0)
+    return pandas.read_csv(
+        buffer,
+        names=KEY + STAT_VALUE_COLUMNS,
+        dtype={"coordinate_hash": str, "warming_scenario": str},
+        keep_default_na=False,
+        na_values=[""],
+    )
+
+
+def compare_stats(expected, actual, precision):
+    """Compare the stats converted from the file with the rows in the
+    database, per warming scenario. Returns the report of `verify`."""
+    merged = expected[KEY + STAT_VALUE_COLUMNS].merge(
+        actual, on=KEY, how="outer", suffixes=("_file", "_db"), indicator=True
+    )
+    both = merged["_merge"].to_numpy() == "both"
+    step = 10.0 ** -precision
+    columns = {
+        "rows_expected": merged["_merge"].to_numpy() != "right_only",
+        "rows_missing": merged["_merge"].to_numpy() == "left_only",
+        "rows_extra": merged["_merge"].to_numpy() == "right_only",
+    }
+    drift = np.zeros(len(merged), dtype=bool)
+    mismatched = np.zeros(len(merged), dtype=bool)
+    largest = np.zeros(len(merged))
+    for column in STAT_VALUE_COLUMNS:
+        file_values = merged[column + "_file"].to_numpy(dtype="float64", na_value=np.nan)
+        db_values = merged[column + "_db"].to_numpy(dtype="float64", na_value=np.nan)
+        difference = np.abs(file_values - db_values)
+        null_on_one_side = np.isnan(file_values) != np.isnan(db_values)
+        # A little slack for numbers that went through text.
+        differs = np.nan_to_num(difference) > 1e-9
+        within_step = np.nan_to_num(difference) <= step + 1e-9
+        drift |= both & differs & within_step
+        mismatched |= both & (null_on_one_side | (differs & ~within_step))
+        largest = np.fmax(largest, np.where(both, np.nan_to_num(difference), 0))
+    columns["rows_drifted"] = drift & ~mismatched
+    columns["rows_mismatched"] = mismatched
+    flags = pandas.DataFrame(columns).astype("int64")
+    flags["largest_difference"] = largest
+    flags["warming_scenario"] = merged["warming_scenario"].to_numpy()
+    grouped = flags.groupby("warming_scenario", sort=True).agg(
+        {name: "sum" for name in columns} | {"largest_difference": "max"}
+    )
+    scenarios = {
+        str(scenario): {
+            name: (float(value) if name == "largest_difference" else int(value)) for name, value in row.items()
+        }
+        for scenario, row in grouped.iterrows()
+    }
+
+    expected_cells = set(expected["coordinate_hash"].unique())
+    actual_cells = set(actual["coordinate_hash"].unique())
+    return {
+        "cells_expected": len(expected_cells),
+        "cells_missing": len(expected_cells - actual_cells),
+        "cells_extra": len(actual_cells - expected_cells),
+        "rows_compared": len(merged),
+        "scenarios": scenarios,
+    }
+
+
+def verify(cursor, cdf, file_path, table=None, sample=None, seed=0):
+    """Verify one `conf.yaml` dataset against its file, in full or (with
+    `sample`, a fraction) on a stratified sample of its cells."""
+    hashes = None
+    with xarray.open_dataset(file_path) as ds:
+        cells = None if sample is None else sample_cells(ds, sample, seed)
+        expected = to_stat_columns(cdf, file_frame(ds, cells), table)
+        if cells is not None:
+            # Every sampled cell, even the ones that are all NaN in the
+            # file, so stats the database shouldn't have turn up too.
+            lons = ds["lon"].to_numpy()[cells[0]] + 0
+            lats = ds["lat"].to_numpy()[cells[1]] + 0
+            hashes = to_hashes(cdf["grid"], lons, lats) if table is None else table.lookup(lons, lats)
+    if expected is None:
+        raise ValueError("Don't know how to verify a {} dataset".format(cdf["model"]))
+    actual = database_frame(cursor, cdf["dataset"], hashes)
+    report = compare_stats(expected, actual, lookup_unit(cdf["unit"]).precision)
+    report.update(dataset=int(cdf["dataset"]), sample=sample)
+    return report
+
+
+def problems(report):
+    """How many missing, extra or mismatched rows and cells a report has."""
+    count = report["cells_missing"] + report["cells_extra"]
+    for scenario in report["scenarios"].values():
+        count += scenario["rows_missing"] + scenario["rows_extra"] + scenario["rows_mismatched"]
+    return count
+
+
+def print_report(report):
+    print(
+        "[Notice] {}: {:,} cells{}; {:,} missing from the database, {:,} extra".format(
+            report["dataset"],
+            report["cells_expected"],
+            "" if report["sample"] is None else " (a {:g} sample)".format(report["sample"]),
+            report["cells_missing"],
+            report["cells_extra"],
+        )
+    )
+    for scenario, counts in report["scenarios"].items():
+        print(
+            "[{}] {} {}: {:,} rows, {:,} missing, {:,} extra, {:,} mismatched, {:,} drifted, "
+            "largest difference {:g}".format(
+                "Error" if counts["rows_missing"] + counts["rows_extra"] + counts["rows_mismatched"] else "Notice",
+                report["dataset"],
+                scenario,
+                counts["rows_expected"],
+                counts["rows_missing"],
+                counts["rows_extra"],
+                counts["rows_mismatched"],
+                counts["rows_drifted"],
+                counts["largest_difference"],
+            )
+        )
+
+
+@click.command()
+@click.option("--conf", default="conf.yaml", help='YAML config file, default "conf.yaml"')
+@click.option(
+    "--dataset-id",
+    "dataset_ids",
+    multiple=True,
+    type=int,
+    help="Verify this dataset (repeat for more); default every dataset in the config",
+)
+@click.option(
+    "--hash-tables",
+    default="hashes",
+    help='Directory of per-grid coordinate hash tables built by --load-coordinates, default "hashes"',
+)
+@click.option("--dbhost", default="localhost", help='Postgresql host/server name, default "localhost"')
+@click.option("--dbname", default="probable_futures", help='Postgresql database name, default "probable_futures"')
+@click.option("--dbuser", nargs=1, help="Postgresql username")
+@click.option("--dbpassword", nargs=1, help="Postgresql password")
+@click.option(
+    "--sample",
+    type=float,
+    default=None,
+    help="Verify only this fraction of the cells (e.g. 0.01), sampled in every {}-degree band of latitude;".format(
+        SAMPLE_BAND_DEGREES
+    )
+    + " default all of them",
+)
+@click.option("--seed", type=int, default=0, help="Random seed for --sample, default 0")
+@click.option("--report", default=None, help="Also write the report, as JSON, to this file")
+def __main__(conf, dataset_ids, hash_tables, dbhost, dbname, dbuser, dbpassword, sample, seed, report):
+    from sqlalchemy import create_engine
+
+    if sample is not None and not 0 < sample <= 1:
+        raise click.BadParameter("--sample has to be a fraction between 0 and 1")
+    with open(conf) as f:
+        conf = safe_load(f)
+    datasets = conf["datasets"]
+    if dataset_ids:
+        known = {int(cdf["dataset"]) for cdf in datasets}
+        for dataset_id in dataset_ids:
+            if dataset_id not in known:
+                raise NoDatasetWithThatIDError(dataset_id)
+        datasets = [cdf for cdf in datasets if int(cdf["dataset"]) in dataset_ids]
+    tables = load_hash_tables(hash_tables, conf)
+
+    engine = create_engine("postgresql://" + dbuser + ":" + dbpassword + "@" + dbhost + "/" + dbname)
+    connection = engine.raw_connection()
+    reports = []
+    try:
+        for cdf in datasets:
+            started = time.perf_counter()
+            with connection.cursor() as cursor:
+                result = verify(cursor, cdf, cdf["filename"], tables.get(cdf["grid"]), sample, seed)
+            connection.rollback()
+            print_report(result)
+            report_throughput("Verified {}".format(cdf["dataset"]), result["rows_compared"], started)
+            reports.append(result)
+    finally:
+        connection.close()
+
+    if report:
+        directory = os.path.dirname(report)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(report, "w") as f:
+            json.dump(reports, f, indent=2)
+        print("[Notice] Wrote the verification report to {}".format(report))
+    if sum(problems(r) for r in reports):
+        print("[Error] The database doesn't match the files")
+        exit(1)
+
+
+if __name__ == "__main__":
+    __main__()
@@ -0,0 +1,207 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from rich import print
+
+"""
+Per-stage profiling for the importers (`--profile`). Each stage of
+each dataset (opening the file, `to_dataframe()`, hashing, building
+stats, rendering, deleting, COPY, commit) is recorded with its wall
+time, the CPU time of the thread that ran it, the rows it handled and
+the memory high-water mark while it ran:
+
+- peak RSS of the process. On Linux we reset the kernel's high-water
+  mark at the start of each stage, so it's the peak of that stage;
+  elsewhere it's the peak of the process so far.
+- with `trace_memory`, the peak of Python/NumPy allocations seen by
+  tracemalloc. This is more precise but slows everything down.
+
+Stages that run at the same time in one process (several database
+connections) share the process's memory numbers.
+
+Stages that run in worker processes are recorded there and sent back
+with the piece they belong to; `Profiler.add` merges them.
+
+"""
+
+_CLEAR_REFS = "/proc/self/clear_refs"
+_STATUS = "/proc/self/status"
+
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM, Linux only.
+    try:
+        with open(_CLEAR_REFS, "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_bytes():
+    try:
+        with open(_STATUS) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes everywhere else.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Profiler:
+    """Records stages while `enabled`; otherwise `stage()` costs next to
+    nothing. With `cprofile_stage` set, every run of that stage is also
+    run under cProfile and dumped to `cprofile_dir`."""
+
+    def __init__(self, enabled=False, trace_memory=False, cprofile_stage=None, cprofile_dir="."):
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        self.cprofile_stage = cprofile_stage
+        self.cprofile_dir = cprofile_dir
+        self.records = []
+        self._lock = threading.Lock()
+        self._dumps = 0
+        if enabled and trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def settings(self):
+        """What a worker process needs to build the same profiler."""
+        return {
+            "enabled": self.enabled,
+            "trace_memory": self.trace_memory,
+            "cprofile_stage": self.cprofile_stage,
+            "cprofile_dir": self.cprofile_dir,
+        }
+
+    @contextmanager
+    def stage(self, dataset, name, rows=None):
+        """Time a stage. Yields the record, so the caller can fill in
+        `rows` once it knows them."""
+        record = {"dataset": dataset, "stage": name, "rows": rows}
+        if not self.enabled:
+            yield record
+            return
+
+        profile = None
+        if name == self.cprofile_stage:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Only one profiler at a time, e.g. another thread has it.
+                profile = None
+        exact_rss = _reset_peak_rss()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            traced_before = tracemalloc.get_traced_memory()[0]
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = time.perf_counter() - wall
+            record["cpu_seconds"] = time.thread_time() - cpu
+            record["peak_rss_bytes"] = _peak_rss_bytes()
+            record["peak_rss_is_per_stage"] = exact_rss
+            if self.trace_memory:
+                record["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1] - traced_before
+            record["pid"] = os.getpid()
+            if profile is not None:
+                profile.disable()
+                record["cprofile"] = self._dump(profile, dataset, name)
+            with self._lock:
+                self.records.append(record)
+
+    def _dump(self, profile, dataset, name):
+        with self._lock:
+            self._dumps += 1
+            n = self._dumps
+        os.makedirs(self.cprofile_dir, exist_ok=True)
+        path = os.path.join(
+            self.cprofile_dir, "{}-{}-{}-{}.prof".format(dataset, name, os.getpid(), n)
+        )
+        profile.dump_stats(path)
+        return path
+
+    def take(self):
+        """Hand over (and forget) what's been recorded so far."""
+        with self._lock:
+            records, self.records = self.records, []
+        return records
+
+    def add(self, records):
+        """Merge records from another process."""
+        with self._lock:
+            self.records.extend(records)
+
+
+def summarize(records):
+    """Total each stage per dataset: calls, wall and CPU seconds, rows,
+    and the highest memory marks seen."""
+    datasets = {}
+    for record in records:
+        stages = datasets.setdefault(str(record["dataset"]), {})
+        total = stages.setdefault(
+            record["stage"],
+            {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "rows": 0, "peak_rss_bytes": 0},
+        )
+        total["calls"] += 1
+        total["wall_seconds"] += record["wall_seconds"]
+        total["cpu_seconds"] += record["cpu_seconds"]
+        total["rows"] += record["rows"] or 0
+        total["peak_rss_bytes"] = max(total["peak_rss_bytes"], record["peak_rss_bytes"] or 0)
+        if "peak_traced_bytes" in record:
+            total["peak_traced_bytes"] = max(
+                total.get("peak_traced_bytes", 0), record["peak_traced_bytes"]
+            )
+    return datasets
+
+
+def write_report(path, profiler, options):
+    """Write the JSON report of a run: the options it ran with, the
+    per-dataset summary and every stage record."""
+    records = profiler.take()
+    report = {
+        "finished": datetime.now(timezone.utc).isoformat(),
+        "argv": sys.argv,
+        "options": options,
+        "peak_rss_bytes": _peak_rss_bytes(),
+        "datasets": summarize(records),
+        "records": records,
+    }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print("[Notice] Wrote the profile of this run to {}".format(path))
+    for dataset, stages in report["datasets"].items():
+        for name, total in stages.items():
+            print(
+                "[Notice] {} {}: {:.2f}s wall, {:.2f}s CPU, {:,} rows, peak RSS {:,.0f} MB".format(
+                    dataset,
+                    name,
+                    total["wall_seconds"],
+                    total["cpu_seconds"],
+                    total["rows"],
+                    total["peak_rss_bytes"] / 2 ** 20,
+                )
+            )
+    return report
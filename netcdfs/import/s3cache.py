@@ -0,0 +1,217 @@
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from hashlib import sha256
+
+from rich import print
+
+"""
+A local cache of the netCDF files we download from S3. Warm Lambda
+containers and repeated batch runs load the same multi-GB file over
+and over, so we keep each download on disk under a name made from its
+bucket, key and ETag. Before reusing an entry we HEAD the object, which
+is cheap, and if the ETag has changed the object is downloaded again
+under a new name.
+
+The cache is capped at `max_bytes`; when a download needs room the
+least recently used entries go first. Every entry has two lock files:
+`.lock` is held while it's checked and downloaded, so two processes
+(or threads) that want the same object wait for one download instead
+of both fetching it, and `fetch()` takes a shared lock on `.use` that
+it holds until `release()` (or the process exits), so an entry that's
+being downloaded or read is never evicted. Eviction only takes
+entries whose `.use` lock it can get exclusively. (The lock files stay
+behind when an entry goes; they're empty.)
+
+"""
+
+# The cache dir and its cap can be set from the environment, e.g. to
+# match the ephemeral storage given to the Lambda function.
+CACHE_DIR = os.environ.get("PF_S3_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pf-netcdf-cache"))
+CACHE_MB = os.environ.get("PF_S3_CACHE_MB")
+
+
+def _entry_name(bucket, key, etag):
+    return sha256("{}/{}/{}".format(bucket, key, etag).encode()).hexdigest()
+
+
+@contextmanager
+def _locked(path, blocking=True):
+    """Hold an exclusive flock on `path`. Yields False instead of
+    waiting if `blocking` is off and someone else has it (exclusive or
+    shared)."""
+    with open(path, "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class S3Cache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=None, client=None):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        if max_bytes is None:
+            if CACHE_MB:
+                max_bytes = int(float(CACHE_MB) * 2 ** 20)
+            else:
+                # What the cache could grow to is the free space plus
+                # what it already holds; leave a fifth of that for
+                # everything else in /tmp.
+                cached = sum(size for _, size, _ in self.entries())
+                max_bytes = int((shutil.disk_usage(directory).free + cached) * 0.8)
+        self.max_bytes = max_bytes
+        if client is None:
+            import boto3
+
+            client = boto3.client("s3")
+        self.client = client
+        # Entry name -> the open `.use` file its shared lock is held on.
+        self._in_use = {}
+
+    def _path(self, name, suffix):
+        return os.path.join(self.directory, name + suffix)
+
+    def entries(self):
+        """(name, size, last used) of every complete entry, least
+        recently used first."""
+        found = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".nc"):
+                continue
+            name = filename[: -len(".nc")]
+            try:
+                stat = os.stat(self._path(name, ".nc"))
+            except FileNotFoundError:
+                continue
+            found.append((name, stat.st_size, stat.st_mtime))
+        return sorted(found, key=lambda entry: entry[2])
+
+    def _remove(self, name):
+        for suffix in (".nc", ".json"):
+            try:
+                os.remove(self._path(name, suffix))
+            except FileNotFoundError:
+                pass
+
+    def _make_room(self, size, keep):
+        """Evict least recently used entries until `size` more bytes
+        fit under the cap. Entries someone holds the lock of are left
+        alone."""
+        entries = self.entries()
+        used = sum(entry_size for _, entry_size, _ in entries)
+        for name, entry_size, _ in entries:
+            if used + size <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            with _locked(self._path(name, ".use"), blocking=False) as locked:
+                if not locked:
+                    continue
+                print("[Notice] Evicting {} from the download cache".format(name))
+                self._remove(name)
+                used -= entry_size
+        if used + size > self.max_bytes:
+            print(
+                "[Notice] The download cache is over its cap of {:,} bytes; files in use can't be evicted".format(
+                    self.max_bytes
+                )
+            )
+
+    def _drop_old_versions(self, bucket, key, keep):
+        # Other ETags of the same object won't be asked for again, so
+        # they're the first to go.
+        for name, _, _ in self.entries():
+            if name == keep:
+                continue
+            try:
+                with open(self._path(name, ".json")) as f:
+                    meta = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            if meta.get("bucket") == bucket and meta.get("key") == key:
+                with _locked(self._path(name, ".use"), blocking=False) as locked:
+                    if locked:
+                        self._remove(name)
+
+    def _hold(self, name):
+        # A shared lock on `.use`, so the entry can't be evicted. Taken
+        # before the entry is looked at; an eviction holds the
+        # exclusive lock only while it deletes.
+        if name not in self._in_use:
+            f = open(self._path(name, ".use"), "a")
+            fcntl.flock(f, fcntl.LOCK_SH)
+            self._in_use[name] = f
+
+    def release(self, path=None):
+        """Let the entry at `path` (default every entry this cache has
+        fetched) be evicted again. Call it once nothing reads the file
+        any more."""
+        for name in list(self._in_use):
+            if path is None or self._path(name, ".nc") == path:
+                f = self._in_use.pop(name)
+                fcntl.flock(f, fcntl.LOCK_UN)
+                f.close()
+
+    @contextmanager
+    def using(self, bucket, key):
+        """`fetch()` s3://bucket/key and `release()` it afterwards."""
+        path = self.fetch(bucket, key)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    def fetch(self, bucket, key):
+        """Path to a local copy of s3://bucket/key, downloading it only
+        if the cache doesn't have this version of it. The entry is held
+        in use, and won't be evicted, until `release()`."""
+        head = self.client.head_object(Bucket=bucket, Key=key)
+        name = _entry_name(bucket, key, head["ETag"].strip('"'))
+        path = self._path(name, ".nc")
+
+        self._hold(name)
+        try:
+            self._fetch(bucket, key, head, name, path)
+        except BaseException:
+            self.release(path)
+            raise
+        return path
+
+    def _fetch(self, bucket, key, head, name, path):
+        etag = head["ETag"].strip('"')
+        size = head["ContentLength"]
+        with _locked(self._path(name, ".lock")):
+            if os.path.exists(path) and os.path.getsize(path) == size:
+                print("[Notice] Using the cached download of s3://{}/{}".format(bucket, key))
+                # Its mtime is when it was last used, for eviction.
+                os.utime(path, (time.time(), time.time()))
+                return
+
+            self._remove(name)
+            self._drop_old_versions(bucket, key, keep=name)
+            self._make_room(size, keep=name)
+            print("[Notice] Downloading s3://{}/{} ({:,} bytes)".format(bucket, key, size))
+            partial = self._path(name, ".part")
+            try:
+                # On a versioned bucket, make sure we get the version we
+                # HEADed; elsewhere the size has to match at least.
+                extra = {"VersionId": head["VersionId"]} if head.get("VersionId") else None
+                self.client.download_file(bucket, key, partial, ExtraArgs=extra)
+                if os.path.getsize(partial) != size:
+                    raise IOError("s3://{}/{} changed while it was being downloaded".format(bucket, key))
+                with open(self._path(name, ".json"), "w") as f:
+                    json.dump({"bucket": bucket, "key": key, "etag": etag, "size": size}, f)
+                os.replace(partial, path)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
@@ -0,0 +1,216 @@
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import xarray
+from pandas import concat
+
+from bulk import render_statistics
+from helpers import hash_index
+from profiling import Profiler
+from statcache import load_frame, save_frame
+from stats import build_stat_columns
+
+"""
+Runs the imports of many datasets at once. Reading and converting a
+file is CPU work, so it goes to a pool of worker processes, one piece
+of a file per task; loading is mostly waiting on Postgres, so it runs
+on a few threads with a database connection each. While one dataset
+is being COPYed the next ones are already being converted.
+
+Each dataset is still loaded by one call on one thread (so in one
+transaction), its pieces arrive in file order, and if a dataset fails
+the others carry on; `run_imports` hands the failures back at the end.
+
+"""
+
+# Set in each worker process by `init_worker`.
+_hash_tables = {}
+_open_files = {}
+_profiler = Profiler()
+
+
+def init_worker(hash_tables, profile_settings=None):
+    global _hash_tables, _profiler
+    _hash_tables = hash_tables
+    _profiler = Profiler(**(profile_settings or {}))
+
+
+def _open(cdf, file_path):
+    # Keep each file open in the worker between its pieces.
+    if file_path not in _open_files:
+        with _profiler.stage(cdf["dataset"], "open"):
+            _open_files[file_path] = xarray.open_dataset(file_path)
+    return _open_files[file_path]
+
+
+def convert_piece(cdf, file_path, indexers, limit=None, cache_piece=None):
+    """Read and convert the `isel()` indexers of a file in turn (None
+    for the whole file) and render the stats as CSV for COPY. Stops
+    once `limit` rows have been converted. With `cache_piece` the stats
+    are also saved there for the stat cache; with `indexers` None they
+    are read from that piece instead of the file. Runs in a worker
+    process. Returns the output of `render_statistics` (or None if
+    there is nothing to load) and the profile records of the piece."""
+    if indexers is None:
+        return _load_cached(cdf, cache_piece), _profiler.take()
+    return _convert(cdf, file_path, indexers, limit, cache_piece), _profiler.take()
+
+
+def _render(dataset, frames):
+    rows, chunks = 0, []
+    with _profiler.stage(dataset, "render") as stage:
+        for stats in frames:
+            piece_rows, piece_chunks = render_statistics(stats)
+            rows += piece_rows
+            chunks += piece_chunks
+        stage["rows"] = rows
+    return rows, chunks
+
+
+def _load_cached(cdf, cache_piece):
+    with _profiler.stage(cdf["dataset"], "cache_read") as stage:
+        stats = load_frame(cache_piece)
+        stage["rows"] = 0 if stats is None else len(stats)
+    if stats is None:
+        return None
+    return _render(cdf["dataset"], [stats])
+
+
+def _convert(cdf, file_path, indexers, limit, cache_piece):
+    dataset = cdf["dataset"]
+    ds = _open(cdf, file_path)
+    frames = []
+    remaining = limit
+    for indexer in indexers:
+        with _profiler.stage(dataset, "to_dataframe") as stage:
+            part = ds if indexer is None else ds.isel(indexer)
+            # We drop all the Na* values. This is verrrrry fast in a
+            # dataframe.
+            df = part.to_dataframe().dropna(how="all")
+            stage["rows"] = len(df)
+        if remaining is not None:
+            df = df.head(remaining)
+            remaining -= len(df)
+        if len(df) > 0:
+            with _profiler.stage(dataset, "hash", len(df)):
+                df = df.assign(
+                    coordinate_hash=hash_index(df, cdf["grid"], _hash_tables.get(cdf["grid"]))
+                )
+            with _profiler.stage(dataset, "stats") as stage:
+                stats = build_stat_columns(cdf, df)
+                stage["rows"] = 0 if stats is None else len(stats)
+            if stats is None:
+                return None
+            frames.append(stats)
+        if remaining == 0:
+            break
+    if cache_piece is not None:
+        with _profiler.stage(dataset, "cache_write", sum(len(stats) for stats in frames)):
+            save_frame(cache_piece, concat(frames, ignore_index=True) if frames else None)
+    if not frames:
+        return None
+    return _render(dataset, frames)
+
+
+class InlineExecutor:
+    """Stands in for the process pool with --cpu-workers 0: every task
+    runs right away, in this process. Handy where there's no
+    multiprocessing, e.g. on Lambda."""
+
+    def __init__(self, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+def run_imports(jobs, load, cpu_workers, db_workers, initializer=None, initargs=()):
+    """Run a list of (key, tasks) jobs, where each task is a tuple of
+    arguments for `convert_piece`. Tasks run on `cpu_workers`
+    processes; `load(key, pieces)` is called once per job on one of
+    `db_workers` threads, with an iterator of that job's converted
+    pieces in order. At most twice as many pieces as there are CPU
+    workers are held in memory at once.
+
+    Returns a list of (key, exception) for the jobs that failed, either
+    in a conversion or in `load`."""
+    if cpu_workers > 0:
+        # Workers are started from scratch rather than forked, since by
+        # now this process has threads (the loaders, the progress bar)
+        # whose locks a fork could copy mid-use.
+        converters = ProcessPoolExecutor(
+            cpu_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=initializer,
+            initargs=initargs,
+        )
+    else:
+        converters = InlineExecutor(initializer, initargs)
+    loaders = ThreadPoolExecutor(max(1, db_workers))
+    slots = threading.BoundedSemaphore(2 * max(1, cpu_workers))
+    failures = []
+
+    def run_load(key, pending, finished):
+        drained = False
+
+        def pieces():
+            nonlocal drained
+            while True:
+                future = pending.get()
+                if future is None:
+                    drained = True
+                    return
+                try:
+                    piece = future.result()
+                finally:
+                    slots.release()
+                yield piece
+
+        try:
+            load(key, pieces())
+        except Exception as e:
+            failures.append((key, e))
+        finally:
+            # Tell the feeder to stop, then throw away whatever of this
+            # job it had already queued.
+            finished.set()
+            while not drained:
+                future = pending.get()
+                if future is None:
+                    drained = True
+                    break
+                future.cancel()
+                slots.release()
+
+    try:
+        loads = []
+        for key, tasks in jobs:
+            pending = queue.Queue()
+            finished = threading.Event()
+            # Loads are queued in the same order as their pieces, so the
+            # job holding the oldest pieces always has a thread.
+            loads.append(loaders.submit(run_load, key, pending, finished))
+            for task in tasks:
+                slots.acquire()
+                if finished.is_set():
+                    slots.release()
+                    break
+                pending.put(converters.submit(convert_piece, *task))
+            pending.put(None)
+        for future in loads:
+            future.result()
+    finally:
+        loaders.shutdown()
+        converters.shutdown(cancel_futures=True)
+    return failures
@@ -0,0 +1,120 @@
+import json
+import os
+
+import numpy as np
+from pandas import DataFrame, concat
+
+from coordinates import digests_to_hex, hex_to_digests
+
+"""
+A cache of converted stats, so loading the same file into the local,
+development and production databases converts it only once. Pass
+`--stat-cache DIR` to `pfimport.py`, `pfimport-new.py` or
+`pfupdate.py`: the first run converts the file as usual and also
+writes the stats columns to DIR; every later run with the same file
+and `conf.yaml` entry reads them back instead of opening the netCDF.
+
+An entry is keyed by what made it (`kind`: "stats" for `pfimport.py`,
+"values" for the percentile loaders), the fingerprint of the file and
+its conf entry (`helpers.file_fingerprint`), and the `--chunk-size`
+it was cut into, so it comes back in the same pieces. Each piece is
+a compressed .npz of columns: coordinate hashes as raw 16-byte
+digests, labels like the warming scenario as codes into a list of
+labels, numbers as they are. The entry only counts once its manifest
+is written, after every piece is in.
+
+"""
+
+STAT_CACHE_KINDS = ["stats", "values"]
+
+
+def save_frame(path, frame):
+    """Write a frame of stats (or None, for a piece with no stats) to
+    `path` as compressed columns."""
+    arrays = {}
+    if frame is None:
+        arrays["empty"] = np.array(True)
+    else:
+        arrays["columns"] = np.array(list(frame.columns))
+        for i, name in enumerate(frame.columns):
+            values = frame[name].to_numpy()
+            if name == "coordinate_hash":
+                arrays["hash_{}".format(i)] = hex_to_digests(values)
+            elif values.dtype == object:
+                labels, codes = np.unique(values.astype(str), return_inverse=True)
+                arrays["labels_{}".format(i)] = labels
+                arrays["codes_{}".format(i)] = codes.astype("int32")
+            else:
+                arrays["values_{}".format(i)] = values
+    partial = path + ".part.npz"
+    np.savez_compressed(partial, **arrays)
+    os.replace(partial, path)
+
+
+def load_frame(path):
+    """Read back a frame written by `save_frame`."""
+    with np.load(path, allow_pickle=False) as f:
+        if "empty" in f:
+            return None
+        columns = {}
+        for i, name in enumerate(f["columns"].tolist()):
+            if "hash_{}".format(i) in f:
+                columns[name] = digests_to_hex(f["hash_{}".format(i)])
+            elif "labels_{}".format(i) in f:
+                columns[name] = f["labels_{}".format(i)].astype(object)[f["codes_{}".format(i)]]
+            else:
+                columns[name] = f["values_{}".format(i)]
+    return DataFrame(columns)
+
+
+class StatCache:
+    """One entry of the cache in `directory`."""
+
+    def __init__(self, directory, kind, fingerprint, chunk_size=None):
+        self.path = os.path.join(
+            directory, "{}-{}-{}".format(kind, fingerprint[:32], chunk_size or "whole")
+        )
+        self.manifest_path = os.path.join(self.path, "manifest.json")
+
+    def piece_path(self, i):
+        return os.path.join(self.path, "{:06d}.npz".format(i))
+
+    def prepare(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def pieces(self):
+        """How many pieces the entry has, or None if it isn't complete."""
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)["pieces"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def finish(self, pieces, **details):
+        """Mark the entry complete, if all of its `pieces` are there
+        (a run that didn't convert every piece, e.g. a resumed one,
+        leaves it incomplete). Returns whether it did."""
+        if not all(os.path.exists(self.piece_path(i)) for i in range(pieces)):
+            return False
+        partial = self.manifest_path + ".part"
+        with open(partial, "w") as f:
+            json.dump(dict(details, pieces=pieces), f, default=str)
+        os.replace(partial, self.manifest_path)
+        return True
+
+    def read(self):
+        """The whole cached frame, or None if the entry isn't complete
+        or has no stats."""
+        pieces = self.pieces()
+        if pieces is None:
+            return None
+        frames = [frame for frame in map(load_frame, map(self.piece_path, range(pieces))) if frame is not None]
+        if not frames:
+            return None
+        return frames[0] if len(frames) == 1 else concat(frames, ignore_index=True)
+
+    def write(self, frame, **details):
+        """Cache a whole frame as one piece."""
+        self.prepare()
+        save_frame(self.piece_path(0), frame)
+        self.finish(1, **details)
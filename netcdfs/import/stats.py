@@ -0,0 +1,148 @@
+import re
+
+import numpy as np
+from pandas import DataFrame
+
+from helpers import factorize, hash_index
+from units import lookup_unit
+
+"""
+Column-oriented stat builders. These take the dataframe of one file
+(or one piece of it) with its `coordinate_hash` column already filled
+in and produce the rows of `pf_dataset_statistics` as whole columns,
+so there's no dict per row and no process pool to pickle records
+through. Values are converted per unit by the registry in `units.py`,
+which gives exactly what the old per-row builders sent through
+`stat_fmt`.
+
+"""
+
+# CMIP files have one variable per warming scenario, listed in this
+# order in conf.yaml.
+CMIP_SCENARIOS = ["0.5", "1.0", "1.5", "2.0", "2.5", "3.0"]
+
+# Warming scenario -> the name the map properties use for it, as in
+# data_1_5c_mid (see pf_private.aggregate_pf_dataset_statistics).
+SCENARIO_NAMES = {"0.5": "baseline", "1.0": "1c", "1.5": "1_5c", "2.0": "2c", "2.5": "2_5c", "3.0": "3c"}
+
+
+def scenario_labels(warming_levels):
+    """`str()` of each warming level, e.g. 0.5 -> "0.5", computed once
+    per distinct level."""
+    distinct, inverse = factorize(np.asarray(warming_levels))
+    labels = np.array([str(v) for v in distinct], dtype=object)
+    return labels[inverse]
+
+
+def _values(df, name, conversion):
+    if name not in df:
+        return np.full(len(df), np.nan)
+    return conversion.convert(df[name].to_numpy())
+
+
+def to_remo_columns(df, dataset_id, unit):
+    """Columnar `to_remo_stat`: one row per (lon, lat, warming level)
+    with the file's variables already renamed to low/mid/high_value.
+    Variables missing from the file come out NULL."""
+    conversion = lookup_unit(unit)
+    return DataFrame(
+        {
+            "dataset_id": np.full(len(df), int(dataset_id), dtype="int64"),
+            "coordinate_hash": df["coordinate_hash"].to_numpy(),
+            "warming_scenario": scenario_labels(df.index.get_level_values(2)),
+            "low_value": _values(df, "low_value", conversion),
+            "mid_value": _values(df, "mid_value", conversion),
+            "high_value": _values(df, "high_value", conversion),
+        }
+    )
+
+
+def to_cmip_columns(df, dataset_id, unit, variables):
+    """Columnar `to_cmip_stats`: every (lon, lat) row fans out to one
+    mid_value per warming scenario, taken from `variables` in
+    `CMIP_SCENARIOS` order."""
+    rows = len(df) * len(CMIP_SCENARIOS)
+    raw = np.column_stack([df[name].to_numpy() for name in variables])
+    mids = lookup_unit(unit).convert(raw.reshape(-1))
+    return DataFrame(
+        {
+            "dataset_id": np.full(rows, int(dataset_id), dtype="int64"),
+            "coordinate_hash": np.repeat(
+                df["coordinate_hash"].to_numpy(), len(CMIP_SCENARIOS)
+            ),
+            "warming_scenario": np.tile(
+                np.array(CMIP_SCENARIOS, dtype=object), len(df)
+            ),
+            "low_value": np.full(rows, np.nan),
+            "mid_value": mids,
+            "high_value": np.full(rows, np.nan),
+        }
+    )
+
+
+def to_stat_columns(cdf, df, table=None):
+    """The stats of one `conf.yaml` dataset, from the dataframe of its
+    file (or a piece of it): hash every lon/lat in one go, gathering
+    from the grid's `GridHashTable` if we have one, then build the
+    columns for the dataset's model. Returns None for a model we don't
+    know how to load."""
+    df = df.assign(coordinate_hash=hash_index(df, cdf["grid"], table))
+    return build_stat_columns(cdf, df)
+
+
+def build_stat_columns(cdf, df):
+    """The second half of `to_stat_columns`, for a dataframe that
+    already has its `coordinate_hash` column."""
+    if cdf["model"] == "GCM, CMIP5":
+        # One variable per warming scenario, in order.
+        variables = [var["name"] for var in cdf["variables"]]
+        return to_cmip_columns(df, cdf["dataset"], cdf["unit"], variables)
+    elif cdf["model"] == "global RegCM and REMO" or cdf["model"] == "global REMO":
+        # We use the variables from the yaml file and rename those
+        # columns to the method, i.e. low_value, mid_value or
+        # high_value. Any that aren't in the netcdf file end up NULL.
+        renames = {var["name"]: var["method"] for var in cdf["variables"]}
+        return to_remo_columns(df.rename(columns=renames), cdf["dataset"], cdf["unit"])
+    return None
+
+
+# Percentile files (filename_new) hold perc_0 ... perc_100 variables
+# that go into the `values` numeric[] column.
+PERCENTILE_VARIABLE = re.compile(r"^perc_\d{1,3}$")
+
+
+def percentile_names(columns):
+    return [name for name in columns if PERCENTILE_VARIABLE.match(name)]
+
+
+def percentile_frame(ds):
+    """Stack the perc_* variables of a dataset into one (cells x
+    percentiles) array, indexed like `to_dataframe()`, and drop the
+    cells where every percentile is NaN."""
+    names = percentile_names(ds.data_vars)
+    dims = list(ds.dims)
+    matrix = (
+        ds[names]
+        .to_array(dim="percentile")
+        .transpose(*dims, "percentile")
+        .values.reshape(-1, len(names))
+    )
+    keep = ~np.isnan(matrix).all(axis=1)
+    index = ds.coords.to_index(dims)[keep]
+    return DataFrame(matrix[keep], index=index, columns=names)
+
+
+def to_percentile_columns(df, dataset_id, unit):
+    """Columnar percentile stats: the dataset_id, coordinate_hash and
+    warming_scenario key columns followed by one converted column per
+    percentile, in file order. NaN percentiles are left out of that
+    row's `values` array when it's written (see `bulk.copy_values`)."""
+    conversion = lookup_unit(unit)
+    columns = {
+        "dataset_id": np.full(len(df), int(dataset_id), dtype="int64"),
+        "coordinate_hash": df["coordinate_hash"].to_numpy(),
+        "warming_scenario": scenario_labels(df.index.get_level_values(2)),
+    }
+    for name in percentile_names(df.columns):
+        columns[name] = conversion.convert(df[name].to_numpy())
+    return DataFrame(columns)
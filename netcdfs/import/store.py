@@ -0,0 +1,194 @@
+import json
+import os
+
+import numpy as np
+from rich import print
+
+from coordinates import GridHashTable, digests_to_hex
+from enrich import DatasetArrays, Enricher, GridIndex
+
+"""
+A read-only, memory-mapped copy of the stats for serving lookups
+without the database. `pfimport.py --store DIR` (and
+`pfimport-new.py --store DIR` for percentile files) writes it next to
+the load, and `Store(DIR)` reads it:
+
+    DIR/
+      RCM/
+        lon.npy, lat.npy   the grid's axes from conf.yaml
+        digests.npy        (lon, lat, 16) md5 digests: the coordinate
+                           hash of every cell, as in GridHashTable
+        20101.npy          (columns, cells + 1) float32, converted the
+                           way pfimport.py converts it, NaN where there's
+                           no data, plus a NaN cell on the end
+        20101.json         the dataset's (warming scenario, method) of
+                           each column, its unit and name
+      GCM/
+        ...
+
+The axes and digests are the cell index every dataset on that grid
+shares; cell n of a dataset is lon n // len(lat), lat n % len(lat), so
+`enrich.GridIndex` snaps points straight to rows. Readers open the
+`.npy` files with `np.load(mmap_mode="r")`, so a dataset is a NumPy
+view of the page cache: nothing is read until it's looked at, opening
+a store costs the same however many datasets are in it, and every
+process on the host shares the one copy in memory.
+
+Every file is written next to its final name and renamed into place,
+the array before its `.json`, so a reader never sees half a dataset;
+one that already has a dataset open keeps the old file until it opens
+it again.
+
+"""
+
+STORE_VERSION = 1
+
+
+def _replace_npy(path, array):
+    np.save(path + ".part.npy", array)
+    os.replace(path + ".part.npy", path)
+
+
+class Store:
+    """The memory-mapped stats in `directory`."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._grids = {}
+
+    def _path(self, grid, name):
+        return os.path.join(self.directory, grid, name)
+
+    def grids(self):
+        """The grids in the store."""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            grid
+            for grid in os.listdir(self.directory)
+            if os.path.exists(self._path(grid, "digests.npy"))
+        )
+
+    def datasets(self, grid=None):
+        """The dataset ids in the store (on `grid`, if given)."""
+        ids = []
+        for name in [grid] if grid is not None else self.grids():
+            ids.extend(
+                int(file[: -len(".json")])
+                for file in os.listdir(os.path.join(self.directory, name))
+                if file.endswith(".json")
+            )
+        return sorted(ids)
+
+    def grid(self, grid):
+        """The `enrich.GridIndex` of a grid, over its mapped axes."""
+        if grid not in self._grids:
+            self._grids[grid] = GridIndex(
+                grid,
+                np.load(self._path(grid, "lon.npy"), mmap_mode="r"),
+                np.load(self._path(grid, "lat.npy"), mmap_mode="r"),
+            )
+        return self._grids[grid]
+
+    def hashes(self, grid, cells):
+        """The coordinate hash of each of the flat cell numbers `cells`
+        of a grid."""
+        digests = np.load(self._path(grid, "digests.npy"), mmap_mode="r")
+        return digests_to_hex(digests.reshape(-1, 16)[np.asarray(cells)])
+
+    def matches(self, grid_conf):
+        """Whether the store has the grid with the same axes as the
+        `conf.yaml` grid."""
+        grid = grid_conf["grid"]
+        if grid not in self.grids():
+            return False
+        index = self.grid(grid)
+        return np.array_equal(index.lon, grid_conf["lon"]) and np.array_equal(index.lat, grid_conf["lat"])
+
+    def write_grid(self, grid_conf, table=None):
+        """Write the cell index of a `conf.yaml` grid, hashed from
+        `table` (a `GridHashTable`) if it's up to date."""
+        grid = grid_conf["grid"]
+        if table is None or not table.matches(grid_conf):
+            table = GridHashTable.build(grid_conf)
+        os.makedirs(os.path.join(self.directory, grid), exist_ok=True)
+        _replace_npy(self._path(grid, "lon.npy"), table.lon)
+        _replace_npy(self._path(grid, "lat.npy"), table.lat)
+        _replace_npy(self._path(grid, "digests.npy"), table.digests)
+        self._grids.pop(grid, None)
+
+    def write_dataset(self, cdf, grid_conf, file_path, table=None):
+        """Convert a `conf.yaml` dataset's file straight into the store,
+        a column at a time, writing its grid first if the store doesn't
+        have it. Raises `ValueError` if the store has the grid with
+        other axes, since every dataset on it would have to be written
+        again. Returns the number of values written."""
+        grid = grid_conf["grid"]
+        if grid not in self.grids():
+            print("[Notice] Writing the {} cell index to the store at {}".format(grid, self.directory))
+            self.write_grid(grid_conf, table)
+        elif not self.matches(grid_conf):
+            raise ValueError(
+                "The {} grid in the store at {} is out of date with the config; "
+                "write the store again from scratch".format(grid, self.directory)
+            )
+
+        grid_index = GridIndex.from_conf(grid_conf)
+        path = self._path(grid, "{}.npy".format(cdf["dataset"]))
+
+        def allocate(shape):
+            values = np.lib.format.open_memmap(path + ".part.npy", mode="w+", dtype="float32", shape=shape)
+            values[:] = np.nan
+            return values
+
+        try:
+            arrays = DatasetArrays.from_file(cdf, grid_index, file_path, allocate)
+            arrays.values.flush()
+            arrays.values = None
+        except BaseException:
+            if os.path.exists(path + ".part.npy"):
+                os.remove(path + ".part.npy")
+            raise
+        os.replace(path + ".part.npy", path)
+
+        meta = {
+            "version": STORE_VERSION,
+            "dataset": arrays.dataset,
+            "grid": grid,
+            "name": cdf.get("name"),
+            "unit": cdf["unit"],
+            "keys": [list(key) for key in arrays.keys],
+        }
+        meta_path = self._path(grid, "{}.json".format(cdf["dataset"]))
+        with open(meta_path + ".part", "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + ".part", meta_path)
+        return len(arrays.keys) * grid_index.cells
+
+    def _meta_path(self, dataset_id):
+        for grid in self.grids():
+            path = self._path(grid, "{}.json".format(int(dataset_id)))
+            if os.path.exists(path):
+                return path
+        raise KeyError("No dataset {} in the store at {}".format(dataset_id, self.directory))
+
+    def meta(self, dataset_id):
+        """What the store knows about a dataset: its grid, unit, name and
+        the (warming scenario, method) of each of its columns."""
+        with open(self._meta_path(dataset_id)) as f:
+            return json.load(f)
+
+    def open_dataset(self, dataset_id):
+        """A dataset as `enrich.DatasetArrays` over its mapped array."""
+        meta = self.meta(dataset_id)
+        values = np.load(self._path(meta["grid"], "{}.npy".format(meta["dataset"])), mmap_mode="r")
+        return DatasetArrays(meta["dataset"], meta["grid"], meta["keys"], values)
+
+    def enricher(self, dataset_ids=None):
+        """An `enrich.Enricher` over the datasets `dataset_ids` (default
+        every dataset in the store), without reading any of them."""
+        datasets = {}
+        for dataset_id in self.datasets() if dataset_ids is None else dataset_ids:
+            arrays = self.open_dataset(dataset_id)
+            datasets[arrays.dataset] = arrays
+        return Enricher({grid: self.grid(grid) for grid in {a.grid for a in datasets.values()}}, datasets)
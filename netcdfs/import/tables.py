@@ -0,0 +1,53 @@
+from sqlalchemy import Column, FetchedValue, Integer, MetaData, Text
+from sqlalchemy.orm import declarative_base
+
+"""
+The two tables `pfimport.py` writes to, spelled out instead of
+reflected. Reflecting the whole pf_public schema and automapping it
+took a round trip per table on every run (every Lambda batch), and
+needed geoalchemy2 and sqlalchemy-citext imported just so reflection
+knew their column types.
+
+Only the columns the importer sets or filters on are here; the rest
+(timestamps, generated columns, defaults) are left to Postgres. citext
+columns are plain text on our side, which is all we need to write
+them. `util/temp.sql` is the real definition; `check_tables` reports
+any column here that the database doesn't have.
+
+"""
+
+Base = declarative_base(metadata=MetaData(schema="pf_public"))
+
+
+class Dataset(Base):
+    __tablename__ = "pf_datasets"
+
+    id = Column(Integer, primary_key=True)
+    slug = Column(Text)
+    name = Column(Text)
+    description = Column(Text)
+    parent_category = Column(Text)
+    sub_category = Column(Text)
+    model = Column(Text)
+    unit = Column(Text)
+
+
+class DatasetStatistic(Base):
+    __tablename__ = "pf_dataset_statistics"
+
+    id = Column(Text, primary_key=True, server_default=FetchedValue())
+    dataset_id = Column(Integer)
+    coordinate_hash = Column(Text)
+    warming_scenario = Column(Text)
+
+
+def check_tables(engine):
+    """The columns defined here that the database's tables don't have,
+    as "table.column" strings. Reflects just these two tables."""
+    reflected = MetaData(schema="pf_public")
+    reflected.reflect(engine, only=[table.name for table in Base.metadata.sorted_tables])
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        columns = reflected.tables[table.key].columns
+        missing += ["{}.{}".format(table.name, c.name) for c in table.columns if c.name not in columns]
+    return missing
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The importer's modules are imported by name, as the scripts do when
+# run from netcdfs/import.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,118 @@
+import time
+
+import numpy as np
+import pytest
+import xarray
+
+from batches import StubInvoker, plan_batches, run_batches
+
+CDF = {"dataset": 20104, "filename": "fixture.nc"}
+
+
+@pytest.fixture
+def file_path(tmp_path):
+    # 10 lons of 4 lats x 2 warming levels: 8 cells a column.
+    lon = np.arange(10, dtype="float64") * 0.2 - 1.0
+    ds = xarray.Dataset(
+        {"mean": (("lon", "lat", "time"), np.ones((10, 4, 2), dtype="float32"))},
+        coords={"lon": lon, "lat": np.arange(4, dtype="float64") * 0.2, "time": [1.0, 2.0]},
+    )
+    path = tmp_path / "fixture.nc"
+    ds.to_netcdf(path)
+    return str(path)
+
+
+def ok(event, context):
+    return {"statusCode": 200, "body": "loaded batch {}".format(event["batch"])}
+
+
+def test_plan_splits_into_whole_columns(file_path):
+    plan = plan_batches(CDF, file_path, 24, add_dataset_record=True)
+
+    assert [entry["event"]["batch"] for entry in plan] == ["1", "2", "3", "4"]
+    assert [entry["cells"] for entry in plan] == [24, 24, 24, 8]
+    assert [entry["lon"] for entry in plan] == [[-1.0, -0.6], [-0.4, 0.0], [0.2, 0.6], [0.8, 0.8]]
+    assert all(entry["event"]["batch_size"] == "24" for entry in plan)
+    assert all(entry["event"]["netcdf_object_key"] == "fixture.nc" for entry in plan)
+    assert [entry["event"].get("add_dataset_record", False) for entry in plan] == [True, False, False, False]
+
+
+def test_column_bigger_than_a_batch_is_one_batch(file_path):
+    plan = plan_batches(CDF, file_path, 3)
+
+    assert len(plan) == 10
+    assert all(entry["cells"] == 8 for entry in plan)
+
+
+def test_every_batch_is_invoked(file_path):
+    invoker = StubInvoker(ok)
+
+    failures = run_batches(plan_batches(CDF, file_path, 24), invoker, concurrency=3)
+
+    assert failures == []
+    assert sorted(event["batch"] for event, _ in invoker.calls) == ["1", "2", "3", "4"]
+
+
+def test_the_record_batch_goes_first_and_alone(file_path):
+    started = []
+    while_record_ran = []
+
+    def handler(event, context):
+        started.append(event["batch"])
+        if event["batch"] == "1":
+            time.sleep(0.05)
+            while_record_ran.extend(started)
+        return ok(event, context)
+
+    run_batches(plan_batches(CDF, file_path, 24, add_dataset_record=True), StubInvoker(handler), concurrency=4)
+
+    assert while_record_ran == ["1"]
+    assert sorted(started) == ["1", "2", "3", "4"]
+
+
+def test_a_failed_batch_is_retried(file_path):
+    attempts = {}
+
+    def flaky(event, context):
+        attempts[event["batch"]] = attempts.get(event["batch"], 0) + 1
+        if event["batch"] == "2" and attempts["2"] == 1:
+            raise RuntimeError("Task timed out")
+        return ok(event, context)
+
+    failures = run_batches(plan_batches(CDF, file_path, 24), StubInvoker(flaky), concurrency=2, retries=1)
+
+    assert failures == []
+    assert attempts == {"1": 1, "2": 2, "3": 1, "4": 1}
+
+
+def test_failures_are_reported_after_the_retries(file_path):
+    attempts = {}
+
+    def broken(event, context):
+        attempts[event["batch"]] = attempts.get(event["batch"], 0) + 1
+        if event["batch"] in ("2", "4"):
+            return {"statusCode": 500, "body": "no luck with batch {}".format(event["batch"])}
+        return ok(event, context)
+
+    failures = run_batches(plan_batches(CDF, file_path, 24), StubInvoker(broken), concurrency=2, retries=2)
+
+    assert failures == [
+        ("2", {"statusCode": 500, "body": "no luck with batch 2"}),
+        ("4", {"statusCode": 500, "body": "no luck with batch 4"}),
+    ]
+    assert attempts == {"1": 1, "2": 3, "3": 1, "4": 3}
+
+
+def test_nothing_else_runs_if_the_record_batch_fails(file_path):
+    attempted = []
+
+    def broken(event, context):
+        attempted.append(event["batch"])
+        raise RuntimeError("could not connect")
+
+    failures = run_batches(
+        plan_batches(CDF, file_path, 24, add_dataset_record=True), StubInvoker(broken), concurrency=2, retries=0
+    )
+
+    assert failures == [("1", {"statusCode": 500, "body": "RuntimeError('could not connect')"})]
+    assert attempted == ["1"]
@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+from collections import namedtuple
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from s3cache import S3Cache
+
+BUCKET = "pf-netcdf"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def downloads(client, monkeypatch):
+    """The keys `download_file` is called with, in order."""
+    keys = []
+    download_file = client.download_file
+
+    def counted(bucket, key, filename, **kwargs):
+        keys.append(key)
+        return download_file(bucket, key, filename, **kwargs)
+
+    monkeypatch.setattr(client, "download_file", counted)
+    return keys
+
+
+def put(client, key, size, fill=b"x"):
+    client.put_object(Bucket=BUCKET, Key=key, Body=fill * size)
+
+
+def cached(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".nc"))
+
+
+def test_a_second_fetch_is_a_hit(client, downloads, tmp_path):
+    put(client, "a.nc", 1000)
+    cache = S3Cache(str(tmp_path), max_bytes=10000, client=client)
+
+    first = cache.fetch(BUCKET, "a.nc")
+    second = cache.fetch(BUCKET, "a.nc")
+
+    assert first == second
+    assert downloads == ["a.nc"]
+    with open(first, "rb") as f:
+        assert f.read() == b"x" * 1000
+
+
+def test_a_new_etag_is_downloaded_again(client, downloads, tmp_path):
+    put(client, "a.nc", 1000)
+    cache = S3Cache(str(tmp_path), max_bytes=10000, client=client)
+    old = cache.fetch(BUCKET, "a.nc")
+    cache.release()
+
+    put(client, "a.nc", 1000, fill=b"y")
+    new = cache.fetch(BUCKET, "a.nc")
+
+    assert new != old
+    assert downloads == ["a.nc", "a.nc"]
+    with open(new, "rb") as f:
+        assert f.read() == b"y" * 1000
+    # The old version is dropped.
+    assert cached(tmp_path) == [os.path.basename(new)]
+
+
+def test_least_recently_used_entries_are_evicted(client, downloads, tmp_path):
+    for key in ("a.nc", "b.nc", "c.nc"):
+        put(client, key, 1000)
+    cache = S3Cache(str(tmp_path), max_bytes=2500, client=client)
+    a = cache.fetch(BUCKET, "a.nc")
+    time.sleep(0.01)
+    b = cache.fetch(BUCKET, "b.nc")
+    time.sleep(0.01)
+    # Using a again makes b the least recently used.
+    cache.fetch(BUCKET, "a.nc")
+    cache.release()
+    time.sleep(0.01)
+
+    c = cache.fetch(BUCKET, "c.nc")
+
+    assert not os.path.exists(b)
+    assert os.path.exists(a) and os.path.exists(c)
+    assert sum(os.path.getsize(os.path.join(tmp_path, name)) for name in cached(tmp_path)) <= 2500
+
+
+def test_an_entry_in_use_is_not_evicted(client, downloads, tmp_path):
+    for key in ("a.nc", "b.nc"):
+        put(client, key, 1000)
+    reader = S3Cache(str(tmp_path), max_bytes=1500, client=client)
+    a = reader.fetch(BUCKET, "a.nc")
+
+    other = S3Cache(str(tmp_path), max_bytes=1500, client=client)
+    b = other.fetch(BUCKET, "b.nc")
+
+    # Over the cap, but a is still being read.
+    assert os.path.exists(a) and os.path.exists(b)
+
+    reader.release(a)
+    other.release(b)
+    put(client, "c.nc", 1000)
+    other.fetch(BUCKET, "c.nc")
+    assert not os.path.exists(a)
+
+
+def test_two_callers_share_one_download(client, downloads, tmp_path, monkeypatch):
+    put(client, "a.nc", 100000)
+    download_file = client.download_file
+
+    def slow(*args, **kwargs):
+        time.sleep(0.2)
+        return download_file(*args, **kwargs)
+
+    monkeypatch.setattr(client, "download_file", slow)
+    paths = []
+    errors = []
+
+    def fetch():
+        # A cache each, as in two processes; the locks are on the files.
+        try:
+            paths.append(S3Cache(str(tmp_path), max_bytes=10 ** 6, client=client).fetch(BUCKET, "a.nc"))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=fetch) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert downloads == ["a.nc"]
+    assert len(set(paths)) == 1
+    assert os.path.getsize(paths[0]) == 100000
+
+
+def test_the_default_cap_is_from_free_space(client, tmp_path, monkeypatch):
+    monkeypatch.setattr("s3cache.CACHE_MB", None)
+    with open(os.path.join(tmp_path, "old.nc"), "wb") as f:
+        f.write(b"x" * 1000)
+    # A nearly full disk: 1 GB, of which 100 MB is free.
+    usage = namedtuple("usage", "total used free")(10 ** 9, 9 * 10 ** 8, 10 ** 8)
+    monkeypatch.setattr("s3cache.shutil.disk_usage", lambda directory: usage)
+
+    cache = S3Cache(str(tmp_path), client=client)
+
+    # Four fifths of the free space and what's already cached.
+    assert cache.max_bytes == int((10 ** 8 + 1000) * 0.8)
@@ -0,0 +1,10 @@
+import pytest
+
+from units import UNIT_CONVERSIONS, check_against_stat_fmt, sample_values
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float64"])
+@pytest.mark.parametrize("unit", sorted(UNIT_CONVERSIONS))
+def test_registry_matches_stat_fmt(unit, dtype):
+    values = sample_values(dtype)
+    assert check_against_stat_fmt(values, [unit]) == []
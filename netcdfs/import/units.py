@@ -0,0 +1,134 @@
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_EVEN
+
+import numpy as np
+from pandas import isna
+from pandas.arrays import IntegerArray
+
+from helpers import NoMatchingUnitError, stat_fmt
+
+"""
+This is the one place we convert netCDF values into database values,
+per unit (see "Datatypes and conversions" in the README). Each unit
+declares the dtype it produces and the number of decimal places it
+keeps, and converts a whole array at once; the importers look a unit
+up once per file or chunk, never once per value.
+
+Every conversion here has to give exactly the value `stat_fmt` gives
+for a single number. `tests/test_units.py` checks that (and so does
+`python units.py`, which exits with 1 on any mismatch).
+
+"""
+
+
+def round_half_even(values, decimals):
+    """Round an array to `decimals` places the way
+    `format_float_positional(precision=decimals)` does: half-even on the
+    exact binary value, not on its shortest decimal repr, so 0.35 (really
+    0.34999...) goes to 0.3 and 0.25 goes to 0.2. Returns float64."""
+    values = np.asarray(values)
+    scale = 10.0 ** decimals
+    scaled = values.astype("float64") * scale
+    rounded = np.rint(scaled)
+    if values.dtype.itemsize > 4:
+        # float32 values times a small power of ten are exact in a
+        # float64, but a float64 product can land on a tie (or miss
+        # one) by rounding, so settle anything close with Decimal.
+        close = np.abs(np.abs(scaled - np.floor(scaled)) - 0.5) <= 1e-6 * np.maximum(
+            1.0, np.abs(scaled)
+        )
+        quantum = Decimal(1).scaleb(-decimals)
+        for i in np.flatnonzero(close):
+            exact = Decimal(float(values.flat[i])).quantize(quantum, ROUND_HALF_EVEN)
+            rounded.flat[i] = float(exact) * scale
+    return rounded / scale
+
+
+def _truncate(values, precision):
+    # Like int(): drop the fraction, toward zero. Nullable integers so
+    # NaN becomes NULL and the numbers are written without a ".0".
+    mask = np.isnan(values)
+    truncated = np.trunc(np.where(mask, 0, values)).astype("int64")
+    return IntegerArray(truncated, mask)
+
+
+class UnitConversion(namedtuple("UnitConversion", "unit dtype precision method description")):
+    def convert(self, values):
+        """Convert a whole array of netCDF values for this unit."""
+        values = np.asarray(values)
+        if values.dtype.kind != "f":
+            values = values.astype("float64")
+        return self.method(values, self.precision)
+
+
+UNIT_CONVERSIONS = {
+    conversion.unit: conversion
+    for conversion in [
+        UnitConversion("days", "Int64", 0, _truncate, "Number of days per year, whole days"),
+        UnitConversion("°C", "Int64", 0, _truncate, "Temperature, whole degrees"),
+        UnitConversion("cm", "Int64", 0, _truncate, "Change in annual precipitation, whole cm"),
+        UnitConversion("mm", "Int64", 0, _truncate, "Change in precipitation, whole mm"),
+        UnitConversion("%", "Int64", 0, _truncate, "Annual likelihood, whole percent"),
+        UnitConversion("likelihood", "Int64", 0, _truncate, "Annual likelihood, whole percent"),
+        UnitConversion("x as frequent", "Int64", 0, _truncate, "Times more/less frequent, whole times"),
+        UnitConversion("class", "Int64", 0, _truncate, "Climate zone class number"),
+        UnitConversion("z-score", "float64", 1, round_half_even, "Z-score to one decimal place"),
+    ]
+}
+
+
+def lookup_unit(unit):
+    """The conversion for a unit, or `NoMatchingUnitError` if we haven't
+    documented one yet."""
+    try:
+        return UNIT_CONVERSIONS[unit]
+    except KeyError:
+        raise NoMatchingUnitError(unit)
+
+
+def check_against_stat_fmt(values, units=None):
+    """Compare every registered conversion (or those of `units`) with
+    `stat_fmt` over `values` and return a list of (unit, value,
+    expected, got) mismatches."""
+    mismatches = []
+    for unit in units or UNIT_CONVERSIONS:
+        conversion = UNIT_CONVERSIONS[unit]
+        converted = conversion.convert(values)
+        for value, got in zip(values, converted):
+            if np.isnan(value):
+                if not isna(got):
+                    mismatches.append((unit, value, None, got))
+                continue
+            expected = Decimal(str(stat_fmt(value, unit)))
+            if Decimal(repr(float(got))) != expected:
+                mismatches.append((unit, value, expected, got))
+    return mismatches
+
+
+def sample_values(dtype, seed=0):
+    """The values `check_against_stat_fmt` is run over: every 0.05 and
+    0.01 step around zero (where the ties are), signed zeros, NaN and
+    a spread of random values, as `dtype`."""
+    rng = np.random.default_rng(seed)
+    edges = np.concatenate(
+        [np.arange(-1000, 1000) / 20, np.arange(-1000, 1000) / 100, [0.0, -0.0, np.nan]]
+    )
+    return np.concatenate(
+        [edges, rng.normal(0, 3, 20000), rng.normal(0, 300, 20000)]
+    ).astype(dtype)
+
+
+if __name__ == "__main__":
+    failed = False
+    for dtype in ["float32", "float64"]:
+        values = sample_values(dtype)
+        mismatches = check_against_stat_fmt(values)
+        for unit, value, expected, got in mismatches[:20]:
+            print(
+                "[Error] {} {!r} ({}): stat_fmt gives {}, registry gives {}".format(
+                    unit, value, dtype, expected, got
+                )
+            )
+        print("[Notice] {} {} values: {} mismatches".format(len(values), dtype, len(mismatches)))
+        failed = failed or bool(mismatches)
+    exit(1 if failed else 0)
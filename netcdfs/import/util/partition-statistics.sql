@@ -0,0 +1,112 @@
+-- pgFormatter-ignore
+-- Partitions pf_dataset_statistics by dataset, for pfimport.py --swap;
+-- util/temp.sql makes the plain table, and only databases that use
+-- --swap need this. Every dataset gets a partition of its own, stats
+-- loaded any other way go to a default partition, the views over the
+-- table are pointed at the new one, and the old table is dropped. It
+-- rewrites every row, so run it when nothing else is loading. The
+-- pgloader files in postgres/loaders set the table unlogged, which a
+-- partitioned table can't be, so they won't work on it afterwards.
+--
+--   psql probable_futures -f util/partition-statistics.sql
+
+begin;
+
+alter table pf_public.pf_dataset_statistics
+  rename to pf_dataset_statistics_unpartitioned;
+alter index pf_public.pf_dataset_stats_dataset_idx
+  rename to pf_dataset_stats_dataset_unpartitioned_idx;
+alter index pf_public.pf_dataset_stats_coordinate_hash_idx
+  rename to pf_dataset_stats_coordinate_hash_unpartitioned_idx;
+alter index pf_public.pf_dataset_stats_warming_idx
+  rename to pf_dataset_stats_warming_unpartitioned_idx;
+
+-- Free up the constraint names too, so the new table gets the same ones.
+do $$
+declare
+  c name;
+begin
+  for c in select conname from pg_constraint
+    where conrelid = 'pf_public.pf_dataset_statistics_unpartitioned'::regclass loop
+    execute format(
+      'alter table pf_public.pf_dataset_statistics_unpartitioned rename constraint %I to %I',
+      c, c || '_unpartitioned');
+  end loop;
+end $$;
+
+create table pf_public.pf_dataset_statistics (
+  id uuid default gen_random_uuid(),
+  dataset_id integer not null references pf_public.pf_datasets(id)
+    on update cascade
+    on delete cascade,
+  coordinate_hash text references pf_public.pf_grid_coordinates(md5_hash)
+    on update cascade,
+  warming_scenario citext references pf_public.pf_warming_scenarios(slug)
+    on update cascade,
+  low_value numeric(6,1),
+  mid_value numeric(6,1),
+  high_value numeric(6,1),
+  created_at timestamptz not null default now(),
+  updated_at timestamptz not null default now(),
+  values numeric[],
+  cumulative_probability numeric[],
+  primary key (id, dataset_id)
+) partition by list (dataset_id);
+comment on table pf_public.pf_dataset_statistics is
+  E'Table storing statistical data (mean, percentile, etc) for PF Climate Datasets';
+
+create table pf_public.pf_dataset_statistics_default
+  partition of pf_public.pf_dataset_statistics default;
+
+-- One partition per dataset already loaded.
+do $$
+declare
+  d integer;
+begin
+  for d in select distinct dataset_id from pf_public.pf_dataset_statistics_unpartitioned loop
+    execute format(
+      'create table pf_public.pf_dataset_statistics_%s partition of pf_public.pf_dataset_statistics for values in (%s)',
+      d, d);
+  end loop;
+end $$;
+
+insert into pf_public.pf_dataset_statistics
+  select * from pf_public.pf_dataset_statistics_unpartitioned;
+
+create index pf_dataset_stats_dataset_idx
+  on pf_public.pf_dataset_statistics (dataset_id);
+
+create index pf_dataset_stats_coordinate_hash_idx
+  on pf_public.pf_dataset_statistics
+  using hash(coordinate_hash);
+
+create index pf_dataset_stats_warming_idx
+  on pf_public.pf_dataset_statistics (warming_scenario);
+
+create trigger _100_timestamps
+  before insert or update on pf_public.pf_dataset_statistics
+  for each row
+  execute procedure pf_private.tg__timestamps();
+
+-- Views keep pointing at the table they were made on, renamed or not,
+-- so make each view over the old table again over the new one.
+do $$
+declare
+  v record;
+begin
+  for v in
+    select distinct r.ev_class::regclass as view, pg_get_viewdef(r.ev_class) as definition
+    from pg_depend d
+    join pg_rewrite r on r.oid = d.objid
+    where d.refobjid = 'pf_public.pf_dataset_statistics_unpartitioned'::regclass
+      and r.ev_class <> d.refobjid
+  loop
+    execute format(
+      'create or replace view %s as %s',
+      v.view, replace(v.definition, 'pf_dataset_statistics_unpartitioned', 'pf_dataset_statistics'));
+  end loop;
+end $$;
+
+drop table pf_public.pf_dataset_statistics_unpartitioned;
+
+commit;